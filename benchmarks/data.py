@@ -0,0 +1,49 @@
+"""
+Synthetic MoneyForward exports for the benchmarks.
+"""
+
+import datetime
+
+import polars as pl
+
+from dami.services.moneyforward import COL_MAPPING
+
+CONTENTS = ["コンビニ ﾗﾝﾁ", "給与", "ＡＢＣストア", "電気料金", "Amazon.co.jp"]
+CATEGORIES = ["食費", "収入", "日用品", "水道・光熱費", "趣味・娯楽"]
+
+
+def make_mf_raw_df(n_rows: int) -> pl.DataFrame:
+    """
+    Rows as they appear in the CSV export, spread over one year,
+    with the mix of ASCII and Japanese text of a real export.
+    """
+    i = pl.col("i")
+    return pl.DataFrame({"i": pl.int_range(n_rows, eager=True)}).select(
+        pl.lit(1, dtype=pl.Int64).alias("計算対象"),
+        (pl.lit(datetime.date(2026, 1, 1)) + pl.duration(days=i % 365))
+        .dt.strftime("%Y/%m/%d")
+        .alias("日付"),
+        pl.lit(pl.Series(CONTENTS)).gather(i % len(CONTENTS)).alias("内容"),
+        (i * -7).alias("金額（円）"),
+        pl.lit("三井住友カード").alias("保有金融機関"),
+        pl.lit(pl.Series(CATEGORIES)).gather(i % len(CATEGORIES)).alias("大項目"),
+        pl.lit("その他").alias("中項目"),
+        pl.lit(None, dtype=pl.String).alias("メモ"),
+        pl.lit(0, dtype=pl.Int64).alias("振替"),
+        pl.format("tx{}", i).alias("ID"),
+    )
+
+
+def make_mf_csv(n_rows: int, encoding: str = "shift-jis") -> bytes:
+    return make_mf_raw_df(n_rows).write_csv().encode(encoding)
+
+
+def make_mf_df(n_rows: int) -> pl.DataFrame:
+    """
+    Rows converted to the schema of the BQ table.
+    """
+    return (
+        make_mf_raw_df(n_rows)
+        .rename(COL_MAPPING)
+        .with_columns(pl.col("transaction_date").str.to_date("%Y/%m/%d"))
+    )
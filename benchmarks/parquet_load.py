@@ -0,0 +1,110 @@
+"""
+Tune the parquet encoding of `BQPolarsHandler.insert_df`: every codec and
+row group size is loaded into the in-memory BigQuery client, with the upload
+throttled to `--upload-mib-per-sec` so that encoding and upload overlap as
+they would over the network. Each setting runs in a fresh process.
+
+    PYTHONPATH=src:. python benchmarks/parquet_load.py --n-rows 1000000
+    PYTHONPATH=src:. python benchmarks/parquet_load.py --compression zstd --row-group-size 65536
+"""
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Annotated, get_args
+
+import typer
+from data import make_mf_df
+from loguru import logger
+from suite import _peak_rss, _reset_peak_rss
+
+from dami.ext.bq import BQPolarsHandler, ParquetCompression, ParquetLoadOptions
+from dami.ext.bq_schema import get_schema_registry
+from dami.settings import GCP_PROJECT
+from tests.fakes import FakeBigQueryClient
+
+
+@dataclass(frozen=True)
+class Result:
+    options: ParquetLoadOptions
+    n_bytes: int
+    encode_seconds: float
+    wall_seconds: float
+    peak_buffer_bytes: int
+    peak_rss_bytes: int
+
+
+def run(n_rows: int, options: ParquetLoadOptions, upload_mib_per_sec: float) -> Result:
+    logger.remove()
+    table = get_schema_registry().table(
+        "moneyforward", project=GCP_PROJECT, dataset="finance"
+    )
+    client = FakeBigQueryClient()
+    client.create_table(table)
+    client.upload_bytes_per_second = upload_mib_per_sec * 1024 * 1024
+    handler = BQPolarsHandler(client=client, load_options=options)  # type: ignore[arg-type]
+    df = make_mf_df(n_rows)
+    rss_before = _reset_peak_rss()
+    stats = handler.insert_df(df, table, write_disposition="WRITE_TRUNCATE")
+    assert stats is not None
+    return Result(
+        options=options,
+        n_bytes=stats.n_bytes,
+        encode_seconds=stats.encode_seconds,
+        wall_seconds=stats.elapsed_seconds,
+        peak_buffer_bytes=stats.peak_buffer_bytes,
+        peak_rss_bytes=max(0, _peak_rss() - rss_before),
+    )
+
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    n_rows: Annotated[int, typer.Option(help="Rows to load")] = 1_000_000,
+    compression: Annotated[
+        list[str] | None, typer.Option(help="Codecs to try (default: all)")
+    ] = None,
+    row_group_size: Annotated[
+        list[int] | None, typer.Option(help="Row group sizes to try")
+    ] = None,
+    max_memory_mib: Annotated[
+        int, typer.Option(help="Encoded MiB held in memory before spilling")
+    ] = 64,
+    upload_mib_per_sec: Annotated[
+        float, typer.Option(help="Simulated upload bandwidth")
+    ] = 50.0,
+) -> None:
+    codecs = compression or list(get_args(ParquetCompression))
+    for codec in codecs:
+        if codec not in get_args(ParquetCompression):
+            raise typer.BadParameter(f"Unknown codec {codec}")
+    print(f"{n_rows} rows, upload at {upload_mib_per_sec:.0f} MiB/s")
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        for codec in codecs:
+            for size in row_group_size or [16 * 1024, 128 * 1024, 1024 * 1024]:
+                options = ParquetLoadOptions(
+                    compression=codec,  # type: ignore[arg-type]
+                    row_group_size=size,
+                    max_memory_bytes=max_memory_mib * 1024 * 1024,
+                )
+                result = executor.submit(
+                    run, n_rows, options, upload_mib_per_sec
+                ).result()
+                print(
+                    f"{codec:>12} {size:>8} rows/group: "
+                    f"{result.n_bytes / 2**20:>7.1f}MiB, "
+                    f"encode {result.encode_seconds:.2f}s, "
+                    f"end-to-end {result.wall_seconds:.2f}s, "
+                    f"buffer {result.peak_buffer_bytes / 2**20:.0f}MiB, "
+                    f"peak RSS +{result.peak_rss_bytes / 2**20:.0f}MiB"
+                )
+
+
+if __name__ == "__main__":
+    app()
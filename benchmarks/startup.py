@@ -0,0 +1,107 @@
+"""
+Cold start of the CLI: runs `python -X importtime scripts/update_mf.py --help`
+in fresh processes and fails when the import time exceeds the budget or when
+a client library is imported before any provider is resolved.
+
+    PYTHONPATH=src python benchmarks/startup.py
+    PYTHONPATH=src python benchmarks/startup.py --budget 0.5 --top 20
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated, Final
+
+import typer
+
+ROOT: Final[Path] = Path(__file__).parent.parent
+CLI_PATH: Final[Path] = ROOT / "scripts" / "update_mf.py"
+DEFAULT_REPEAT: Final[int] = 5
+# median import time of the CLI; dependency_injector alone imports
+# fastapi and pydantic_settings, about 0.4s
+IMPORT_TIME_BUDGET_SECONDS: Final[float] = 0.8
+# loaded by the container only when a handler is first resolved
+LAZY_MODULES: Final[tuple[str, ...]] = (
+    "polars",
+    "pyarrow",
+    "google.cloud.storage",
+    "google.cloud.bigquery",
+    "google.cloud.bigquery_storage_v1",
+)
+
+
+@dataclass(frozen=True)
+class ImportTimes:
+    # module -> cumulative microseconds
+    cumulative_us: dict[str, int]
+    # microseconds of the modules imported at top level, i.e. the whole import
+    total_us: int
+
+
+def parse_importtime(stderr: str) -> ImportTimes:
+    cumulative_us: dict[str, int] = {}
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        module = name.strip()
+        cumulative_us[module] = int(cumulative)
+        # nested imports are indented below their importer
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return ImportTimes(cumulative_us=cumulative_us, total_us=total_us)
+
+
+def measure(cli_path: Path) -> ImportTimes:
+    env = {**os.environ, "PYTHONPATH": str(ROOT / "src")}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", str(cli_path), "--help"],
+        env=env,
+        cwd=cli_path.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(proc.stderr)
+
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    budget: Annotated[
+        float, typer.Option(help="Median import time allowed, in seconds")
+    ] = IMPORT_TIME_BUDGET_SECONDS,
+    repeat: Annotated[int, typer.Option(help="Processes started")] = DEFAULT_REPEAT,
+    top: Annotated[int, typer.Option(help="Slowest top-level imports shown")] = 10,
+) -> None:
+    runs = [measure(CLI_PATH) for _ in range(repeat)]
+    median = statistics.median(run.total_us for run in runs) / 1e6
+    last = runs[-1]
+    print(
+        f"{CLI_PATH.name} --help: median import time {median:.3f}s over {repeat} runs"
+    )
+    slowest = sorted(last.cumulative_us.items(), key=lambda item: -item[1])[:top]
+    for module, us in slowest:
+        print(f"{us / 1e3:>10.1f}ms  {module}")
+    failures = [
+        f"{module} is imported at startup"
+        for module in LAZY_MODULES
+        if module in last.cumulative_us
+    ]
+    if median > budget:
+        failures.append(
+            f"import time {median:.3f}s exceeds the budget of {budget:.3f}s"
+        )
+    if failures:
+        print("\n".join(["Failures:", *failures]))
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,349 @@
+"""
+Offline benchmarks of the ingest and fetch paths on synthetic MoneyForward
+data, run against the in-memory clients of `tests/fakes.py`.
+Each case runs in a fresh process; the run fails when a result regresses
+beyond `baseline.json`.
+
+    PYTHONPATH=src:. python benchmarks/suite.py
+    PYTHONPATH=src:. python benchmarks/suite.py --sizes 10000000 --case download_df
+    PYTHONPATH=src:. python benchmarks/suite.py --update-baseline
+"""
+
+import datetime
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Annotated, Final
+
+import polars as pl
+import typer
+from data import make_mf_csv, make_mf_df
+from dependency_injector import providers
+from loguru import logger
+
+from dami.container import DIContainer
+from dami.ext.bq import BQPolarsHandler
+from dami.ext.bq_schema import get_schema_registry
+from dami.ext.gcs import GCSLocation
+from dami.ext.mirror import TableMirror
+from dami.services.moneyforward import MoneyForwardService
+from dami.settings import GCP_PROJECT, GS_BUCKET
+from tests.fakes import FakeClients, override_with_fakes
+
+BASELINE_PATH: Final[Path] = Path(__file__).parent / "baseline.json"
+DEFAULT_SIZES: Final[list[int]] = [10_000, 100_000, 1_000_000]
+DEFAULT_REPEAT: Final[int] = 3
+# a result regresses when it exceeds baseline * (1 + ratio) + slack;
+# the slack keeps timer and allocator noise on small inputs from failing the run
+MAX_TIME_REGRESSION: Final[float] = 0.5
+TIME_SLACK_SECONDS: Final[float] = 0.05
+MAX_RSS_REGRESSION: Final[float] = 0.25
+RSS_SLACK_BYTES: Final[int] = 32 * 1024 * 1024
+MAX_BYTES_REGRESSION: Final[float] = 0.05
+
+CSV_LOCATION: Final[GCSLocation] = GCSLocation(
+    bucket=GS_BUCKET, path="mf_records/export.csv"
+)
+
+# the timed function and the clients whose counters it moves
+CaseRun = tuple[Callable[[], object], FakeClients | None]
+
+
+@dataclass(frozen=True)
+class Result:
+    case: str
+    n_rows: int
+    wall_seconds: float
+    # growth of the resident set over the memory held before the case ran
+    peak_rss_bytes: int
+    # payload bytes that would cross the network with the real clients
+    bytes_copied: int
+
+    @property
+    def key(self) -> str:
+        return f"{self.case}/{self.n_rows}"
+
+
+def _fake_container() -> tuple[DIContainer, FakeClients]:
+    container = DIContainer()
+    clients = override_with_fakes(container)
+    container.mf_gcs_location.override(
+        providers.Object(GCSLocation(bucket=GS_BUCKET, path="mf_records"))
+    )
+    return container, clients
+
+
+def _mf_table():
+    return get_schema_registry().table(
+        "moneyforward", project=GCP_PROJECT, dataset="finance"
+    )
+
+
+def setup_download_df(n_rows: int) -> CaseRun:
+    container, clients = _fake_container()
+    clients.storage.put_object(
+        CSV_LOCATION.bucket, CSV_LOCATION.path, make_mf_csv(n_rows)
+    )
+    handler = container.gcs_handler()
+    blob = handler.get_blob(CSV_LOCATION)
+    return (lambda: handler.download_df(blob, "shift-jis")), clients
+
+
+def setup_insert_df(n_rows: int) -> CaseRun:
+    container, clients = _fake_container()
+    table = _mf_table()
+    clients.bq.create_table(table)
+    handler: BQPolarsHandler = container.bq_handler()
+    df = make_mf_df(n_rows)
+    return (
+        lambda: handler.insert_df(df, table, write_disposition="WRITE_TRUNCATE")
+    ), clients
+
+
+def setup_validate_df(n_rows: int) -> CaseRun:
+    table = _mf_table()
+    df = make_mf_df(n_rows)
+    return (lambda: BQPolarsHandler.validate_df(df, table)), None
+
+
+def setup_fetch_df(n_rows: int) -> CaseRun:
+    container, clients = _fake_container()
+    table = _mf_table()
+    clients.bq.create_table(table)
+    handler: BQPolarsHandler = container.bq_handler()
+    handler.insert_df(make_mf_df(n_rows), table)
+    fields = ["transaction_id", "transaction_date", "content", "amount"]
+    query = (
+        f"SELECT {', '.join(fields)} FROM {table.get_bq_table_id()} "
+        "WHERE transaction_date BETWEEN @start_date AND @end_date"
+    )
+    params = {
+        "start_date": datetime.date(2026, 1, 1),
+        "end_date": datetime.date(2026, 12, 31),
+    }
+    return (lambda: handler.fetch_df(query, table, fields, params)), clients
+
+
+def setup_mirror_scan(n_rows: int) -> CaseRun:
+    """
+    The query of `fetch_df` on the local mirror, synced beforehand;
+    each run checks for changes first.
+    """
+    container, clients = _fake_container()
+    table = _mf_table()
+    clients.bq.create_table(table)
+    container.bq_handler().insert_df(make_mf_df(n_rows), table)
+    mirror: TableMirror = container.table_mirror(
+        table=table, mirror_dir=Path(tempfile.mkdtemp(prefix="dami-mirror-"))
+    )
+    mirror.sync()
+
+    def run() -> pl.DataFrame:
+        return (
+            mirror.scan(sync=True)
+            .filter(
+                pl.col("transaction_date").is_between(
+                    datetime.date(2026, 1, 1), datetime.date(2026, 12, 31)
+                )
+            )
+            .select("transaction_id", "transaction_date", "content", "amount")
+            .collect()
+        )
+
+    return run, clients
+
+
+def setup_insert_latest_csv(n_rows: int) -> CaseRun:
+    container, clients = _fake_container()
+    clients.storage.put_object(
+        CSV_LOCATION.bucket, CSV_LOCATION.path, make_mf_csv(n_rows)
+    )
+    service: MoneyForwardService = container.mf_service()
+    clients.bq.create_table(service.bq_table)
+
+    def run() -> None:
+        # forget the previous run so that the file is loaded again
+        clients.bq.labels[service.bq_table.get_bq_table_id().strip("`")].clear()
+        service.insert_latest_csv()
+
+    return run, clients
+
+
+def setup_insert_landed_csv(n_rows: int) -> CaseRun:
+    """
+    `insert_latest_csv` of a CSV uploaded with its parquet landing copy.
+    """
+    container, clients = _fake_container()
+    service: MoneyForwardService = container.mf_service()
+    clients.bq.create_table(service.bq_table)
+    csv_path = (
+        Path(tempfile.mkdtemp(prefix="dami-landing-")) / Path(CSV_LOCATION.path).name
+    )
+    csv_path.write_bytes(make_mf_csv(n_rows))
+    service.upload_csv_to_gcs(csv_path)
+
+    def run() -> None:
+        # forget the previous run so that the file is loaded again
+        clients.bq.labels[service.bq_table.get_bq_table_id().strip("`")].clear()
+        service.insert_latest_csv()
+
+    return run, clients
+
+
+CASES: Final[dict[str, Callable[[int], CaseRun]]] = {
+    "download_df": setup_download_df,
+    "insert_df": setup_insert_df,
+    "validate_df": setup_validate_df,
+    "fetch_df": setup_fetch_df,
+    "mirror_scan": setup_mirror_scan,
+    "insert_latest_csv": setup_insert_latest_csv,
+    "insert_landed_csv": setup_insert_landed_csv,
+}
+
+
+def _read_status_bytes(key: str) -> int | None:
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith(f"{key}:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> int:
+    """
+    Reset the peak RSS of this process where Linux allows it and
+    return the current RSS, from which the growth is measured.
+    """
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+    return _read_status_bytes("VmRSS") or 0
+
+
+def _peak_rss() -> int:
+    peak = _read_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    # kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_case(case: str, n_rows: int, repeat: int) -> Result:
+    logger.remove()
+    run, clients = CASES[case](n_rows)
+    if clients is not None:
+        clients.reset_counters()
+    # memory freed by a warm-up run would be reused and hide the peak,
+    # so the peak covers every run and the first run is not timed
+    rss_before = _reset_peak_rss()
+    best = float("inf")
+    for i in range(repeat + 1):
+        started = time.perf_counter()
+        run()
+        if i > 0:
+            best = min(best, time.perf_counter() - started)
+    return Result(
+        case=case,
+        n_rows=n_rows,
+        wall_seconds=best,
+        peak_rss_bytes=max(0, _peak_rss() - rss_before),
+        bytes_copied=clients.bytes_copied // (repeat + 1) if clients is not None else 0,
+    )
+
+
+def find_regressions(result: Result, baseline: dict) -> list[str]:
+    regressions = []
+    if (
+        result.wall_seconds
+        > baseline["wall_seconds"] * (1 + MAX_TIME_REGRESSION) + TIME_SLACK_SECONDS
+    ):
+        regressions.append(
+            f"wall time {result.wall_seconds:.3f}s > baseline {baseline['wall_seconds']:.3f}s"
+        )
+    if (
+        result.peak_rss_bytes
+        > baseline["peak_rss_bytes"] * (1 + MAX_RSS_REGRESSION) + RSS_SLACK_BYTES
+    ):
+        regressions.append(
+            f"peak RSS {result.peak_rss_bytes / 2**20:.0f}MiB > "
+            f"baseline {baseline['peak_rss_bytes'] / 2**20:.0f}MiB"
+        )
+    if result.bytes_copied > baseline["bytes_copied"] * (1 + MAX_BYTES_REGRESSION):
+        regressions.append(
+            f"bytes copied {result.bytes_copied} > baseline {baseline['bytes_copied']}"
+        )
+    return regressions
+
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    sizes: Annotated[list[int] | None, typer.Option(help="Row counts to run")] = None,
+    case: Annotated[
+        list[str] | None, typer.Option(help="Cases to run (default: all)")
+    ] = None,
+    repeat: Annotated[
+        int, typer.Option(help="Timed runs per case; the best is kept")
+    ] = DEFAULT_REPEAT,
+    update_baseline: Annotated[
+        bool, typer.Option(help="Store the results as the new baseline")
+    ] = False,
+) -> None:
+    cases = case or list(CASES)
+    for name in cases:
+        if name not in CASES:
+            raise typer.BadParameter(f"Unknown case {name}; choose from {list(CASES)}")
+    baselines: dict[str, dict] = (
+        json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    )
+    failures: list[str] = []
+    # a fresh process per case keeps peak RSS and warm caches independent
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1,
+    ) as executor:
+        for n_rows in sizes or DEFAULT_SIZES:
+            for name in cases:
+                result = executor.submit(run_case, name, n_rows, repeat).result()
+                baseline = baselines.get(result.key)
+                regressions = (
+                    find_regressions(result, baseline) if baseline is not None else []
+                )
+                status = "NEW" if baseline is None else "FAIL" if regressions else "ok"
+                print(
+                    f"{result.key:<28} {result.wall_seconds:>8.3f}s "
+                    f"{result.peak_rss_bytes / 2**20:>8.1f}MiB "
+                    f"{result.bytes_copied / 2**20:>8.1f}MiB copied  {status}"
+                )
+                failures.extend(f"{result.key}: {r}" for r in regressions)
+                if update_baseline:
+                    baselines[result.key] = {
+                        k: v
+                        for k, v in asdict(result).items()
+                        if k not in ("case", "n_rows")
+                    }
+    if update_baseline:
+        BASELINE_PATH.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+        return
+    if failures:
+        print("\n".join(["Regressions:", *failures]))
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,69 @@
+"""
+Compare loading a Shift-JIS MoneyForward export with `pl.read_csv(encoding=...)`
+against the chunked transcoder used by `GCSHandler.download_df`.
+
+    PYTHONPATH=src python benchmarks/transcode.py --n-rows 1000000
+"""
+
+import io
+import time
+import tracemalloc
+from typing import Annotated
+
+import polars as pl
+import typer
+from data import make_mf_csv
+
+from dami.ext.gcs import DOWNLOAD_CHUNK_SIZE
+from dami.ext.transcode import transcode_to_utf8
+
+app = typer.Typer()
+
+
+def read_decoded(data: bytes, encoding: str) -> pl.DataFrame:
+    return pl.read_csv(data, encoding=encoding)
+
+
+def read_transcoded(data: bytes, encoding: str) -> pl.DataFrame:
+    view = memoryview(data)
+    chunks = (
+        view[i : i + DOWNLOAD_CHUNK_SIZE].tobytes()
+        for i in range(0, len(data), DOWNLOAD_CHUNK_SIZE)
+    )
+    buffer = io.BytesIO()
+    for chunk in transcode_to_utf8(chunks, encoding):
+        buffer.write(chunk)
+    buffer.seek(0)
+    return pl.read_csv(buffer)
+
+
+@app.command()
+def main(
+    n_rows: Annotated[
+        int, typer.Option(help="Rows in the synthetic export")
+    ] = 1_000_000,
+    encoding: Annotated[str, typer.Option(help="Encoding of the export")] = "shift-jis",
+    repeat: Annotated[
+        int, typer.Option(help="Runs per reader; the best is reported")
+    ] = 3,
+) -> None:
+    data = make_mf_csv(n_rows, encoding)
+    print(f"{n_rows} rows, {len(data) / 2**20:.1f} MiB in {encoding}")
+    results: dict[str, pl.DataFrame] = {}
+    for name, reader in [("decode", read_decoded), ("transcode", read_transcoded)]:
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            results[name] = reader(data, encoding)
+            best = min(best, time.perf_counter() - started)
+        # Python-side allocations only; the Polars parser allocates in Rust
+        tracemalloc.start()
+        reader(data, encoding)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>10}: {best:.3f}s, peak Python memory {peak / 2**20:.1f} MiB")
+    assert results["decode"].equals(results["transcode"])
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,9 @@
+"""
+Ingestion API server: `uvicorn --app-dir scripts api:app`
+"""
+
+from update_mf import init_container
+
+from dami.api import create_app
+
+app = create_app(init_container())
@@ -0,0 +1,34 @@
+from typing import Annotated
+
+import typer
+from update_mf import init_container
+
+from dami.services.moneyforward import BACKFILL_MAX_WORKERS, MoneyForwardService
+from dami.types.gcs import GCSLocation
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    prefix: Annotated[
+        str | None,
+        typer.Option(help="gs:// prefix to backfill from (default: mf_records/)"),
+    ] = None,
+    max_workers: Annotated[
+        int, typer.Option(help="Number of CSVs downloaded and parsed concurrently")
+    ] = BACKFILL_MAX_WORKERS,
+    max_memory_bytes: Annotated[
+        int | None, typer.Option(help="Memory ceiling for downloading each CSV")
+    ] = None,
+) -> None:
+    container = init_container()
+    service: MoneyForwardService = container.mf_service()
+    loc = GCSLocation.from_uri(prefix) if prefix is not None else None
+    service.backfill(
+        prefix=loc, max_workers=max_workers, max_memory_bytes=max_memory_bytes
+    )
+
+
+if __name__ == "__main__":
+    app()
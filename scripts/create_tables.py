@@ -0,0 +1,28 @@
+from typing import Annotated
+
+import typer
+from update_mf import init_container
+
+from dami.ext.bq import BQPolarsHandler
+from dami.settings import GCP_PROJECT
+
+app = typer.Typer()
+
+
+@app.command()
+def main(
+    dataset: Annotated[str, typer.Option(help="Dataset to create the tables in")],
+    names: Annotated[
+        list[str], typer.Argument(help="Schemas in bigquery/schema/ to create")
+    ],
+) -> None:
+    container = init_container()
+    handler: BQPolarsHandler = container.bq_handler()
+    registry = container.schema_registry()
+    # existing tables are kept; a partitioning change needs the table recreated
+    for name in names:
+        handler.create_table(registry.table(name, project=GCP_PROJECT, dataset=dataset))
+
+
+if __name__ == "__main__":
+    app()
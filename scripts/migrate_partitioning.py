@@ -0,0 +1,68 @@
+from typing import Annotated
+
+import typer
+from loguru import logger
+from update_mf import init_container
+
+from dami.ext.bq import BQPolarsHandler
+from dami.settings import GCP_PROJECT
+from dami.types.bq import BQTable
+
+app = typer.Typer()
+
+
+def migrate(handler: BQPolarsHandler, table: BQTable) -> None:
+    """
+    Recreate `table` with the partitioning and clustering of its options,
+    since BigQuery cannot partition an existing table in place.
+    The rows are copied into a new table, which then replaces the old one.
+    Stop the ingests first; the table is missing between the delete and the copy.
+    The labels are not copied, so the next ingest loads its CSV again.
+    """
+    table_id = f"{table.project}.{table.dataset}.{table.table}"
+    migrated = table.model_copy(update={"table": f"{table.table}_migrated"})
+    migrated_id = f"{migrated.project}.{migrated.dataset}.{migrated.table}"
+    handler.create_table(migrated, exists_ok=False)
+    columns = ", ".join(field.name for field in table.fields)
+    handler.run_update_query(
+        f"INSERT INTO {migrated.get_bq_table_id()} ({columns}) "
+        f"SELECT {columns} FROM {table.get_bq_table_id()}",
+        {},
+    )
+    handler.client.delete_table(table_id)
+    # a copy into a new table keeps the partitioning of its source
+    handler.client.copy_table(migrated_id, table_id).result()
+    handler.client.delete_table(migrated_id)
+    handler.invalidate_cache(table_id)
+    logger.info(f"Migrated {table.get_bq_table_id()} to {table.time_partitioning}")
+
+
+@app.command()
+def main(
+    dataset: Annotated[str, typer.Option(help="Dataset of the tables")],
+    names: Annotated[
+        list[str], typer.Argument(help="Schemas in bigquery/schema/ to migrate")
+    ],
+    dry_run: Annotated[
+        bool, typer.Option(help="Only report the tables to migrate")
+    ] = False,
+) -> None:
+    container = init_container()
+    handler: BQPolarsHandler = container.bq_handler()
+    registry = container.schema_registry()
+    for name in names:
+        table = registry.table(name, project=GCP_PROJECT, dataset=dataset)
+        live = handler.get_time_partitioning(table)
+        if live == table.time_partitioning:
+            logger.info(f"{table.get_bq_table_id()} is already partitioned as declared")
+            continue
+        logger.info(
+            f"{table.get_bq_table_id()} is partitioned as {live}, "
+            f"declared as {table.time_partitioning}"
+        )
+        if not dry_run:
+            migrate(handler, table)
+
+
+if __name__ == "__main__":
+    app()
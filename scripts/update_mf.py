@@ -1,14 +1,19 @@
 from pathlib import Path
-from typing import Annotated
+from typing import TYPE_CHECKING, Annotated
 from dami.container import AppSettings, DIContainer
 
-from dami.ext.gcs import GCSLocation
-from dami.services.moneyforward import MoneyForwardService
+from dami.types.gcs import GCSLocation
+from dami.types.moneyforward import IngestMode
 import typer
 
 from dami.settings import SERVICE_ACCOUNT_PATH
+from dami.tracing import JsonLinesExporter, configure_tracing
 from dependency_injector import providers
 
+if TYPE_CHECKING:
+    # the clients load when the service is resolved, not at `--help`
+    from dami.services.moneyforward import MoneyForwardService
+
 
 app = typer.Typer()
 
@@ -29,12 +34,24 @@ def init_container() -> DIContainer:
 
 
 @app.command()
-def main(csv_path: Annotated[Path, typer.Argument(..., help="Path to the CSV file")]) -> None:
+def main(
+    csv_path: Annotated[Path, typer.Argument(..., help="Path to the CSV file")],
+    mode: Annotated[
+        IngestMode, typer.Option(help="replace: reload the date range, upsert: MERGE changed rows")
+    ] = "replace",
+    force: Annotated[
+        bool, typer.Option(help="Load into BigQuery even if the file was already loaded")
+    ] = False,
+    trace: Annotated[
+        Path | None, typer.Option(help="Append timed spans to this JSON lines file")
+    ] = None,
+) -> None:
+    if trace is not None:
+        configure_tracing(JsonLinesExporter(trace))
     container = init_container()
-    service: MoneyForwardService = container.mf_service()
-    # Upload the CSV file to GCS
-    service.upload_csv_to_gcs(local_path=csv_path)
-    service.insert_latest_csv()
+    service: "MoneyForwardService" = container.mf_service()
+    # Upload the CSV file to GCS and load it; no-op if it is unchanged
+    service.ingest_csv(local_path=csv_path, mode=mode, force=force)
 
 
 if __name__ == "__main__":
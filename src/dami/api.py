@@ -0,0 +1,94 @@
+import asyncio
+import tempfile
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Final
+
+from fastapi import FastAPI, HTTPException, Request, status
+
+from dami.container import DIContainer
+from dami.services.ingest import (
+    INGEST_MAX_PENDING,
+    INGEST_MAX_WORKERS,
+    IngestJob,
+    IngestJobQueue,
+    QueueFullError,
+)
+from dami.services.moneyforward import MoneyForwardService
+from dami.types.moneyforward import IngestMode
+
+MAX_CONCURRENT_UPLOADS: Final[int] = 8
+
+
+def create_app(
+    container: DIContainer,
+    max_concurrent_uploads: int = MAX_CONCURRENT_UPLOADS,
+    max_ingest_workers: int = INGEST_MAX_WORKERS,
+    max_pending_ingests: int = INGEST_MAX_PENDING,
+) -> FastAPI:
+    queue = IngestJobQueue(
+        service_factory=container.mf_service,
+        max_workers=max_ingest_workers,
+        max_pending=max_pending_ingests,
+    )
+    upload_slots = asyncio.Semaphore(max_concurrent_uploads)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncGenerator[None]:
+        # build the clients once at startup instead of on the first request,
+        # so that the handlers never resolve a provider on the event loop
+        app.state.mf_service = container.mf_service()
+        yield
+        queue.shutdown(wait=True)
+
+    app = FastAPI(title="dami", lifespan=lifespan)
+
+    @app.put(
+        "/moneyforward/csv/{filename}",
+        status_code=status.HTTP_202_ACCEPTED,
+    )
+    async def upload_moneyforward_csv(
+        filename: str,
+        request: Request,
+        mode: IngestMode = "replace",
+    ) -> IngestJob:
+        """
+        Upload the request body to GCS like a local CSV, skipping an unchanged
+        file and writing its landing copy, and queue its ingest into BigQuery.
+        """
+        if not filename.endswith(".csv"):
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, "Only CSV files are accepted"
+            )
+        # reject before reading the body when the uploads or the queue are saturated
+        if upload_slots.locked() or queue.is_full():
+            raise HTTPException(
+                status.HTTP_429_TOO_MANY_REQUESTS, "Too many uploads in progress"
+            )
+        service: MoneyForwardService = request.app.state.mf_service
+        async with upload_slots:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                # spooled to disk; the CRC32C and the landing copy need the whole file
+                local_path = Path(tmp_dir) / Path(filename).name
+                with local_path.open("wb") as f:
+                    async for chunk in request.stream():
+                        await asyncio.to_thread(f.write, chunk)
+                blob = await asyncio.to_thread(service.upload_csv_to_gcs, local_path)
+        try:
+            return queue.submit(blob, mode=mode)
+        except QueueFullError as e:
+            raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, str(e))
+
+    @app.get("/jobs")
+    async def list_jobs() -> list[IngestJob]:
+        return queue.list()
+
+    @app.get("/jobs/{job_id}")
+    async def get_job(job_id: str) -> IngestJob:
+        job = queue.get(job_id)
+        if job is None:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, f"Job not found: {job_id}")
+        return job
+
+    return app
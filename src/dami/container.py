@@ -1,18 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Literal
+from typing import TYPE_CHECKING, Any, Literal
 from dependency_injector.containers import DeclarativeContainer
 
 from dependency_injector import providers
-from google.cloud import storage
-from google.cloud import bigquery
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 from pydantic import model_validator
 
-from dami.ext.bq import BQPolarsHandler
-from dami.ext.gcs import GCSHandler, GCSLocation
-from dami.services.moneyforward import MoneyForwardService
+from dami.ext.http import HTTP_POOL_SIZE, RequestCounter
+from dami.types.gcs import GCSLocation
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery, storage
+    from google.cloud.bigquery_storage_v1 import BigQueryReadClient, BigQueryWriteClient
+
+    from dami.ext.aio import AsyncBQPolarsHandler, AsyncGCSHandler
+    from dami.ext.bq import BQPolarsHandler, ParquetLoadOptions
+    from dami.ext.bq_schema import SchemaRegistry
+    from dami.ext.gcs import BucketCache, GCSHandler
+    from dami.ext.mirror import TableMirror
+    from dami.ext.read_policy import ReadPolicy, ResilientReader
+    from dami.services.moneyforward import MoneyForwardService
 
 
 AppEnv = Literal["dev", "prod"]
@@ -21,6 +31,8 @@ AppEnv = Literal["dev", "prod"]
 class AppSettings(BaseSettings):
     environemnt: AppEnv
     service_account_path: str | Path | None = None
+    # connections kept alive per host
+    http_pool_size: int = HTTP_POOL_SIZE
     model_config = SettingsConfigDict(env_prefix="APP_")
 
     @model_validator(mode="after")
@@ -36,41 +48,209 @@ class AppSettings(BaseSettings):
         return self
     
 
-def inject_storage_client(settings: AppSettings) -> storage.Client:
+# The client libraries are imported inside each `inject_*` function,
+# which runs when its provider is first resolved.
+
+
+def inject_storage_client(
+    settings: AppSettings, request_counter: RequestCounter
+) -> "storage.Client":
+    from google.cloud import storage
+    from google.oauth2 import service_account
+
+    from dami.ext.http import pooled_session
+
     assert settings.service_account_path is not None
-    return storage.Client.from_service_account_json(
-        str(settings.service_account_path)
+    credentials = service_account.Credentials.from_service_account_file(
+        str(settings.service_account_path), scopes=storage.Client.SCOPE
+    )
+    # one pooled keep-alive session shared by the handlers of every thread
+    return storage.Client(
+        project=credentials.project_id,
+        credentials=credentials,
+        _http=pooled_session(credentials, settings.http_pool_size, request_counter),
     )
 
 
-def inject_bq_client(settings: AppSettings) -> bigquery.Client:
+def inject_bq_client(settings: AppSettings) -> "bigquery.Client":
+    from google.cloud import bigquery
+
     assert settings.service_account_path is not None
     return bigquery.Client.from_service_account_json(
         str(settings.service_account_path)
     )
-    
+
+
+def inject_bq_write_client(settings: AppSettings) -> "BigQueryWriteClient":
+    from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+
+    assert settings.service_account_path is not None
+    return BigQueryWriteClient.from_service_account_json(
+        str(settings.service_account_path)
+    )
+
+
+def inject_bq_read_client(settings: AppSettings) -> "BigQueryReadClient":
+    from google.cloud.bigquery_storage_v1 import BigQueryReadClient
+
+    assert settings.service_account_path is not None
+    return BigQueryReadClient.from_service_account_json(
+        str(settings.service_account_path)
+    )
+
+
+def inject_aio_executor() -> ThreadPoolExecutor:
+    from dami.ext.aio import AIO_MAX_WORKERS
+
+    return ThreadPoolExecutor(max_workers=AIO_MAX_WORKERS)
+
+
+# The handlers and services import the client libraries at module level,
+# so they are imported the same way.
+
+
+def inject_gcs_handler(**kwargs: Any) -> "GCSHandler":
+    from dami.ext.gcs import GCSHandler
+
+    return GCSHandler(**kwargs)
+
+
+def inject_bucket_cache() -> "BucketCache":
+    from dami.ext.gcs import BucketCache
+
+    return BucketCache()
+
+
+def inject_read_policy() -> "ReadPolicy":
+    from dami.ext.read_policy import ReadPolicy
+
+    return ReadPolicy()
+
+
+def inject_gcs_reader(policy: "ReadPolicy") -> "ResilientReader":
+    from dami.ext.read_policy import ResilientReader
+
+    return ResilientReader(policy=policy)
+
+
+def inject_bq_handler(**kwargs: Any) -> "BQPolarsHandler":
+    from dami.ext.bq import BQPolarsHandler
+
+    return BQPolarsHandler(**kwargs)
+
+
+def inject_bq_load_options() -> "ParquetLoadOptions":
+    from dami.ext.bq import ParquetLoadOptions
+
+    return ParquetLoadOptions()
+
+
+def inject_schema_registry() -> "SchemaRegistry":
+    from dami.ext.bq_schema import get_schema_registry
+
+    return get_schema_registry()
+
+
+def inject_async_gcs_handler(
+    executor: ThreadPoolExecutor, handler: "GCSHandler"
+) -> "AsyncGCSHandler":
+    from dami.ext.aio import AsyncGCSHandler
+
+    return AsyncGCSHandler(executor=executor, handler=handler)
+
+
+def inject_async_bq_handler(
+    executor: ThreadPoolExecutor, handler: "BQPolarsHandler"
+) -> "AsyncBQPolarsHandler":
+    from dami.ext.aio import AsyncBQPolarsHandler
+
+    return AsyncBQPolarsHandler(executor=executor, handler=handler)
+
+
+def inject_table_mirror(**kwargs: Any) -> "TableMirror":
+    from dami.ext.mirror import TableMirror
+
+    return TableMirror(**kwargs)
+
+
+def inject_mf_service(**kwargs: Any) -> "MoneyForwardService":
+    from dami.services.moneyforward import MoneyForwardService
+
+    return MoneyForwardService(**kwargs)
 
 
 class DIContainer(DeclarativeContainer):
     settings = providers.Factory(AppSettings)
     # settings
     mf_gcs_location = providers.Factory(GCSLocation)
+    schema_registry = providers.Callable(inject_schema_registry)
+    # parquet encoding of load jobs
+    bq_load_options = providers.Factory(inject_bq_load_options)
     # clients
-    storage_client = providers.Singleton(inject_storage_client, settings=settings)
+    storage_request_counter = providers.Singleton(RequestCounter)
+    storage_client = providers.Singleton(
+        inject_storage_client,
+        settings=settings,
+        request_counter=storage_request_counter,
+    )
     bq_client = providers.Singleton(inject_bq_client, settings=settings)
+    bq_write_client = providers.Singleton(inject_bq_write_client, settings=settings)
+    bq_read_client = providers.Singleton(inject_bq_read_client, settings=settings)
+    # opt-in: override with a QueryResultCache to cache `fetch_df` results
+    bq_query_cache = providers.Object(None)
+    # bucket handles shared by the handlers of every thread
+    gcs_bucket_cache = providers.Singleton(inject_bucket_cache)
+    # retries and hedging of GCS reads; the reader keeps the latencies
+    # and stats of every handler
+    gcs_read_policy = providers.Factory(inject_read_policy)
+    gcs_reader = providers.Singleton(inject_gcs_reader, policy=gcs_read_policy)
     # ext
     gcs_handler = providers.ThreadLocalSingleton(
-        GCSHandler,
+        inject_gcs_handler,
         client=storage_client,
+        bucket_cache=gcs_bucket_cache,
+        reader=gcs_reader,
     )
     bq_handler = providers.ThreadLocalSingleton(
-        BQPolarsHandler,
+        inject_bq_handler,
         client=bq_client,
+        write_client=bq_write_client,
+        read_client=bq_read_client,
+        query_cache=bq_query_cache,
+        load_options=bq_load_options,
+    )
+    # local parquet copy of a table: `container.table_mirror(table=...)`
+    table_mirror = providers.Factory(inject_table_mirror, handler=bq_handler)
+    # async ext: one handler shared by every coroutine, with a shared pool
+    # for the short blocking calls
+    aio_executor = providers.Singleton(inject_aio_executor)
+    async_gcs_handler = providers.Singleton(
+        inject_async_gcs_handler,
+        executor=aio_executor,
+        handler=providers.Singleton(
+            inject_gcs_handler,
+            client=storage_client,
+            bucket_cache=gcs_bucket_cache,
+            reader=gcs_reader,
+        ),
+    )
+    async_bq_handler = providers.Singleton(
+        inject_async_bq_handler,
+        executor=aio_executor,
+        handler=providers.Singleton(
+            inject_bq_handler,
+            client=bq_client,
+            write_client=bq_write_client,
+            read_client=bq_read_client,
+            query_cache=bq_query_cache,
+            load_options=bq_load_options,
+        ),
     )
     # services
     mf_service = providers.ThreadLocalSingleton(
-        MoneyForwardService,
+        inject_mf_service,
         bq_handler=bq_handler,
         gcs_handler=gcs_handler,
         gcs_dir=mf_gcs_location,
+        schema_registry=schema_registry,
     )
@@ -0,0 +1,164 @@
+import asyncio
+import functools
+from collections.abc import AsyncIterable, Callable, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Final, ParamSpec, TypeVar
+
+import polars as pl
+from google.api_core.future.polling import PollingFuture
+from google.cloud import bigquery as bq
+from google.cloud.storage import Blob
+from loguru import logger
+
+from dami.ext.bq import (
+    BQPolarsHandler,
+    WriteDisposition,
+    _create_query_job_config_from_python,
+)
+from dami.ext.gcs import GCSHandler, GCSLocation, GCSPath, UploadStats
+from dami.ext.query_cache import dml_target_tables
+from dami.types.bq import BQQuery, BQTable, QueryParamValue
+
+# the pooled HTTP sessions (HTTP_POOL_SIZE) keep a connection for each of
+# these workers plus the parallel part uploads (UPLOAD_MAX_WORKERS)
+AIO_MAX_WORKERS: Final[int] = 10
+JOB_POLL_INITIAL_INTERVAL: Final[float] = 0.2
+JOB_POLL_MAX_INTERVAL: Final[float] = 5.0
+
+P = ParamSpec("P")
+R = TypeVar("R")
+J = TypeVar("J", bound=PollingFuture)
+
+
+@dataclass
+class _AsyncRunner:
+    executor: ThreadPoolExecutor
+
+    async def _run(self, fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+        """
+        Run a short blocking call (one request or local CPU work) on the shared pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs)
+        )
+
+
+@dataclass
+class AsyncGCSHandler(_AsyncRunner):
+    """
+    Awaitable counterpart of `GCSHandler`.
+    All instances share one handler (and so one client and its connection pool);
+    concurrent transfers are bounded by the executor.
+    """
+
+    handler: GCSHandler
+
+    async def get_blob(self, loc: GCSLocation) -> Blob:
+        return await self._run(self.handler.get_blob, loc)
+
+    async def find_blob(self, loc: GCSLocation) -> Blob | None:
+        return await self._run(self.handler.find_blob, loc)
+
+    async def get_latest_blob(self, prefix: GCSPath, suffix: str) -> Blob | None:
+        return await self._run(self.handler.get_latest_blob, prefix, suffix)
+
+    async def download_df(
+        self,
+        blob: Blob,
+        str_encoding: str | None,
+        max_memory_bytes: int | None = None,
+    ) -> pl.DataFrame:
+        return await self._run(
+            self.handler.download_df, blob, str_encoding, max_memory_bytes
+        )
+
+    async def upload_bytes(self, data: bytes, loc: GCSLocation) -> None:
+        await self._run(self.handler.upload_bytes, data, loc)
+
+    async def upload_file(self, local_path: Path, loc: GCSLocation) -> UploadStats:
+        return await self._run(self.handler.upload_file, local_path, loc)
+
+    async def upload_stream(
+        self, chunks: AsyncIterable[bytes], loc: GCSLocation
+    ) -> Blob:
+        """
+        Upload an async byte stream (e.g. a request body) without buffering it.
+        If the stream fails, the upload is abandoned and no object is created.
+        """
+        writer = await self._run(self.handler.open_writer, loc)
+        async for chunk in chunks:
+            if chunk:
+                await self._run(writer.write, chunk)
+        await self._run(writer.close)
+        return await self.get_blob(loc)
+
+    async def delete_blob(self, loc: GCSLocation) -> None:
+        await self._run(self.handler.delete_blob, loc)
+
+
+@dataclass
+class AsyncBQPolarsHandler(_AsyncRunner):
+    """
+    Awaitable counterpart of `BQPolarsHandler`.
+    Jobs are submitted on the executor and then polled with `asyncio.sleep`
+    in between, so a running job does not occupy a thread.
+    """
+
+    handler: BQPolarsHandler
+    poll_initial_interval: float = JOB_POLL_INITIAL_INTERVAL
+    poll_max_interval: float = JOB_POLL_MAX_INTERVAL
+
+    async def wait_job(self, job: J) -> J:
+        interval = self.poll_initial_interval
+        while not await self._run(job.done):
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.poll_max_interval)
+        # raises the job error if any
+        await self._run(job.result)
+        return job
+
+    async def insert_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+    ) -> None:
+        job = await self._run(self.handler.submit_load_df, df, table, write_disposition)
+        await self.wait_job(job)
+        self.handler.invalidate_cache(f"{table.project}.{table.dataset}.{table.table}")
+        logger.info(f"completed load job {job.job_id}")
+
+    async def run_update_query(
+        self,
+        query: BQQuery,
+        params: Mapping[str, QueryParamValue],
+    ) -> None:
+        job = await self._run(self.handler.submit_update_query, query, params)
+        await self.wait_job(job)
+        for table_id in dml_target_tables(query):
+            self.handler.invalidate_cache(table_id)
+        logger.info("completed update query")
+
+    async def fetch_df(
+        self,
+        query: BQQuery,
+        table: BQTable,
+        fields_to_fetch: list[str],
+        params: Mapping[str, QueryParamValue],
+    ) -> pl.DataFrame:
+        job_config = _create_query_job_config_from_python(params)
+        cache_key, cached = await self._run(
+            self.handler.lookup_cache, query, job_config, table, fields_to_fetch
+        )
+        if cached is not None:
+            return cached
+        job: bq.QueryJob = await self._run(
+            self.handler.client.query, query, job_config=job_config
+        )
+        await self.wait_job(job)
+        return await self._run(
+            self.handler.job_to_df, job, table, fields_to_fetch, cache_key
+        )
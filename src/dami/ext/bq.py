@@ -1,33 +1,37 @@
-from collections.abc import Mapping
-from dataclasses import dataclass
+from collections.abc import Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 import datetime
-import io
-from typing import cast
+import json
+import time
+from typing import IO, Final, Literal, cast
+import uuid
 
+from google import resumable_media
 from google.cloud import bigquery as bq
+from google.cloud import exceptions as google_exceptions
+from google.cloud.bigquery_storage_v1 import BigQueryReadClient, BigQueryWriteClient
+from google.cloud.bigquery_storage_v1 import types as bqs_types
 import polars as pl
+from polars.io.plugins import register_io_source
+import pyarrow as pa
 
+from dami.ext.bq_schema import PolarsSchema, generate_bq_table, table_schema
+from dami.ext.query_cache import QueryResultCache, dml_target_tables
+from dami.ext.spool import SpooledPipe
+from dami.tracing import AttributeValue, current_span, in_current_context, span, traced
 from dami.types.bq import (
     BQDataType,
-    BQField,
     BQQuery,
-    PolarsTypeForBQ,
     PythonTypeForBQ,
     BQTable,
+    BQTimePartitioning,
+    QueryParamValue,
 )
 
 from loguru import logger
 
 
-BQ_TYPE_TO_POLARS_DTYPE: dict[BQDataType, type[PolarsTypeForBQ]] = {
-    "STRING": pl.String,
-    "INTEGER": pl.Int64,
-    "FLOAT": pl.Float64,
-    "BOOLEAN": pl.Boolean,
-    "TIMESTAMP": pl.Datetime,
-    "DATE": pl.Date,
-}
-
 PYTHON_TYPE_TO_BQ_TYPE: dict[type[PythonTypeForBQ], BQDataType] = {
     str: "STRING",
     int: "INTEGER",
@@ -37,150 +41,851 @@ PYTHON_TYPE_TO_BQ_TYPE: dict[type[PythonTypeForBQ], BQDataType] = {
     datetime.date: "DATE",
 }
 
+# "load_job": one parquet load job
+# "storage_write": Arrow record batches through the Storage Write API
+InsertMode = Literal["load_job", "storage_write"]
+WriteDisposition = Literal["WRITE_APPEND", "WRITE_TRUNCATE"]
+# PENDING streams become visible together at commit; COMMITTED ones on append
+WriteStreamType = Literal["PENDING", "COMMITTED"]
+
+# codecs BigQuery reads from parquet ("lz4" is written as LZ4_RAW)
+ParquetCompression = Literal["uncompressed", "snappy", "gzip", "lz4", "zstd"]
+PARQUET_ROW_GROUP_SIZE: Final[int] = 128 * 1024
+# encoded parquet held in memory before the load buffer spills to a temp file
+PARQUET_SPOOL_MAX_MEMORY_BYTES: Final[int] = 64 * 1024 * 1024
+# chunks of the load job upload, each sent as soon as it is encoded;
+# resumable uploads take whole units of 256 KiB
+PARQUET_UPLOAD_CHUNK_SIZE: Final[int] = 8 * 1024 * 1024
+RESUMABLE_UPLOAD_CHUNK_UNIT: Final[int] = 256 * 1024
+# retries of each upload request, as in `load_table_from_file`
+LOAD_UPLOAD_NUM_RETRIES: Final[int] = 6
+
+# AppendRows requests are limited to 10MB; keep headroom for the envelope
+STORAGE_WRITE_MAX_REQUEST_BYTES: Final[int] = 8 * 1024 * 1024
+STORAGE_WRITE_MAX_STREAMS: Final[int] = 4
+STORAGE_READ_MAX_STREAMS: Final[int] = 4
+# load jobs of `replace_partitions` uploading at the same time
+REPLACE_PARTITIONS_MAX_WORKERS: Final[int] = 4
+_PARTITION_ID_COLUMN: Final[str] = "__partition_id"
+# record batches buffered between the read streams and the consumer
+STORAGE_READ_MAX_QUEUE_SIZE: Final[int] = 8
+# a query request, parameters included, is limited to 10MB of JSON;
+# the size per key is estimated from a sample, so keep headroom
+FETCH_BY_KEYS_MAX_PARAM_BYTES: Final[int] = 4 * 1024 * 1024
+FETCH_BY_KEYS_MAX_WORKERS: Final[int] = 4
+_KEY_SIZE_SAMPLE: Final[int] = 100
+
+# job statistics attached to the spans of finished jobs
+JOB_STAT_ATTRIBUTES: Final[tuple[str, ...]] = (
+    "total_bytes_processed",
+    "total_bytes_billed",
+    "slot_millis",
+    "num_dml_affected_rows",
+    "cache_hit",
+    "output_rows",
+    "output_bytes",
+    "input_file_bytes",
+)
+
 BQQueryParameter = (
     bq.ArrayQueryParameter | bq.ScalarQueryParameter | bq.StructQueryParameter
 )
 
 
-def _validate_field(bq_field: BQField, polars_dtype: pl.DataType) -> None:
-    if bq_field.type != "RECORD":
-        expected_dtype = BQ_TYPE_TO_POLARS_DTYPE[bq_field.type]
-        actual_dtype = polars_dtype.__class__
-        if expected_dtype != actual_dtype:
-            raise TypeError(
-                f"Field {bq_field.name} has incorrect dtype: "
-                f"expected {expected_dtype}, got {actual_dtype}"
-            )
-    else:
-        # RECORD type: validate sub-fields
-        if not isinstance(polars_dtype, pl.Struct):
-            raise TypeError(
-                f"Field {bq_field.name} is of type RECORD but polars dtype is {polars_dtype}"
+@dataclass(frozen=True)
+class ParquetLoadOptions:
+    compression: ParquetCompression = "zstd"
+    compression_level: int | None = None
+    row_group_size: int = PARQUET_ROW_GROUP_SIZE
+    max_memory_bytes: int = PARQUET_SPOOL_MAX_MEMORY_BYTES
+    upload_chunk_size: int = PARQUET_UPLOAD_CHUNK_SIZE
+
+    @property
+    def resumable_chunk_size(self) -> int:
+        """
+        `upload_chunk_size` cut to the in-memory part of the load buffer and
+        rounded down to whole units of a resumable upload, at least one.
+        """
+        size = min(self.upload_chunk_size, self.max_memory_bytes)
+        units = max(1, size // RESUMABLE_UPLOAD_CHUNK_UNIT)
+        return units * RESUMABLE_UPLOAD_CHUNK_UNIT
+
+
+@dataclass(frozen=True)
+class ParquetLoadStats:
+    n_rows: int
+    n_bytes: int
+    # encoded bytes held in memory at most by the load buffer
+    peak_buffer_bytes: int
+    spilled_to_disk: bool
+    encode_seconds: float
+    # from the start of the encoding to the end of the upload,
+    # or of the load job for `insert_df`
+    elapsed_seconds: float
+
+    @property
+    def throughput_mib_per_sec(self) -> float:
+        return self.n_bytes / (1024 * 1024) / max(self.elapsed_seconds, 1e-9)
+
+
+def _job_stats(job: bq.QueryJob | bq.LoadJob) -> dict[str, AttributeValue]:
+    # query and load jobs expose different subsets of the statistics
+    stats = {name: getattr(job, name, None) for name in JOB_STAT_ATTRIBUTES}
+    return {name: value for name, value in stats.items() if value is not None}
+
+
+def _query_parameter(name: str | None, value: QueryParamValue) -> BQQueryParameter:
+    """
+    Lists become ARRAY and mappings STRUCT parameters; struct elements of
+    an array are unnamed.
+    """
+    if isinstance(value, list):
+        if len(value) == 0:
+            raise ValueError(
+                f"Cannot create array query parameter {name} from empty list"
             )
-        assert bq_field.fields is not None  # for type checker
-        polars_field_dtype: dict[str, pl.DataType] = {
-            field.name: cast(pl.DataType, field.dtype) for field in polars_dtype.fields
-        }
-        for sub_field in bq_field.fields:
-            _validate_field(
-                bq_field=sub_field,
-                polars_dtype=polars_field_dtype[sub_field.name],
+        first = value[0]
+        if isinstance(first, list):
+            raise ValueError(f"BQ does not support arrays of arrays ({name})")
+        if isinstance(first, Mapping):
+            return bq.ArrayQueryParameter(
+                name=name,
+                array_type="STRUCT",
+                values=[_query_parameter(None, element) for element in value],
             )
+        return bq.ArrayQueryParameter(
+            name=name,
+            array_type=PYTHON_TYPE_TO_BQ_TYPE[type(first)],
+            values=value,
+        )
+    if isinstance(value, Mapping):
+        fields: Mapping[str, QueryParamValue] = value
+        return bq.StructQueryParameter(
+            name,
+            *(_query_parameter(key, field) for key, field in fields.items()),
+        )
+    return bq.ScalarQueryParameter(
+        name=name,
+        type_=PYTHON_TYPE_TO_BQ_TYPE[type(value)],
+        value=value,
+    )
 
 
 def _create_query_job_config_from_python(
-    params: Mapping[str, PythonTypeForBQ],
+    params: Mapping[str, QueryParamValue],
 ) -> bq.QueryJobConfig:
-    query_params: list[BQQueryParameter] = []
-    for name, value in params.items():
-        if isinstance(value, list):
-            if len(value) == 0:
-                raise ValueError(
-                    f"Cannot create array query parameter {name} from empty list"
-                )
-            element_type = PYTHON_TYPE_TO_BQ_TYPE[type(value[0])]
-            query_param = bq.ArrayQueryParameter(
-                name=name,
-                array_type=element_type,
-                values=value,
-            )
-            query_params.append(query_param)
-        elif isinstance(value, Mapping):
-            raise NotImplementedError("Struct query parameters are not implemented yet")
-        else:
-            param_type = PYTHON_TYPE_TO_BQ_TYPE[type(value)]
-            query_param = bq.ScalarQueryParameter(
-                name=name,
-                type_=param_type,
-                value=value,
-            )
-            query_params.append(query_param)
+    query_params = [_query_parameter(name, value) for name, value in params.items()]
     job_config = bq.QueryJobConfig(query_parameters=query_params)
     return job_config
 
 
-def _generate_polars_schema(
-    fields: list[BQField],
-) -> dict[str, type[PolarsTypeForBQ] | pl.Struct]:
-    schema: dict[str, type[PolarsTypeForBQ] | pl.Struct] = {}
-    for field in fields:
-        if field.type != "RECORD":
-            polars_dtype = BQ_TYPE_TO_POLARS_DTYPE[field.type]
-            schema[field.name] = polars_dtype
-        else:
-            assert field.fields is not None  # for type checker
-            sub_schema = _generate_polars_schema(field.fields)
-            schema[field.name] = pl.Struct(sub_schema)
-    return schema
+def _parquet_load_job_config(
+    table: BQTable, write_disposition: WriteDisposition
+) -> bq.LoadJobConfig:
+    parquet_options = bq.ParquetOptions()
+    parquet_options.enable_list_inference = True
+    return bq.LoadJobConfig(
+        source_format=bq.SourceFormat.PARQUET,
+        parquet_options=parquet_options,
+        schema=table_schema(table).bq_fields,
+        write_disposition=write_disposition,
+    )
+
+
+def _split_df(df: pl.DataFrame, max_bytes: int) -> list[pl.DataFrame]:
+    """
+    Split `df` into zero-copy slices whose estimated size is under `max_bytes`.
+    """
+    # rounded up, so that a batch never exceeds `max_bytes`
+    row_width = max(1, -(-int(df.estimated_size()) // max(1, df.height)))
+    rows_per_batch = max(1, max_bytes // row_width)
+    return [
+        df.slice(offset, rows_per_batch)
+        for offset in range(0, df.height, rows_per_batch)
+    ]
 
 
 @dataclass
 class BQPolarsHandler:
     client: bq.Client
+    write_client: BigQueryWriteClient | None = None
+    read_client: BigQueryReadClient | None = None
+    # opt-in local cache of `fetch_df` results
+    query_cache: QueryResultCache | None = None
+    load_options: ParquetLoadOptions = field(default_factory=ParquetLoadOptions)
+
+    def invalidate_cache(self, table_id: str) -> None:
+        if self.query_cache is not None:
+            self.query_cache.invalidate(table_id)
+
+    def create_table(
+        self,
+        table: BQTable,
+        exists_ok: bool = True,
+        expires: datetime.datetime | None = None,
+    ) -> None:
+        """
+        Create `table` with its partitioning and clustering.
+        An existing table is left as it is, even if its options differ.
+        BQ deletes the table at `expires`, if given.
+        """
+        bq_table = generate_bq_table(table)
+        bq_table.expires = expires
+        self.client.create_table(bq_table, exists_ok=exists_ok)
+        logger.info(f"Created BQ table {table.get_bq_table_id()}")
+
+    def delete_table(self, table: BQTable) -> None:
+        table_id = f"{table.project}.{table.dataset}.{table.table}"
+        self.client.delete_table(table_id, not_found_ok=True)
+        self.invalidate_cache(table_id)
+        logger.info(f"Deleted BQ table {table.get_bq_table_id()}")
+
+    def get_labels(self, table: BQTable) -> dict[str, str]:
+        bq_table = self.client.get_table(f"{table.project}.{table.dataset}.{table.table}")
+        return dict(bq_table.labels or {})
+
+    def get_time_partitioning(self, table: BQTable) -> BQTimePartitioning | None:
+        """
+        Partitioning of the table in BQ. It can differ from the options of
+        `table`, as an existing table keeps its partitioning until it is recreated.
+        """
+        bq_table = self.client.get_table(f"{table.project}.{table.dataset}.{table.table}")
+        partitioning = bq_table.time_partitioning
+        if partitioning is None:
+            return None
+        return BQTimePartitioning(
+            field=partitioning.field,
+            type=partitioning.type_,
+            expiration_ms=partitioning.expiration_ms,
+            require_partition_filter=bool(bq_table.require_partition_filter),
+        )
+
+    def update_labels(self, table: BQTable, labels: Mapping[str, str | None]) -> None:
+        """
+        Set labels of `table`, leaving the others; None removes a label.
+        """
+        bq_table = bq.Table(f"{table.project}.{table.dataset}.{table.table}")
+        bq_table.labels = dict(labels)
+        self.client.update_table(bq_table, ["labels"])
 
     @staticmethod
     def validate_df(df: pl.DataFrame, table: BQTable) -> None:
-        for field in table.fields:
-            if field.name not in df.columns:
-                raise ValueError(f"DataFrame is missing required field: {field.name}")
-            polars_dtype = df.schema[field.name]
-            _validate_field(
-                bq_field=field,
-                polars_dtype=polars_dtype,
-            )
+        """
+        Check dtypes and REQUIRED/REPEATED modes; the checks are compiled
+        once per table.
+        """
+        table_schema(table).validator.validate(df)
+
+    @staticmethod
+    def coerce_df(df: pl.DataFrame, table: BQTable) -> pl.DataFrame:
+        """
+        Cast compatible dtypes (e.g. Int32 to INTEGER) to the table schema,
+        keeping only the table columns, and validate the result.
+        """
+        return table_schema(table).validator.coerce(df)
 
-    def insert_df(self, df: pl.DataFrame, table: BQTable) -> None:
+    def _prepare_df(self, df: pl.DataFrame, table: BQTable, coerce: bool) -> pl.DataFrame:
+        if coerce:
+            return self.coerce_df(df, table)
         self.validate_df(df, table)
-        # Write DataFrame to stream as parquet file; does not hit disk
+        return df
+
+    @traced("bq.insert_df")
+    def insert_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        mode: InsertMode = "load_job",
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+        coerce: bool = False,
+        after: Future | None = None,
+    ) -> ParquetLoadStats | None:
+        """
+        Returns the encoding and upload statistics of the load job;
+        None in the storage_write mode.
+        With `after`, e.g. a DELETE of the rows being replaced, the rows are
+        written only once it has succeeded; the parquet encoding starts at once.
+        """
+        current_span().set(table=table.get_bq_table_id(), rows=df.height, mode=mode)
+        if mode == "storage_write":
+            if write_disposition != "WRITE_APPEND":
+                raise ValueError("The storage_write mode only supports WRITE_APPEND")
+            if after is not None:
+                after.result()
+            self.write_df(df, table, coerce=coerce)
+            return None
+        started = time.perf_counter()
+        job, stats = self._submit_load_df(df, table, write_disposition, coerce, after)
+        with span("bq.load_job_wait") as s:
+            res = job.result()  # Waits for the job to complete
+            s.set(**_job_stats(job))
+        self.invalidate_cache(f"{table.project}.{table.dataset}.{table.table}")
+        logger.info(res)
+        return replace(stats, elapsed_seconds=time.perf_counter() - started)
+
+    @traced("bq.insert_parquet_uri")
+    def insert_parquet_uri(
+        self,
+        uri: str,
+        table: BQTable,
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+        after: Future | None = None,
+    ) -> None:
+        """
+        Load a parquet file in GCS, e.g. `gs://bucket/path.parquet`. BQ reads
+        it directly, so the data does not pass through the client; the file
+        must already match the table schema.
+        """
+        current_span().set(table=table.get_bq_table_id(), uri=uri)
+        if after is not None:
+            with span("bq.load_dependency_wait"):
+                after.result()
+        job = self.client.load_table_from_uri(
+            uri,
+            destination=f"{table.project}.{table.dataset}.{table.table}",
+            project=table.project,
+            job_config=_parquet_load_job_config(table, write_disposition),
+        )
+        with span("bq.load_job_wait") as s:
+            res = job.result()
+            s.set(**_job_stats(job))
+        self.invalidate_cache(f"{table.project}.{table.dataset}.{table.table}")
+        logger.info(res)
+
+    def submit_load_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+        coerce: bool = False,
+    ) -> bq.LoadJob:
+        """
+        Start a parquet load job for `df` without waiting for it.
+        """
+        job, _ = self._submit_load_df(df, table, write_disposition, coerce)
+        return job
+
+    def _submit_load_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        write_disposition: WriteDisposition,
+        coerce: bool,
+        after: Future | None = None,
+    ) -> tuple[bq.LoadJob, ParquetLoadStats]:
+        with span("bq.validate", rows=df.height, coerce=coerce):
+            df = self._prepare_df(df, table, coerce)
         logger.info(
             f"Inserting DataFrame into BQ table {table.project}.{table.dataset}.{table.table}"
         )
         logger.info(df.head())
-        with io.BytesIO() as stream:
-            df.write_parquet(stream)
-            stream.seek(0)
-            parquet_options = bq.ParquetOptions()
-            parquet_options.enable_list_inference = True
-            job = self.client.load_table_from_file(
+        return self._submit_parquet_load(df, table, write_disposition, after=after)
+
+    def _submit_parquet_load(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        write_disposition: WriteDisposition,
+        partition_id: str | None = None,
+        after: Future | None = None,
+    ) -> tuple[bq.LoadJob, ParquetLoadStats]:
+        """
+        Encode `df` to parquet on a separate thread while the load job upload
+        reads what is encoded so far. The encoded bytes are spooled, in memory
+        up to `load_options.max_memory_bytes` and in a temp file beyond.
+        The upload starts once `after` has succeeded, so its job runs after it.
+        """
+        destination = f"{table.project}.{table.dataset}.{table.table}"
+        if partition_id is not None:
+            destination += f"${partition_id}"
+        options = self.load_options
+        started = time.perf_counter()
+        with SpooledPipe(options.max_memory_bytes) as pipe:
+
+            def encode() -> float:
+                with span("bq.parquet_encode", rows=df.height) as s:
+                    try:
+                        df.write_parquet(
+                            cast(IO[bytes], pipe),
+                            compression=options.compression,
+                            compression_level=options.compression_level,
+                            row_group_size=options.row_group_size,
+                        )
+                    except BaseException as e:
+                        pipe.fail(e)
+                        raise
+                    pipe.finish()
+                    s.set(bytes=pipe.n_bytes)
+                return time.perf_counter() - started
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                encoding = executor.submit(in_current_context(encode))
+                if after is not None:
+                    with span("bq.load_dependency_wait"):
+                        try:
+                            after.result()
+                        except BaseException:
+                            pipe.close()
+                            raise
+                with span("bq.load_upload") as s:
+                    try:
+                        job = self._load_table_from_stream(
+                            cast(IO[bytes], pipe),
+                            destination=destination,
+                            project=table.project,
+                            job_config=_parquet_load_job_config(table, write_disposition),
+                        )
+                    except BaseException:
+                        # the encoder fails on its next write instead of finishing
+                        pipe.close()
+                        raise
+                    s.set(bytes=pipe.n_bytes)
+                encode_seconds = encoding.result()
+            stats = ParquetLoadStats(
+                n_rows=df.height,
+                n_bytes=pipe.n_bytes,
+                peak_buffer_bytes=pipe.peak_memory_bytes,
+                spilled_to_disk=pipe.spilled_to_disk,
+                encode_seconds=encode_seconds,
+                elapsed_seconds=time.perf_counter() - started,
+            )
+        logger.info(
+            f"Uploaded {stats.n_bytes} bytes of {options.compression} parquet "
+            f"({stats.n_rows} rows) in {stats.elapsed_seconds:.2f}s, "
+            f"{stats.throughput_mib_per_sec:.1f} MiB/s"
+            + (", spilled to disk" if stats.spilled_to_disk else "")
+        )
+        return job, stats
+
+    def _load_table_from_stream(
+        self,
+        stream: IO[bytes],
+        destination: str,
+        project: str,
+        job_config: bq.LoadJobConfig,
+    ) -> bq.LoadJob:
+        """
+        `client.load_table_from_file` with chunks of
+        `load_options.resumable_chunk_size`. The client uploads chunks of
+        100 MiB and reads each in full before sending it, which would wait
+        for that much of the encoding and hold it in memory.
+        """
+        configuration = job_config.to_api_repr()
+        configuration["load"]["destinationTable"] = bq.TableReference.from_string(
+            destination
+        ).to_api_repr()
+        job_reference = {"projectId": project, "jobId": f"dami_load_{uuid.uuid4().hex}"}
+        if self.client.location is not None:
+            job_reference["location"] = self.client.location
+        job_resource = {"jobReference": job_reference, "configuration": configuration}
+        try:
+            upload, transport = self.client._initiate_resumable_upload(
                 stream,
-                destination=f"{table.project}.{table.dataset}.{table.table}",
-                project=table.project,
-                job_config=bq.LoadJobConfig(
-                    source_format=bq.SourceFormat.PARQUET,
-                    parquet_options=parquet_options,
-                    schema=table.bq_schema,
+                # the job resource; annotated as string values by the client
+                cast(Mapping[str, str], job_resource),
+                num_retries=LOAD_UPLOAD_NUM_RETRIES,
+                timeout=None,
+                project=project,
+            )
+            # read by `transmit_next_chunk`; the client initiates every
+            # upload with its own chunk size
+            upload._chunk_size = self.load_options.resumable_chunk_size
+            response = None
+            while not upload.finished:
+                response = upload.transmit_next_chunk(transport)
+        except resumable_media.InvalidResponse as e:
+            raise google_exceptions.from_http_response(e.response) from e
+        assert response is not None
+        return cast(bq.LoadJob, self.client.job_from_resource(response.json()))
+
+    def _append_rows_requests(
+        self,
+        stream_name: str,
+        schema: pa.Schema,
+        batches: list[pl.DataFrame],
+    ) -> Iterator[bqs_types.AppendRowsRequest]:
+        offset = 0
+        for i, batch in enumerate(batches):
+            # converted one batch at a time to avoid a second full copy of df
+            record_batch = batch.to_arrow().cast(schema).combine_chunks().to_batches()[0]
+            arrow_rows = bqs_types.AppendRowsRequest.ArrowData(
+                rows=bqs_types.ArrowRecordBatch(
+                    serialized_record_batch=record_batch.serialize().to_pybytes(),
                 ),
             )
-        res = job.result()  # Waits for the job to complete
-        logger.info(res)
+            if i == 0:
+                # the writer schema is required only in the first request
+                arrow_rows.writer_schema = bqs_types.ArrowSchema(
+                    serialized_schema=schema.serialize().to_pybytes(),
+                )
+            yield bqs_types.AppendRowsRequest(
+                write_stream=stream_name,
+                offset=offset,
+                arrow_rows=arrow_rows,
+            )
+            offset += batch.height
+
+    def _write_stream(
+        self,
+        parent: str,
+        stream_type: WriteStreamType,
+        schema: pa.Schema,
+        batches: list[pl.DataFrame],
+    ) -> str:
+        assert self.write_client is not None  # for type checker
+        stream = self.write_client.create_write_stream(
+            parent=parent,
+            write_stream=bqs_types.WriteStream(
+                type_=bqs_types.WriteStream.Type[stream_type]
+            ),
+        )
+        responses = self.write_client.append_rows(
+            self._append_rows_requests(stream.name, schema, batches),
+            metadata=(("x-goog-request-params", f"write_stream={stream.name}"),),
+        )
+        for response in responses:
+            if response.error.code != 0 or len(response.row_errors) > 0:
+                raise RuntimeError(
+                    f"Failed to append rows to {stream.name}: "
+                    f"{response.error.message} {list(response.row_errors)}"
+                )
+        self.write_client.finalize_write_stream(name=stream.name)
+        return stream.name
 
+    @traced("bq.replace_partitions")
+    def replace_partitions(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        partition_ids: list[str] | None = None,
+        coerce: bool = False,
+    ) -> list[str]:
+        """
+        Replace the partitions of `table` holding the rows of `df`, each with a
+        WRITE_TRUNCATE load into its partition decorator, e.g. `table$20260101`.
+        Unlike a DELETE, the cost depends on the rows loaded and not on the table size.
+        Partitions in `partition_ids` without rows in `df` are emptied.
+        The partitions are replaced one by one, not atomically.
+        Returns the replaced partitions.
+        """
+        partitioning = table.time_partitioning
+        if partitioning is None or partitioning.field is None:
+            raise ValueError(f"{table.get_bq_table_id()} is not partitioned by a column")
+        df = self._prepare_df(df, table, coerce)
+        column = pl.col(partitioning.field)
+        dtype = df.schema[partitioning.field]
+        if isinstance(dtype, pl.Datetime) and dtype.time_zone is not None:
+            # BQ partitions TIMESTAMP columns by their UTC time
+            column = column.dt.convert_time_zone("UTC")
+        parts: dict[str, pl.DataFrame] = {
+            cast(str, partition_id): part
+            for (partition_id,), part in df.with_columns(
+                partitioning.partition_id_expr(column).alias(_PARTITION_ID_COLUMN)
+            )
+            .partition_by(_PARTITION_ID_COLUMN, as_dict=True, include_key=False)
+            .items()
+        }
+        for partition_id in partition_ids or []:
+            parts.setdefault(partition_id, df.clear())
+        if len(parts) == 0:
+            return []
+        current_span().set(
+            table=table.get_bq_table_id(), rows=df.height, partitions=len(parts)
+        )
+        logger.info(
+            f"Replacing {len(parts)} partition(s) of {table.get_bq_table_id()} "
+            f"with {df.height} rows"
+        )
+        with ThreadPoolExecutor(
+            max_workers=min(REPLACE_PARTITIONS_MAX_WORKERS, len(parts))
+        ) as executor:
+            jobs = list(
+                executor.map(
+                    lambda item: self._submit_parquet_load(
+                        item[1], table, "WRITE_TRUNCATE", partition_id=item[0]
+                    )[0],
+                    parts.items(),
+                )
+            )
+        with span("bq.load_job_wait", jobs=len(jobs)):
+            for job in jobs:
+                job.result()
+        self.invalidate_cache(f"{table.project}.{table.dataset}.{table.table}")
+        return sorted(parts)
+
+    @traced("bq.write_df")
+    def write_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        stream_type: WriteStreamType = "PENDING",
+        max_request_bytes: int = STORAGE_WRITE_MAX_REQUEST_BYTES,
+        max_streams: int = STORAGE_WRITE_MAX_STREAMS,
+        coerce: bool = False,
+    ) -> None:
+        """
+        Insert `df` through the Storage Write API.
+        `df` is split into Arrow record batches written by up to `max_streams`
+        streams in parallel. With PENDING streams the rows become visible
+        atomically when all streams are committed.
+        """
+        if self.write_client is None:
+            raise ValueError("write_client is required for the storage_write mode")
+        df = self._prepare_df(df, table, coerce)
+        if df.height == 0:
+            return
+        logger.info(
+            f"Writing DataFrame into BQ table {table.project}.{table.dataset}.{table.table}"
+        )
+        schema = table_schema(table).arrow_schema
+        df = df.select([field.name for field in table.fields])
+        batches = _split_df(df, max_request_bytes)
+        n_streams = min(max_streams, len(batches))
+        per_stream = -(-len(batches) // n_streams)
+        parent = BigQueryWriteClient.table_path(table.project, table.dataset, table.table)
+        with ThreadPoolExecutor(max_workers=n_streams) as executor:
+            stream_names = list(
+                executor.map(
+                    lambda i: self._write_stream(
+                        parent,
+                        stream_type,
+                        schema,
+                        batches[i : i + per_stream],
+                    ),
+                    range(0, len(batches), per_stream),
+                )
+            )
+        if stream_type == "PENDING":
+            res = self.write_client.batch_commit_write_streams(
+                bqs_types.BatchCommitWriteStreamsRequest(
+                    parent=parent,
+                    write_streams=stream_names,
+                )
+            )
+            if len(res.stream_errors) > 0:
+                raise RuntimeError(f"Failed to commit write streams: {res.stream_errors}")
+        self.invalidate_cache(f"{table.project}.{table.dataset}.{table.table}")
+        current_span().set(
+            table=table.get_bq_table_id(), rows=df.height, streams=len(stream_names)
+        )
+        logger.info(f"Wrote {df.height} rows with {len(stream_names)} stream(s)")
+
+    @traced("bq.fetch_df")
     def fetch_df(
         self,
         query: BQQuery,
         table: BQTable,
         fields_to_fetch: list[str],
-        params: Mapping[str, PythonTypeForBQ],
+        params: Mapping[str, QueryParamValue],
     ) -> pl.DataFrame:
         job_config = _create_query_job_config_from_python(params)
-        field_mapping = {
-            field.name: field for field in table.fields if field.name in fields_to_fetch
-        }
-        schema = _generate_polars_schema(
-            [field_mapping[field] for field in fields_to_fetch]
-        )
+        cache_key, cached = self.lookup_cache(query, job_config, table, fields_to_fetch)
+        if cached is not None:
+            current_span().set(rows=cached.height, cache_hit=True)
+            return cached
         job = self.client.query(query, job_config=job_config)
-        res = job.to_arrow()
+        df = self.job_to_df(job, table, fields_to_fetch, cache_key)
+        current_span().set(rows=df.height)
+        return df
+
+    @traced("bq.fetch_by_keys")
+    def fetch_by_keys(
+        self,
+        table: BQTable,
+        keys: pl.DataFrame | pl.Series,
+        fields_to_fetch: list[str],
+        max_param_bytes: int = FETCH_BY_KEYS_MAX_PARAM_BYTES,
+        max_workers: int = FETCH_BY_KEYS_MAX_WORKERS,
+    ) -> pl.DataFrame:
+        """
+        Fetch the rows of `table` matching a row of `keys`, whose columns are
+        the key columns. The distinct keys are sent as `UNNEST(@keys)` array
+        parameters (ARRAY<STRUCT> for composite keys), in batches of about
+        `max_param_bytes` fetched concurrently with `fetch_df`.
+        """
+        if isinstance(keys, pl.Series):
+            keys = keys.to_frame()
+        if keys.width == 0:
+            raise ValueError("No key columns given")
+        missing = set(keys.columns) - {field.name for field in table.fields}
+        if missing:
+            raise ValueError(f"Key columns {sorted(missing)} are not in {table.get_bq_table_id()}")
+        keys = keys.unique(maintain_order=True).drop_nulls()
+        current_span().set(table=table.get_bq_table_id(), keys=keys.height)
+        if keys.height == 0:
+            return pl.DataFrame(schema=self._generate_fetch_schema(table, fields_to_fetch))
+        values: list[QueryParamValue]
+        if keys.width == 1:
+            predicate = f"{keys.columns[0]} IN UNNEST(@keys)"
+            values = [*keys.to_series().to_list()]
+        else:
+            # STRUCTs compare field by field
+            predicate = f"STRUCT({', '.join(keys.columns)}) IN UNNEST(@keys)"
+            values = [*keys.rows(named=True)]
+        sample = _query_parameter("keys", values[:_KEY_SIZE_SAMPLE]).to_api_repr()
+        bytes_per_key = len(json.dumps(sample["parameterValue"])) / min(
+            len(values), _KEY_SIZE_SAMPLE
+        )
+        batch_size = max(1, int(max_param_bytes / bytes_per_key))
+        batches = [values[i : i + batch_size] for i in range(0, len(values), batch_size)]
+        query = (
+            f"SELECT {', '.join(fields_to_fetch)} FROM {table.get_bq_table_id()} "
+            f"WHERE {predicate}"
+        )
+        logger.info(f"Fetching {len(values)} keys in {len(batches)} queries")
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+            futures = [
+                executor.submit(
+                    in_current_context(
+                        self.fetch_df, query, table, fields_to_fetch, {"keys": batch}
+                    )
+                )
+                for batch in batches
+            ]
+            frames = [future.result() for future in futures]
+        df = pl.concat(frames)
+        current_span().set(rows=df.height, queries=len(batches))
+        return df
+
+    def lookup_cache(
+        self,
+        query: BQQuery,
+        job_config: bq.QueryJobConfig,
+        table: BQTable,
+        fields_to_fetch: list[str],
+    ) -> tuple[str | None, pl.DataFrame | None]:
+        """
+        Returns the cache key (None when the cache is disabled) and the cached result.
+        """
+        if self.query_cache is None:
+            return None, None
+        table_id = f"{table.project}.{table.dataset}.{table.table}"
+        cache_key = self.query_cache.make_key(
+            query=query,
+            params=[p.to_api_repr() for p in job_config.query_parameters],
+            fields_to_fetch=fields_to_fetch,
+            table_modified=self.client.get_table(table_id).modified,
+        )
+        cached = self.query_cache.get(table_id, cache_key)
+        if cached is not None:
+            logger.info(f"Fetched {cached.height} rows from the query cache")
+        return cache_key, cached
+
+    def job_to_df(
+        self,
+        job: bq.QueryJob,
+        table: BQTable,
+        fields_to_fetch: list[str],
+        cache_key: str | None = None,
+    ) -> pl.DataFrame:
+        """
+        Download the result of `job`, waiting for it if needed, and
+        store it in the query cache under `cache_key`.
+        """
+        schema = self._generate_fetch_schema(table, fields_to_fetch)
+        with span("bq.fetch_result") as s:
+            res = job.to_arrow(bqstorage_client=self.read_client)
+            s.set(bytes=res.nbytes, **_job_stats(job))
         df = cast(pl.DataFrame, pl.from_arrow(res, schema=schema))
         assert isinstance(df, pl.DataFrame)
         logger.info(f"Fetched {df.height} rows from BQ")
+        if self.query_cache is not None and cache_key is not None:
+            table_id = f"{table.project}.{table.dataset}.{table.table}"
+            self.query_cache.put(table_id, cache_key, df)
         return df
 
-    def run_update_query(
+    @staticmethod
+    def _generate_fetch_schema(
+        table: BQTable, fields_to_fetch: list[str]
+    ) -> PolarsSchema:
+        return table_schema(table).fetch_schema(fields_to_fetch)
+
+    def fetch_batches(
         self,
         query: BQQuery,
-        params: dict[str, PythonTypeForBQ],
-    ) -> None:
+        table: BQTable,
+        fields_to_fetch: list[str],
+        params: Mapping[str, QueryParamValue],
+        max_stream_count: int = STORAGE_READ_MAX_STREAMS,
+        max_queue_size: int = STORAGE_READ_MAX_QUEUE_SIZE,
+    ) -> Iterator[pl.DataFrame]:
+        """
+        Yield the query result batch by batch as soon as each one arrives.
+        With `read_client`, batches are read from up to `max_stream_count`
+        Storage Read streams in parallel, so rows are not ordered unless
+        the query has an ORDER BY. At most `max_queue_size` batches are buffered.
+        """
         job_config = _create_query_job_config_from_python(params)
+        schema = self._generate_fetch_schema(table, fields_to_fetch)
         job = self.client.query(query, job_config=job_config)
+        n_rows = 0
+        for record_batch in job.result().to_arrow_iterable(
+            bqstorage_client=self.read_client,
+            max_queue_size=max_queue_size,
+            max_stream_count=max_stream_count,
+        ):
+            df = cast(pl.DataFrame, pl.from_arrow(record_batch, schema=schema))
+            n_rows += df.height
+            yield df
+        logger.info(f"Fetched {n_rows} rows from BQ")
+
+    def fetch_lazy(
+        self,
+        query: BQQuery,
+        table: BQTable,
+        fields_to_fetch: list[str],
+        params: Mapping[str, QueryParamValue],
+        max_stream_count: int = STORAGE_READ_MAX_STREAMS,
+    ) -> pl.LazyFrame:
+        """
+        LazyFrame over `fetch_batches`; the query runs each time it is collected.
+        """
+        schema = self._generate_fetch_schema(table, fields_to_fetch)
+
+        def io_source(
+            with_columns: list[str] | None,
+            predicate: pl.Expr | None,
+            n_rows: int | None,
+            batch_size: int | None,
+        ) -> Iterator[pl.DataFrame]:
+            remaining = n_rows
+            for df in self.fetch_batches(
+                query, table, fields_to_fetch, params, max_stream_count
+            ):
+                if with_columns is not None:
+                    df = df.select(with_columns)
+                if predicate is not None:
+                    df = df.filter(predicate)
+                if remaining is not None:
+                    df = df.head(remaining)
+                    remaining -= df.height
+                yield df
+                if remaining == 0:
+                    break
+
+        return register_io_source(io_source, schema=schema)
+
+    @traced("bq.run_update_query")
+    def run_update_query(
+        self,
+        query: BQQuery,
+        params: Mapping[str, QueryParamValue],
+    ) -> bq.QueryJob:
+        """
+        Returns the finished job, e.g. for its `dml_stats`.
+        """
+        job = self.submit_update_query(query, params)
         job.result()  # Waits for the job to complete
+        current_span().set(**_job_stats(job))
+        for table_id in dml_target_tables(query):
+            self.invalidate_cache(table_id)
         logger.info("completed update query")
+        return job
+
+    def submit_update_query(
+        self,
+        query: BQQuery,
+        params: Mapping[str, QueryParamValue],
+    ) -> bq.QueryJob:
+        job_config = _create_query_job_config_from_python(params)
+        return self.client.query(query, job_config=job_config)
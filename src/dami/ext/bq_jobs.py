@@ -0,0 +1,199 @@
+import re
+import threading
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Final, ParamSpec, Self, TypeVar
+
+import polars as pl
+from loguru import logger
+
+from dami.ext.bq import BQPolarsHandler, ParquetLoadStats, WriteDisposition
+from dami.tracing import in_current_context
+from dami.types.bq import BQQuery, BQTable, QueryParamValue
+
+# jobs waited on at the same time, besides the client-side work
+JOB_SCHEDULER_MAX_WORKERS: Final[int] = 4
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+@dataclass(frozen=True)
+class _QueuedStatement:
+    query: BQQuery
+    params: dict[str, QueryParamValue]
+    future: Future[None]
+
+
+def merge_statements(
+    statements: list[tuple[BQQuery, dict[str, QueryParamValue]]],
+) -> tuple[BQQuery, dict[str, QueryParamValue]]:
+    """
+    Join DML statements into one multi-statement script. The parameters of
+    the i-th statement are renamed `@s<i>_<name>` so that they cannot clash.
+    """
+    if len(statements) == 1:
+        return statements[0]
+    queries: list[str] = []
+    params: dict[str, QueryParamValue] = {}
+    for i, (query, statement_params) in enumerate(statements):
+        for name, value in statement_params.items():
+            query = re.sub(rf"@{name}\b", f"@s{i}_{name}", query)
+            params[f"s{i}_{name}"] = value
+        queries.append(query.strip().rstrip(";"))
+    return ";\n".join(queries), params
+
+
+@dataclass
+class BQJobScheduler:
+    """
+    Runs BQ jobs and the client-side work around them concurrently,
+    returning futures that take completion callbacks.
+
+    DML statements are queued and sent as one multi-statement script job,
+    so that statements run back to back pay one job startup latency.
+    The queue is sent when a load is submitted, on `flush` and when
+    the scheduler exits. The statements of a script run in order and
+    a failing statement fails the futures of the whole script.
+
+        with BQJobScheduler(handler) as jobs:
+            deleted = jobs.submit_update_query("DELETE ...", params)
+            # encoded while the DELETE runs, uploaded once it has succeeded
+            jobs.submit_load_df(df, table, after=deleted)
+    """
+
+    handler: BQPolarsHandler
+    max_workers: int = JOB_SCHEDULER_MAX_WORKERS
+    _executor: ThreadPoolExecutor = field(init=False, repr=False)
+    _queue: list[_QueuedStatement] = field(default_factory=list, init=False, repr=False)
+    _futures: list[Future] = field(default_factory=list, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def submit(
+        self, fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs
+    ) -> Future[R]:
+        """
+        Run `fn` on the scheduler's pool, within the caller's tracing span.
+        """
+        future = self._executor.submit(in_current_context(fn, *args, **kwargs))
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def submit_update_query(
+        self, query: BQQuery, params: dict[str, QueryParamValue]
+    ) -> Future[None]:
+        """
+        Queue a DML statement; the future completes with its script job.
+        """
+        future: Future[None] = Future()
+        with self._lock:
+            self._queue.append(_QueuedStatement(query, params, future))
+            self._futures.append(future)
+        return future
+
+    def submit_load_df(
+        self,
+        df: pl.DataFrame,
+        table: BQTable,
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+        coerce: bool = False,
+        after: Future | None = None,
+    ) -> Future[ParquetLoadStats | None]:
+        """
+        Load `df` with `BQPolarsHandler.insert_df`. With `after`, the parquet
+        encoding overlaps it and the upload waits for it to succeed.
+        """
+        self.flush()
+        return self.submit(
+            self.handler.insert_df,
+            df,
+            table,
+            write_disposition=write_disposition,
+            coerce=coerce,
+            after=after,
+        )
+
+    def submit_load_uri(
+        self,
+        uri: str,
+        table: BQTable,
+        write_disposition: WriteDisposition = "WRITE_APPEND",
+        after: Future | None = None,
+    ) -> Future[None]:
+        """
+        Load a parquet file in GCS with `BQPolarsHandler.insert_parquet_uri`,
+        once `after` has succeeded.
+        """
+        self.flush()
+        return self.submit(
+            self.handler.insert_parquet_uri,
+            uri,
+            table,
+            write_disposition=write_disposition,
+            after=after,
+        )
+
+    def flush(self) -> None:
+        """
+        Send the queued statements as one job.
+        """
+        with self._lock:
+            queued, self._queue = self._queue, []
+        if len(queued) == 0:
+            return
+        for statement in queued:
+            statement.future.set_running_or_notify_cancel()
+        query, params = merge_statements([(s.query, s.params) for s in queued])
+        logger.info(f"Running {len(queued)} DML statement(s) in one job")
+
+        def run() -> None:
+            try:
+                self.handler.run_update_query(query, params)
+            except BaseException as e:
+                for statement in queued:
+                    statement.future.set_exception(e)
+                raise
+            for statement in queued:
+                statement.future.set_result(None)
+
+        self.submit(run)
+
+    def wait(self) -> None:
+        """
+        Flush and wait for every submitted job; raises the first error.
+        """
+        self.flush()
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        for future in futures:
+            if (error := future.exception()) is not None:
+                raise error
+
+    def close(self) -> None:
+        """
+        Drop the queued statements and the work not started yet,
+        and wait for the running jobs.
+        """
+        with self._lock:
+            queued, self._queue = self._queue, []
+        for statement in queued:
+            statement.future.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *exc_info: object) -> None:
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
@@ -0,0 +1,243 @@
+import functools
+import hashlib
+import json
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Self
+
+import polars as pl
+import pyarrow as pa
+from google.cloud import bigquery as bq
+from loguru import logger
+
+from dami.ext.bq_validation import CompiledTableSchema, compile_table_schema
+from dami.settings import BQ_SCHEMA_DIR, BQ_TABLE_OPTIONS_DIR
+from dami.types.bq import (
+    BQDataType,
+    BQField,
+    BQTable,
+    BQTableOptions,
+    PolarsTypeForBQ,
+)
+
+BQ_TYPE_TO_POLARS_DTYPE: dict[BQDataType, type[PolarsTypeForBQ]] = {
+    "STRING": pl.String,
+    "INTEGER": pl.Int64,
+    "FLOAT": pl.Float64,
+    "BOOLEAN": pl.Boolean,
+    "TIMESTAMP": pl.Datetime,
+    "DATE": pl.Date,
+}
+
+BQ_TYPE_TO_ARROW_TYPE: dict[BQDataType, pa.DataType] = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "FLOAT": pa.float64(),
+    "BOOLEAN": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    "DATE": pa.date32(),
+}
+
+PolarsSchema = dict[str, type[PolarsTypeForBQ] | pl.Struct]
+
+
+def _generate_polars_schema(fields: list[BQField]) -> PolarsSchema:
+    schema: PolarsSchema = {}
+    for bq_field in fields:
+        if bq_field.type != "RECORD":
+            polars_dtype = BQ_TYPE_TO_POLARS_DTYPE[bq_field.type]
+            schema[bq_field.name] = polars_dtype
+        else:
+            assert bq_field.fields is not None  # for type checker
+            sub_schema = _generate_polars_schema(bq_field.fields)
+            schema[bq_field.name] = pl.Struct(sub_schema)
+    return schema
+
+
+def _generate_arrow_field(field: BQField) -> pa.Field:
+    if field.type != "RECORD":
+        arrow_dtype = BQ_TYPE_TO_ARROW_TYPE[field.type]
+    else:
+        assert field.fields is not None  # for type checker
+        arrow_dtype = pa.struct([_generate_arrow_field(f) for f in field.fields])
+    if field.mode == "REPEATED":
+        arrow_dtype = pa.list_(arrow_dtype)
+    return pa.field(field.name, arrow_dtype, nullable=field.mode != "REQUIRED")
+
+
+def _generate_arrow_schema(fields: list[BQField]) -> pa.Schema:
+    return pa.schema([_generate_arrow_field(bq_field) for bq_field in fields])
+
+
+def _generate_schema_field(field: BQField) -> bq.SchemaField:
+    return bq.SchemaField(
+        name=field.name,
+        field_type=field.type,
+        mode=field.mode,
+        description=field.description or "",
+        fields=[_generate_schema_field(f) for f in field.fields or []],
+    )
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    """
+    Schemas derived from the fields of one table, built once and reused
+    by every load, write and fetch.
+    """
+
+    table_id: str
+    bq_fields: list[bq.SchemaField]
+    polars_schema: PolarsSchema
+    arrow_schema: pa.Schema
+    field_by_name: dict[str, BQField]
+    validator: CompiledTableSchema
+    # digest of the fields; changes whenever the schema does
+    fingerprint: str
+
+    @classmethod
+    def from_table(cls, table: BQTable) -> Self:
+        fields_json = json.dumps(table.bq_schema, sort_keys=True)
+        return cls(
+            table_id=f"{table.project}.{table.dataset}.{table.table}",
+            bq_fields=[_generate_schema_field(f) for f in table.fields],
+            polars_schema=_generate_polars_schema(table.fields),
+            arrow_schema=_generate_arrow_schema(table.fields),
+            field_by_name={f.name: f for f in table.fields},
+            validator=compile_table_schema(table),
+            fingerprint=hashlib.md5(fields_json.encode("utf-8")).hexdigest(),
+        )
+
+    def fetch_schema(self, fields_to_fetch: list[str]) -> PolarsSchema:
+        return {name: self.polars_schema[name] for name in fields_to_fetch}
+
+
+def generate_bq_table(table: BQTable) -> bq.Table:
+    """
+    `bigquery.Table` to create `table` with, including its partitioning and clustering.
+    """
+    bq_table = bq.Table(
+        f"{table.project}.{table.dataset}.{table.table}",
+        schema=table_schema(table).bq_fields,
+    )
+    partitioning = table.time_partitioning
+    if partitioning is not None:
+        bq_table.time_partitioning = bq.TimePartitioning(
+            type_=partitioning.type,
+            field=partitioning.field,
+            expiration_ms=partitioning.expiration_ms,
+        )
+        bq_table.require_partition_filter = partitioning.require_partition_filter
+    bq_table.clustering_fields = table.clustering_fields
+    return bq_table
+
+
+def table_schema(table: BQTable) -> TableSchema:
+    """
+    Derived schemas of `table`, memoized on the table object;
+    `BQTable.model_copy` drops the memo.
+    """
+    schema: TableSchema | None = table._schema
+    if schema is None:
+        schema = TableSchema.from_table(table)
+        table._schema = schema
+    return schema
+
+
+@dataclass
+class _RegistryEntry:
+    # of the schema file and of the options file (0 if there is none)
+    mtime_ns: tuple[int, int]
+    fields: list[BQField]
+    options: BQTableOptions
+    tables: dict[tuple[str, str, str], BQTable] = field(default_factory=dict)
+
+
+@dataclass
+class SchemaRegistry:
+    """
+    Table schemas in `schema_dir/<name>.json`, each parsed on first use
+    together with the optional table options in `options_dir/<name>.json`.
+    With `check_mtime`, a file is parsed again after it changes on disk.
+    """
+
+    schema_dir: Path = BQ_SCHEMA_DIR
+    options_dir: Path = BQ_TABLE_OPTIONS_DIR
+    check_mtime: bool = True
+    _entries: dict[str, _RegistryEntry] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def names(self) -> list[str]:
+        return sorted(path.stem for path in self.schema_dir.glob("*.json"))
+
+    def _entry(self, name: str) -> _RegistryEntry:
+        entry = self._entries.get(name)
+        if entry is not None and not self.check_mtime:
+            return entry
+        path = self.schema_dir / f"{name}.json"
+        options_path = self.options_dir / f"{name}.json"
+        mtime_ns = (
+            path.stat().st_mtime_ns,
+            options_path.stat().st_mtime_ns if options_path.exists() else 0,
+        )
+        if entry is not None and entry.mtime_ns == mtime_ns:
+            return entry
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.mtime_ns != mtime_ns:
+                columns = json.loads(path.read_text())
+                entry = _RegistryEntry(
+                    mtime_ns=mtime_ns,
+                    fields=[BQField.model_validate(col) for col in columns],
+                    options=(
+                        BQTableOptions.model_validate_json(options_path.read_text())
+                        if mtime_ns[1] != 0
+                        else BQTableOptions()
+                    ),
+                )
+                self._entries[name] = entry
+                logger.info(f"Loaded BQ schema {name} from {path}")
+        return entry
+
+    def fields(self, name: str) -> list[BQField]:
+        return list(self._entry(name).fields)
+
+    def options(self, name: str) -> BQTableOptions:
+        return self._entry(name).options.model_copy(deep=True)
+
+    def table(
+        self, name: str, project: str, dataset: str, table: str | None = None
+    ) -> BQTable:
+        """
+        `BQTable` with the fields and options of `name`;
+        defaults to a table of the same name.
+        The same object is returned until the schema file changes.
+        """
+        entry = self._entry(name)
+        key = (project, dataset, table or name)
+        bq_table = entry.tables.get(key)
+        if bq_table is None:
+            options = entry.options.model_copy(deep=True)
+            bq_table = BQTable(
+                project=project,
+                dataset=dataset,
+                table=table or name,
+                fields=list(entry.fields),
+                time_partitioning=options.time_partitioning,
+                clustering_fields=options.clustering_fields,
+            )
+            entry.tables[key] = bq_table
+        return bq_table
+
+
+@functools.cache
+def get_schema_registry() -> SchemaRegistry:
+    """
+    Process-wide registry of the schemas in `bigquery/schema/`.
+    """
+    return SchemaRegistry()
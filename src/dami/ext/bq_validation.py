@@ -0,0 +1,267 @@
+import functools
+from dataclasses import dataclass
+from typing import Final
+
+import polars as pl
+from polars.datatypes import DataTypeClass
+
+from dami.types.bq import BQDataType, BQField, BQTable
+
+COMPILED_SCHEMA_CACHE_SIZE: Final[int] = 64
+
+# dtype class each BQ type is validated against
+BQ_TYPE_TO_DTYPE_CLASS: Final[dict[BQDataType, type[pl.DataType]]] = {
+    "STRING": pl.String,
+    "INTEGER": pl.Int64,
+    "FLOAT": pl.Float64,
+    "BOOLEAN": pl.Boolean,
+    "TIMESTAMP": pl.Datetime,
+    "DATE": pl.Date,
+}
+
+# dtype a compatible column is cast to when coercing
+BQ_TYPE_TO_COERCE_DTYPE: Final[dict[BQDataType, pl.DataType]] = {
+    "STRING": pl.String(),
+    "INTEGER": pl.Int64(),
+    "FLOAT": pl.Float64(),
+    "BOOLEAN": pl.Boolean(),
+    "TIMESTAMP": pl.Datetime("us", "UTC"),
+    "DATE": pl.Date(),
+}
+
+_INTEGER_DTYPES: Final[tuple[type[pl.DataType], ...]] = (
+    pl.Int8,
+    pl.Int16,
+    pl.Int32,
+    pl.UInt8,
+    pl.UInt16,
+    pl.UInt32,
+    # strict casts fail on values over the Int64 range
+    pl.UInt64,
+)
+
+# dtypes that are cast to the BQ type when coercing
+COERCIBLE_DTYPES: Final[dict[BQDataType, tuple[type[pl.DataType], ...]]] = {
+    "STRING": (pl.Categorical, pl.Enum),
+    "INTEGER": _INTEGER_DTYPES,
+    "FLOAT": (pl.Float32, pl.Int64, *_INTEGER_DTYPES),
+    "BOOLEAN": (),
+    "TIMESTAMP": (pl.Date,),
+    "DATE": (),
+}
+
+
+class SchemaViolationError(ValueError):
+    """
+    Raised when values break the REQUIRED/REPEATED modes of a table.
+    `violations` maps each broken constraint to the number of offending values.
+    """
+
+    def __init__(self, table_id: str, violations: dict[str, int]) -> None:
+        self.violations = violations
+        details = ", ".join(f"{name} ({n})" for name, n in violations.items())
+        super().__init__(f"DataFrame violates the schema of {table_id}: {details}")
+
+
+def _target_dtype(field: BQField, with_mode: bool = True) -> pl.DataType:
+    if field.type == "RECORD":
+        assert field.fields is not None  # for type checker
+        dtype: pl.DataType = pl.Struct(
+            {sub_field.name: _target_dtype(sub_field) for sub_field in field.fields}
+        )
+    else:
+        dtype = BQ_TYPE_TO_COERCE_DTYPE[field.type]
+    if with_mode and field.mode == "REPEATED":
+        return pl.List(dtype)
+    return dtype
+
+
+def _constraint_exprs(field: BQField, expr: pl.Expr, path: str) -> list[pl.Expr]:
+    """
+    Aggregations counting the values of `expr` that break the mode of `field`
+    or of its sub-fields.
+    """
+    exprs: list[pl.Expr] = []
+    if field.mode == "REQUIRED":
+        exprs.append(expr.is_null().sum().alias(f"{path}: null in REQUIRED field"))
+    elif field.mode == "REPEATED":
+        # a NULL array is loaded as an empty one, but NULL elements are rejected
+        n_null_elements = expr.list.len() - expr.list.drop_nulls().list.len()
+        exprs.append(
+            n_null_elements.sum().alias(f"{path}: null element in REPEATED field")
+        )
+    if field.type == "RECORD":
+        assert field.fields is not None  # for type checker
+        if field.mode == "REPEATED":
+            expr = expr.filter(expr.list.len() > 0).explode()
+        # sub-fields of a NULL record are not checked
+        expr = expr.drop_nulls()
+        for sub_field in field.fields:
+            exprs.extend(
+                _constraint_exprs(
+                    sub_field,
+                    expr.struct.field(sub_field.name),
+                    f"{path}.{sub_field.name}",
+                )
+            )
+    return exprs
+
+
+def _check_dtype(field: BQField, dtype: pl.DataType | DataTypeClass, path: str) -> None:
+    if field.mode == "REPEATED":
+        if not isinstance(dtype, pl.List):
+            raise TypeError(f"Field {path} is REPEATED but polars dtype is {dtype}")
+        dtype = dtype.inner
+    if field.type == "RECORD":
+        if not isinstance(dtype, pl.Struct):
+            raise TypeError(
+                f"Field {path} is of type RECORD but polars dtype is {dtype}"
+            )
+        assert field.fields is not None  # for type checker
+        sub_dtypes = {f.name: f.dtype for f in dtype.fields}
+        for sub_field in field.fields:
+            if sub_field.name not in sub_dtypes:
+                raise TypeError(f"Field {path} is missing sub-field: {sub_field.name}")
+            _check_dtype(
+                sub_field, sub_dtypes[sub_field.name], f"{path}.{sub_field.name}"
+            )
+        return
+    expected_dtype = BQ_TYPE_TO_DTYPE_CLASS[field.type]
+    if not isinstance(dtype, expected_dtype):
+        raise TypeError(
+            f"Field {path} has incorrect dtype: "
+            f"expected {expected_dtype}, got {dtype.__class__}"
+        )
+
+
+def _coerce_expr(
+    field: BQField,
+    expr: pl.Expr,
+    dtype: pl.DataType | DataTypeClass,
+    path: str,
+    with_mode: bool = True,
+) -> pl.Expr | None:
+    """
+    Expression casting `expr` to the dtype of `field`; None if it already matches.
+    """
+    if isinstance(dtype, pl.Null):
+        return expr.cast(_target_dtype(field, with_mode))
+    if with_mode and field.mode == "REPEATED":
+        if not isinstance(dtype, pl.List):
+            raise TypeError(f"Field {path} is REPEATED but polars dtype is {dtype}")
+        inner = _coerce_expr(field, pl.element(), dtype.inner, path, with_mode=False)
+        return expr.list.eval(inner) if inner is not None else None
+    if field.type == "RECORD":
+        if not isinstance(dtype, pl.Struct):
+            raise TypeError(
+                f"Field {path} is of type RECORD but polars dtype is {dtype}"
+            )
+        assert field.fields is not None  # for type checker
+        sub_dtypes = {f.name: f.dtype for f in dtype.fields}
+        sub_exprs: list[pl.Expr] = []
+        changed = list(sub_dtypes) != [f.name for f in field.fields]
+        for sub_field in field.fields:
+            if sub_field.name not in sub_dtypes:
+                raise TypeError(f"Field {path} is missing sub-field: {sub_field.name}")
+            sub_expr = expr.struct.field(sub_field.name)
+            coerced = _coerce_expr(
+                sub_field,
+                sub_expr,
+                sub_dtypes[sub_field.name],
+                f"{path}.{sub_field.name}",
+            )
+            changed |= coerced is not None
+            sub_exprs.append(
+                (coerced if coerced is not None else sub_expr).alias(sub_field.name)
+            )
+        if not changed:
+            return None
+        # rebuilding the struct must keep NULL records NULL
+        return pl.when(expr.is_not_null()).then(pl.struct(sub_exprs))
+    if isinstance(dtype, BQ_TYPE_TO_DTYPE_CLASS[field.type]):
+        return None
+    if isinstance(dtype, COERCIBLE_DTYPES[field.type]):
+        return expr.cast(BQ_TYPE_TO_COERCE_DTYPE[field.type])
+    raise TypeError(
+        f"Field {path} has incompatible dtype: cannot cast {dtype} to {field.type}"
+    )
+
+
+@dataclass(frozen=True)
+class CompiledTableSchema:
+    """
+    Checks for one `BQTable`, built once and reused for every DataFrame.
+    All REQUIRED/REPEATED constraints are evaluated in a single query.
+    """
+
+    table_id: str
+    fields: tuple[BQField, ...]
+    constraint_exprs: tuple[pl.Expr, ...]
+
+    @property
+    def columns(self) -> list[str]:
+        return [field.name for field in self.fields]
+
+    def check_dtypes(self, schema: pl.Schema) -> None:
+        for field in self.fields:
+            if field.name not in schema:
+                raise ValueError(f"DataFrame is missing required field: {field.name}")
+            _check_dtype(field, schema[field.name], field.name)
+
+    def _raise_violations(self, counts: pl.DataFrame) -> None:
+        violations = {name: n for name, n in counts.row(0, named=True).items() if n > 0}
+        if violations:
+            raise SchemaViolationError(self.table_id, violations)
+
+    def validate(self, df: pl.DataFrame) -> None:
+        self.check_dtypes(df.schema)
+        if self.constraint_exprs:
+            self._raise_violations(df.select(self.constraint_exprs))
+
+    def coerce(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Cast compatible columns to the table dtypes and drop the other columns,
+        then validate the result in the same query.
+        """
+        for field in self.fields:
+            if field.name not in df.columns:
+                raise ValueError(f"DataFrame is missing required field: {field.name}")
+        exprs: list[pl.Expr] = []
+        for field in self.fields:
+            coerced = _coerce_expr(
+                field, pl.col(field.name), df.schema[field.name], field.name
+            )
+            exprs.append(
+                coerced.alias(field.name) if coerced is not None else pl.col(field.name)
+            )
+        coerced_lf = df.lazy().select(exprs)
+        if not self.constraint_exprs:
+            return coerced_lf.collect()
+        # both queries share the cast, which is computed once
+        coerced_df, counts = pl.collect_all(
+            [coerced_lf, coerced_lf.select(self.constraint_exprs)]
+        )
+        assert isinstance(coerced_df, pl.DataFrame)  # for type checker
+        assert isinstance(counts, pl.DataFrame)
+        self._raise_violations(counts)
+        return coerced_df
+
+
+@functools.lru_cache(maxsize=COMPILED_SCHEMA_CACHE_SIZE)
+def _compile_table_schema(table_json: str) -> CompiledTableSchema:
+    table = BQTable.model_validate_json(table_json)
+    constraint_exprs: list[pl.Expr] = []
+    for field in table.fields:
+        constraint_exprs.extend(
+            _constraint_exprs(field, pl.col(field.name), field.name)
+        )
+    return CompiledTableSchema(
+        table_id=f"{table.project}.{table.dataset}.{table.table}",
+        fields=tuple(table.fields),
+        constraint_exprs=tuple(constraint_exprs),
+    )
+
+
+def compile_table_schema(table: BQTable) -> CompiledTableSchema:
+    # BQTable is mutable and unhashable, so it is cached by its content
+    return _compile_table_schema(table.model_dump_json())
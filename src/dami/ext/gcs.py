@@ -1,27 +1,182 @@
-from collections.abc import Callable
-from dataclasses import dataclass
+import base64
+from collections.abc import Callable, Generator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import datetime
+import io
+from pathlib import Path
+import tempfile
+import threading
+import time
+from typing import Final, Literal
+
 from google.cloud import storage
 from google.cloud.storage import Blob
+from google.cloud.storage.fileio import BlobWriter
+import google_crc32c
+from loguru import logger
 
 import polars as pl
 
+from dami.ext.read_policy import ResilientReader
+from dami.ext.transcode import is_utf8, transcode_to_utf8
+from dami.tracing import current_span, span, traced
+from dami.types.gcs import GCSLocation, GCSPath
+
+
+BYTES_TO_LOADER: dict[str, Callable[[bytes, str | None], pl.DataFrame]] = {
+    "parquet": lambda data, _: pl.read_parquet(data),
+    "csv": lambda data, encoding: pl.read_csv(data, encoding=encoding or "utf-8"),
+}
+
+
+# Streaming counterparts of BYTES_TO_LOADER; keyed by the same extensions.
+# CSVs are transcoded to UTF-8 while spooling, so scanners never see an encoding.
+FILE_TO_SCANNER: dict[str, Callable[[Path], pl.LazyFrame]] = {
+    "parquet": lambda path: pl.scan_parquet(path),
+    "csv": lambda path: pl.scan_csv(path),
+}
+
+DEFAULT_MAX_MEMORY_BYTES: Final[int] = 64 * 1024 * 1024
+# upper bound of a single ranged read; the memory ceiling may lower it
+DOWNLOAD_CHUNK_SIZE: Final[int] = 8 * 1024 * 1024
+# number of rows sampled to estimate the in-memory width of a row
+ROW_WIDTH_SAMPLE_SIZE: Final[int] = 1000
+
+# files larger than this are split into parts uploaded in parallel
+PARALLEL_UPLOAD_THRESHOLD: Final[int] = 32 * 1024 * 1024
+UPLOAD_PART_SIZE: Final[int] = 16 * 1024 * 1024
+UPLOAD_MAX_WORKERS: Final[int] = 8
+# resumable upload chunk for streamed writes; must be a multiple of 256KiB
+STREAM_UPLOAD_CHUNK_SIZE: Final[int] = 8 * 1024 * 1024
+# GCS accepts at most 32 source objects per compose request
+MAX_COMPOSE_SOURCES: Final[int] = 32
+_CRC32C_READ_SIZE: Final[int] = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class UploadStats:
+    n_bytes: int
+    n_parts: int
+    n_resumed_parts: int
+    elapsed_seconds: float
+
+    @property
+    def throughput_mib_per_sec(self) -> float:
+        return self.n_bytes / (1024 * 1024) / max(self.elapsed_seconds, 1e-9)
+
+
+def file_crc32c(path: Path, start: int = 0, size: int | None = None) -> str:
+    """
+    CRC32C of `path[start:start + size]`, encoded the same way as `Blob.crc32c`.
+    """
+    checksum = google_crc32c.Checksum()
+    with path.open("rb") as f:
+        f.seek(start)
+        remaining = path.stat().st_size - start if size is None else size
+        while remaining > 0:
+            chunk = f.read(min(_CRC32C_READ_SIZE, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+# cached prefix indexes are fully re-listed after this many seconds
+PREFIX_INDEX_TTL_SECONDS: Final[float] = 10 * 60
+# cached bucket handles are fetched again after this many seconds
+BUCKET_CACHE_TTL_SECONDS: Final[float] = 10 * 60
+
+# "updated": latest by modification time (always correct)
+# "name": latest by blob name, for prefixes whose names sort chronologically
+LatestBlobOrder = Literal["updated", "name"]
+
+
+@dataclass(frozen=True)
+class PrefixIndexEntry:
+    name: str
+    generation: int
+    updated: datetime.datetime
+    size: int
+
+    @classmethod
+    def from_blob(cls, blob: Blob) -> "PrefixIndexEntry":
+        assert blob.name is not None
+        assert blob.generation is not None
+        assert blob.updated is not None
+        return cls(
+            name=blob.name,
+            generation=blob.generation,
+            updated=blob.updated,
+            size=blob.size or 0,
+        )
+
 
 @dataclass
-class GCSLocation:
-    bucket: str
-    path: str
+class PrefixIndex:
+    entries: dict[str, PrefixIndexEntry] = field(default_factory=dict)
+    # monotonic time of the last full listing
+    listed_at: float = 0.0
+    # held while the entries are refreshed and read
+    lock: threading.Lock = field(
+        default_factory=threading.Lock, repr=False, compare=False
+    )
 
-    def get_uri(self) -> str:
-        return f"gs://{self.bucket}/{self.path}"
+    @property
+    def high_water_name(self) -> str | None:
+        return max(self.entries) if self.entries else None
 
+    def latest(self, order_by: LatestBlobOrder) -> PrefixIndexEntry | None:
+        if not self.entries:
+            return None
+        if order_by == "name":
+            return self.entries[max(self.entries)]
+        return max(self.entries.values(), key=lambda e: e.updated)
 
-GCSPath = str | GCSLocation
 
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
 
-BYTES_TO_LOADER: dict[str, Callable[[bytes, str | None], pl.DataFrame]] = {
-    "parquet": lambda data, _: pl.read_parquet(data),
-    "csv": lambda data, encoding: pl.read_csv(data, encoding=encoding or "utf-8"),
-}
+
+@dataclass
+class BucketCache:
+    """
+    Bucket handles from `client.get_bucket`, reused for `ttl` seconds so that
+    an operation does not cost a bucket metadata GET each time.
+    Thread-safe, so that the handlers of every thread can share one cache
+    for the same client.
+    """
+
+    ttl: float = BUCKET_CACHE_TTL_SECONDS
+    stats: CacheStats = field(default_factory=CacheStats)
+    _entries: dict[str, tuple[storage.Bucket, float]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def get(self, client: storage.Client, name: str) -> storage.Bucket:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self.stats.hits += 1
+                return entry[0]
+            self.stats.misses += 1
+        # a missing bucket raises NotFound here, as before the cache
+        bucket = client.get_bucket(name)
+        with self._lock:
+            self._entries[name] = (bucket, time.monotonic())
+        return bucket
+
+    def invalidate(self, name: str | None = None) -> None:
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
 
 
 class UnsupportedFileTypeError(Exception):
@@ -35,64 +190,415 @@ class BlobNotFoundError(Exception):
 @dataclass
 class GCSHandler:
     client: storage.Client
+    prefix_index_ttl: float = PREFIX_INDEX_TTL_SECONDS
+    prefix_cache_stats: CacheStats = field(default_factory=CacheStats)
+    bucket_cache: BucketCache = field(default_factory=BucketCache)
+    # deadlines, retries and hedging of metadata GETs and downloads
+    reader: ResilientReader = field(default_factory=ResilientReader)
+    _prefix_indexes: dict[tuple[str, str, str], PrefixIndex] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    # guards `_prefix_indexes` and `prefix_cache_stats`
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
 
     def _path_to_location(self, path: GCSPath) -> GCSLocation:
         if isinstance(path, GCSLocation):
             return path
         assert isinstance(path, str)
-        if not path.startswith("gs://"):
-            raise ValueError(f"Invalid GCS URI: {path}")
-        path = path[5:]
-        bucket_name, blob_name = path.split("/", 1)
-        return GCSLocation(bucket=bucket_name, path=blob_name)
+        return GCSLocation.from_uri(path)
+
+    def _get_bucket(self, name: str) -> storage.Bucket:
+        return self.bucket_cache.get(self.client, name)
+
+    def _get_blob(self, bucket: storage.Bucket, name: str) -> Blob | None:
+        # the library's own retry is off; the reader retries instead
+        return self.reader.call(
+            lambda timeout: bucket.get_blob(name, timeout=timeout, retry=None)
+        )
 
     def get_blob(self, loc: GCSLocation) -> Blob:
-        bucket = self.client.get_bucket(loc.bucket)
-        blob = bucket.get_blob(loc.path)
+        bucket = self._get_bucket(loc.bucket)
+        blob = self._get_blob(bucket, loc.path)
         if blob is None:
             raise BlobNotFoundError(f"Blob not found: {loc.get_uri()}")
         return blob
 
-    def get_latest_blob(self, prefix: GCSPath, suffix: str) -> Blob | None:
+    @traced("gcs.list_blobs")
+    def _list_into_index(
+        self,
+        bucket: storage.Bucket,
+        loc: GCSLocation,
+        suffix: str,
+        index: PrefixIndex,
+        start_offset: str | None,
+    ) -> dict[str, Blob]:
+        listed: dict[str, Blob] = {}
+        for b in self.client.list_blobs(
+            bucket,
+            prefix=loc.path,
+            start_offset=start_offset,
+            match_glob=f"**{suffix}",
+        ):
+            if b.name.endswith(suffix):
+                index.entries[b.name] = PrefixIndexEntry.from_blob(b)
+                listed[b.name] = b
+        current_span().set(
+            prefix=loc.get_uri(),
+            n_blobs=len(listed),
+            incremental=start_offset is not None,
+        )
+        return listed
+
+    def find_blob(self, loc: GCSLocation) -> Blob | None:
         """
-        in a given prefix, get the latest blob
+        `get_blob` without raising; costs a single metadata GET.
         """
+        return self._get_blob(self.client.bucket(loc.bucket), loc.path)
+
+    @traced("gcs.list_blobs")
+    def list_blobs(self, prefix: GCSPath, suffix: str) -> list[Blob]:
         loc = self._path_to_location(prefix)
-        bucket = self.client.get_bucket(loc.bucket)
         blobs = [
             b
-            for b in self.client.list_blobs(bucket, prefix=loc.path)
+            for b in self.client.list_blobs(
+                self.client.bucket(loc.bucket),
+                prefix=loc.path,
+                match_glob=f"**{suffix}",
+            )
             if b.name.endswith(suffix)
         ]
-        if len(blobs) == 0:
-            return None
-        latest_blob = max(blobs, key=lambda b: b.updated)
-        return latest_blob
+        current_span().set(prefix=loc.get_uri(), n_blobs=len(blobs))
+        return blobs
 
-    def download_df(self, blob: Blob, str_encoding: str | None) -> pl.DataFrame:
+    def update_blob_metadata(self, blob: Blob, metadata: dict[str, str]) -> None:
+        blob.metadata = {**(blob.metadata or {}), **metadata}
+        blob.patch()
+
+    @traced("gcs.get_latest_blob")
+    def get_latest_blob(
+        self,
+        prefix: GCSPath,
+        suffix: str,
+        order_by: LatestBlobOrder = "updated",
+    ) -> Blob | None:
         """
-        Specify `str_encoding` when you use STR_TO_LOADER.
+        in a given prefix, get the latest blob
+
+        With order_by="name" the listing is cached per prefix: a cached index
+        is refreshed by listing only names at or after the last known one
+        (`start_offset`), and the candidate's generation is re-checked with a
+        single metadata GET. This is exact for chronologically named blobs.
+        With order_by="updated" the prefix is listed in full on every call,
+        since a newer blob may have a name sorting before the known ones.
         """
+        loc = self._path_to_location(prefix)
+        # `client.bucket` does not issue a request, unlike `client.get_bucket`
+        bucket = self.client.bucket(loc.bucket)
+        key = (loc.bucket, loc.path, suffix)
+        with self._lock:
+            index = self._prefix_indexes.get(key)
+            # an incremental listing only finds names after the high-water one
+            full = (
+                order_by == "updated"
+                or index is None
+                or time.monotonic() - index.listed_at > self.prefix_index_ttl
+            )
+            if index is None or full:
+                self.prefix_cache_stats.misses += 1
+                index = PrefixIndex(listed_at=time.monotonic())
+                self._prefix_indexes[key] = index
+            else:
+                self.prefix_cache_stats.hits += 1
+        # concurrent lookups of the same prefix take turns; others are not blocked
+        with index.lock:
+            return self._refresh_latest(bucket, loc, suffix, index, order_by, full)
+
+    def _refresh_latest(
+        self,
+        bucket: storage.Bucket,
+        loc: GCSLocation,
+        suffix: str,
+        index: PrefixIndex,
+        order_by: LatestBlobOrder,
+        full: bool,
+    ) -> Blob | None:
+        listed = self._list_into_index(
+            bucket, loc, suffix, index, None if full else index.high_water_name
+        )
+        while (entry := index.latest(order_by)) is not None:
+            if entry.name in listed:
+                return listed[entry.name]
+            blob = self._get_blob(bucket, entry.name)
+            if blob is None:
+                # deleted since it was indexed
+                del index.entries[entry.name]
+                continue
+            if blob.generation != entry.generation:
+                index.entries[entry.name] = PrefixIndexEntry.from_blob(blob)
+            return blob
+        return None
+
+    @staticmethod
+    def _get_extension(blob: Blob) -> str:
         assert blob.name is not None
         extension = blob.name.split(".")[-1]
-        data = blob.download_as_bytes()
-        # Note that passing encoding to `pl.read_XXX`
-        # and passing decoded string are different.
-        # the latter may cause issues with some file types.
-        try:
-            loader = BYTES_TO_LOADER[extension]
-        except KeyError:
+        if extension not in BYTES_TO_LOADER:
             raise UnsupportedFileTypeError(
                 f"Unsupported file type for BYTES_TO_LOADER: {extension}"
             )
-        return loader(data, str_encoding)
+        return extension
+
+    @traced("gcs.download_df")
+    def download_df(
+        self,
+        blob: Blob,
+        str_encoding: str | None,
+        max_memory_bytes: int | None = None,
+    ) -> pl.DataFrame:
+        """
+        Specify `str_encoding` when you use STR_TO_LOADER.
+        Pass `max_memory_bytes` to download through the streaming path,
+        which never holds the raw payload in memory.
+        """
+        current_span().set(blob=blob.name, bytes=blob.size)
+        if max_memory_bytes is not None:
+            with self.download_lazy(blob, str_encoding, max_memory_bytes) as lf:
+                with span("gcs.parse", streaming=True):
+                    df = lf.collect(engine="streaming")
+            current_span().set(rows=df.height)
+            return df
+        extension = self._get_extension(blob)
+        if extension == "csv" and not is_utf8(str_encoding):
+            # `pl.read_csv(encoding=...)` decodes the whole payload into one str;
+            # transcoding chunk by chunk keeps only the UTF-8 copy in memory
+            assert str_encoding is not None  # for type checker
+            buffer = io.BytesIO()
+            with span("gcs.download", encoding=str_encoding) as download_span:
+                for chunk in transcode_to_utf8(
+                    self._iter_chunks(blob, DOWNLOAD_CHUNK_SIZE), str_encoding
+                ):
+                    buffer.write(chunk)
+                download_span.set(utf8_bytes=buffer.tell())
+            buffer.seek(0)
+            with span("gcs.parse", format=extension):
+                df = pl.read_csv(buffer)
+        else:
+            with span("gcs.download"):
+                data = self.reader.call(
+                    lambda timeout: blob.download_as_bytes(timeout=timeout, retry=None)
+                )
+            # Note that passing encoding to `pl.read_XXX`
+            # and passing decoded string are different.
+            # the latter may cause issues with some file types.
+            loader = BYTES_TO_LOADER[extension]
+            with span("gcs.parse", format=extension):
+                df = loader(data, str_encoding)
+        current_span().set(rows=df.height)
+        return df
+
+    def _iter_chunks(self, blob: Blob, chunk_size: int) -> Iterator[bytes]:
+        """
+        Read the blob with ranged requests of at most `chunk_size` bytes.
+        """
+        if blob.size is None:
+            self.reader.call(lambda timeout: blob.reload(timeout=timeout, retry=None))
+        assert blob.size is not None
+        size = blob.size
+        for start in range(0, size, chunk_size):
+            end = min(start + chunk_size, size) - 1
+            # pin the generation so that all chunks come from the same object.
+            # The range is bound now: a hedged or retried request may start
+            # on another thread after the loop has moved on.
+            yield self.reader.call(
+                lambda timeout, start=start, end=end: blob.download_as_bytes(
+                    start=start,
+                    end=end,
+                    if_generation_match=blob.generation,
+                    timeout=timeout,
+                    retry=None,
+                ),
+                # only ranged reads are hedged, each size by its own latencies
+                hedge_kind=f"range:{chunk_size}",
+            )
+
+    @contextmanager
+    def _spool_blob(
+        self,
+        blob: Blob,
+        str_encoding: str | None,
+        max_memory_bytes: int,
+    ) -> Generator[Path]:
+        """
+        Copy the blob to a local temporary file with ranged reads,
+        so that at most one chunk of the payload is held in memory.
+        CSVs are transcoded to UTF-8 on the way.
+        """
+        extension = self._get_extension(blob)
+        chunk_size = max(1, min(DOWNLOAD_CHUNK_SIZE, max_memory_bytes))
+        chunks = self._iter_chunks(blob, chunk_size)
+        if extension == "csv" and not is_utf8(str_encoding):
+            assert str_encoding is not None  # for type checker
+            chunks = transcode_to_utf8(chunks, str_encoding)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / f"blob.{extension}"
+            with path.open("wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            yield path
+
+    @contextmanager
+    def download_lazy(
+        self,
+        blob: Blob,
+        str_encoding: str | None,
+        max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    ) -> Generator[pl.LazyFrame]:
+        """
+        Streaming variant of `download_df`.
+        The LazyFrame is backed by a temporary file and is valid only inside the block.
+        """
+        with self._spool_blob(blob, str_encoding, max_memory_bytes) as path:
+            yield FILE_TO_SCANNER[path.suffix[1:]](path)
+
+    def download_batches(
+        self,
+        blob: Blob,
+        str_encoding: str | None,
+        max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+    ) -> Iterator[pl.DataFrame]:
+        """
+        Yield the blob as DataFrames whose estimated size stays under `max_memory_bytes`.
+        """
+        with self.download_lazy(blob, str_encoding, max_memory_bytes) as lf:
+            sample = lf.head(ROW_WIDTH_SAMPLE_SIZE).collect()
+            if sample.height == 0:
+                yield sample
+                return
+            row_width = max(1, int(sample.estimated_size()) // sample.height)
+            batch_size = max(1, max_memory_bytes // row_width)
+            yield from lf.collect_batches(chunk_size=batch_size)
 
+    @traced("gcs.upload_bytes")
     def upload_bytes(self, data: bytes, loc: GCSLocation) -> None:
-        bucket = self.client.get_bucket(loc.bucket)
+        current_span().set(bytes=len(data))
+        bucket = self._get_bucket(loc.bucket)
         blob = bucket.blob(loc.path)
         blob.upload_from_string(data)  # you can pass bytes directly
 
+    def _upload_part(
+        self,
+        bucket: storage.Bucket,
+        local_path: Path,
+        part_name: str,
+        start: int,
+        size: int,
+    ) -> bool:
+        """
+        Upload one part unless an identical part is already in GCS.
+        Returns True when the part was resumed (i.e. skipped).
+        """
+        expected_crc32c = file_crc32c(local_path, start, size)
+        existing = bucket.get_blob(part_name)
+        if (
+            existing is not None
+            and existing.size == size
+            and existing.crc32c == expected_crc32c
+        ):
+            return True
+        blob = bucket.blob(part_name)
+        with local_path.open("rb") as f:
+            f.seek(start)
+            blob.upload_from_file(f, size=size, checksum="crc32c")
+        return False
+
+    def _compose(
+        self,
+        bucket: storage.Bucket,
+        part_names: list[str],
+        dest_path: str,
+        metadata: dict[str, str] | None = None,
+    ) -> None:
+        # compose in rounds because of the per-request source limit
+        round_idx = 0
+        while len(part_names) > MAX_COMPOSE_SOURCES:
+            next_names: list[str] = []
+            for i in range(0, len(part_names), MAX_COMPOSE_SOURCES):
+                name = f"{dest_path}.parts/compose-{round_idx:02d}-{i:05d}"
+                group = [bucket.blob(n) for n in part_names[i : i + MAX_COMPOSE_SOURCES]]
+                bucket.blob(name).compose(group)
+                next_names.append(name)
+            part_names = next_names
+            round_idx += 1
+        dest = bucket.blob(dest_path)
+        dest.metadata = metadata
+        dest.compose([bucket.blob(n) for n in part_names])
+
+    @traced("gcs.upload_file")
+    def upload_file(
+        self,
+        local_path: Path,
+        loc: GCSLocation,
+        parallel_threshold: int = PARALLEL_UPLOAD_THRESHOLD,
+        part_size: int = UPLOAD_PART_SIZE,
+        max_workers: int = UPLOAD_MAX_WORKERS,
+        metadata: dict[str, str] | None = None,
+    ) -> UploadStats:
+        """
+        Upload a local file by streaming it from disk.
+        Files above `parallel_threshold` are uploaded as parts in parallel and composed.
+        Parts are kept until the compose succeeds, so calling this again after
+        a failure re-uploads only the missing or corrupted parts.
+        `metadata` is set on the object in the request that creates it.
+        """
+        n_bytes = local_path.stat().st_size
+        bucket = self._get_bucket(loc.bucket)
+        started = time.perf_counter()
+        if n_bytes <= parallel_threshold:
+            blob = bucket.blob(loc.path)
+            blob.metadata = metadata
+            blob.upload_from_filename(str(local_path), checksum="crc32c")
+            n_parts, n_resumed = 1, 0
+        else:
+            offsets = list(range(0, n_bytes, part_size))
+            part_names = [f"{loc.path}.parts/{i:05d}" for i in range(len(offsets))]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                resumed = list(
+                    executor.map(
+                        lambda args: self._upload_part(bucket, local_path, *args),
+                        [
+                            (name, start, min(part_size, n_bytes - start))
+                            for name, start in zip(part_names, offsets)
+                        ],
+                    )
+                )
+            self._compose(bucket, part_names, loc.path, metadata)
+            for blob in self.client.list_blobs(bucket, prefix=f"{loc.path}.parts/"):
+                blob.delete()
+            n_parts, n_resumed = len(part_names), sum(resumed)
+        stats = UploadStats(
+            n_bytes=n_bytes,
+            n_parts=n_parts,
+            n_resumed_parts=n_resumed,
+            elapsed_seconds=time.perf_counter() - started,
+        )
+        current_span().set(bytes=n_bytes, n_parts=n_parts, n_resumed_parts=n_resumed)
+        logger.info(
+            f"Uploaded {n_bytes} bytes to {loc.get_uri()} in {n_parts} part(s) "
+            f"({n_resumed} resumed), {stats.throughput_mib_per_sec:.1f} MiB/s"
+        )
+        return stats
+
+    def open_writer(
+        self, loc: GCSLocation, chunk_size: int = STREAM_UPLOAD_CHUNK_SIZE
+    ) -> BlobWriter:
+        """
+        Writer for a resumable upload holding at most `chunk_size` bytes in memory.
+        The object is created only when the writer is closed.
+        """
+        blob = self.client.bucket(loc.bucket).blob(loc.path)
+        return BlobWriter(blob, chunk_size=chunk_size, checksum="crc32c")
+
     def delete_blob(self, loc: GCSLocation) -> None:
-        bucket = self.client.get_bucket(loc.bucket)
+        bucket = self._get_bucket(loc.bucket)
         blob = bucket.blob(loc.path)
         blob.delete()
@@ -0,0 +1,66 @@
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Final
+
+if TYPE_CHECKING:
+    # imported by `pooled_session`, so that the container can import this
+    # module without loading the HTTP stack
+    import requests
+    from google.auth.credentials import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+
+
+# keep-alive connections kept per host; a thread that finds the pool empty
+# opens a new connection, which is dropped afterwards if the pool is full.
+# Enough for the async pool (AIO_MAX_WORKERS) and the parallel part uploads
+# (UPLOAD_MAX_WORKERS) at the same time.
+HTTP_POOL_SIZE: Final[int] = 18
+
+
+@dataclass
+class RequestCounter:
+    """
+    Counts the HTTP requests sent through a session, by method.
+    """
+
+    by_method: Counter[str] = field(default_factory=Counter)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    @property
+    def n_requests(self) -> int:
+        with self._lock:
+            return sum(self.by_method.values())
+
+    def reset(self) -> None:
+        with self._lock:
+            self.by_method.clear()
+
+    def __call__(
+        self, response: "requests.Response", *args: Any, **kwargs: Any
+    ) -> None:
+        # registered as a `requests` response hook
+        with self._lock:
+            self.by_method[response.request.method or "UNKNOWN"] += 1
+
+
+def pooled_session(
+    credentials: "Credentials",
+    pool_size: int = HTTP_POOL_SIZE,
+    counter: RequestCounter | None = None,
+) -> "AuthorizedSession":
+    """
+    Authorized session holding up to `pool_size` keep-alive connections per host,
+    to be shared by every thread of a client.
+    """
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    if counter is not None:
+        session.hooks["response"].append(counter)
+    return session
@@ -0,0 +1,304 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Final, cast
+
+import polars as pl
+from loguru import logger
+
+from dami.ext.bq import BQPolarsHandler, _create_query_job_config_from_python
+from dami.ext.bq_schema import table_schema
+from dami.settings import BQ_MIRROR_DIR
+from dami.tracing import current_span, traced
+from dami.types.bq import NULL_PARTITION_ID, BQTable, QueryParamValue
+
+# hive partition column of the mirror, e.g. `month=2026-01/data.parquet`
+MIRROR_PARTITION_KEY: Final[str] = "month"
+MIRROR_FILE_NAME: Final[str] = "data.parquet"
+_MANIFEST_NAME: Final[str] = "_manifest.json"
+# rows still in the streaming buffer have no partition yet
+_UNPARTITIONED_ID: Final[str] = "__UNPARTITIONED__"
+
+
+@dataclass
+class _Manifest:
+    # table fields and mirror column the files were written with
+    schema_key: str
+    # last-modified time of the table when it was last synced
+    table_modified: str
+    # partition id -> last-modified time, for tables partitioned by the column
+    partitions: dict[str, str] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class MirrorSyncStats:
+    full: bool
+    months_fetched: int
+    rows_fetched: int
+
+    @property
+    def up_to_date(self) -> bool:
+        return not self.full and self.months_fetched == 0
+
+
+def _months_of_partition(partition_id: str, partitioning_type: str) -> list[str]:
+    if partition_id == NULL_PARTITION_ID:
+        return [NULL_PARTITION_ID]
+    year = partition_id[:4]
+    if partitioning_type == "YEAR":
+        return [f"{year}-{month:02d}" for month in range(1, 13)]
+    # HOUR, DAY and MONTH ids start with YYYYMM
+    return [f"{year}-{partition_id[4:6]}"]
+
+
+def _month_ranges(months: list[str]) -> list[tuple[datetime.date, datetime.date]]:
+    """
+    Half-open date ranges covering `months`, consecutive months merged.
+    """
+    ranges: list[tuple[datetime.date, datetime.date]] = []
+    for month in sorted(months):
+        year, number = month.split("-")
+        start = datetime.date(int(year), int(number), 1)
+        end = (start + datetime.timedelta(days=31)).replace(day=1)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+@dataclass
+class TableMirror:
+    """
+    Local copy of a BQ table as Hive-partitioned parquet files, one per month
+    of `column` (default: the partitioning column), under
+    `mirror_dir/<table id>/month=YYYY-MM/`.
+
+    `sync` checks the last-modified time of the table, which costs one
+    metadata request when nothing changed. If the table is partitioned by
+    `column`, only the months of partitions modified since the last sync are
+    fetched again; otherwise the whole table is.
+    """
+
+    handler: BQPolarsHandler
+    table: BQTable
+    mirror_dir: Path = BQ_MIRROR_DIR
+    column: str | None = None
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+    # `column`, or the partitioning column when it is None
+    _column: str = field(init=False, repr=False)
+    _is_timestamp: bool = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        column = self.column
+        if column is None:
+            partitioning = self.table.time_partitioning
+            if partitioning is None or partitioning.field is None:
+                raise ValueError(
+                    f"{self.table.get_bq_table_id()} is not partitioned by a column; "
+                    "pass the date column to mirror by"
+                )
+            column = partitioning.field
+        bq_field = {f.name: f for f in self.table.fields}.get(column)
+        if (
+            bq_field is None
+            or bq_field.mode == "REPEATED"
+            or bq_field.type not in ("DATE", "TIMESTAMP")
+        ):
+            raise ValueError(
+                f"Cannot mirror by {column}; a DATE or TIMESTAMP column is required"
+            )
+        self.column = self._column = column
+        self._is_timestamp = bq_field.type == "TIMESTAMP"
+
+    @property
+    def table_id(self) -> str:
+        return f"{self.table.project}.{self.table.dataset}.{self.table.table}"
+
+    @property
+    def root(self) -> Path:
+        return self.mirror_dir / self.table_id
+
+    @property
+    def months(self) -> list[str]:
+        return sorted(
+            path.name.split("=", 1)[1]
+            for path in self.root.glob(f"{MIRROR_PARTITION_KEY}=*")
+            if (path / MIRROR_FILE_NAME).exists()
+        )
+
+    def scan(self, sync: bool = False) -> pl.LazyFrame:
+        """
+        Lazy frame over the mirror with an extra `month` column. Filters on
+        `month` skip whole files; other filters and the projection are pushed
+        down to the parquet reader.
+        """
+        if sync:
+            self.sync()
+        if len(self.months) == 0:
+            schema = {
+                **table_schema(self.table).polars_schema,
+                MIRROR_PARTITION_KEY: pl.String,
+            }
+            return pl.LazyFrame(schema=schema)
+        return pl.scan_parquet(
+            str(self.root / f"{MIRROR_PARTITION_KEY}=*" / MIRROR_FILE_NAME),
+            hive_partitioning=True,
+            hive_schema={MIRROR_PARTITION_KEY: pl.String},
+        )
+
+    @traced("mirror.sync")
+    def sync(self) -> MirrorSyncStats:
+        with self._lock:
+            current_span().set(table=self.table_id)
+            manifest = self._read_manifest()
+            schema_key = json.dumps(
+                [self._column, self.table.bq_schema], sort_keys=True
+            )
+            # read before fetching, so that writes made meanwhile are fetched next time
+            modified = str(self.handler.client.get_table(self.table_id).modified)
+            if manifest is not None and manifest.schema_key != schema_key:
+                # mirrored with another schema or column
+                manifest = None
+            if manifest is not None and manifest.table_modified == modified:
+                current_span().set(up_to_date=True)
+                return MirrorSyncStats(full=False, months_fetched=0, rows_fetched=0)
+            partitioning = self.table.time_partitioning
+            partitions: dict[str, str] = {}
+            months: set[str] | None = None
+            if partitioning is not None and partitioning.field == self._column:
+                partitions = self._partition_times()
+                if manifest is None:
+                    logger.info(
+                        f"No current mirror of {self.table_id}; fetching all months"
+                    )
+                else:
+                    changed = {
+                        pid
+                        for pid, last_modified in partitions.items()
+                        if manifest.partitions.get(pid) != last_modified
+                    } | (set(manifest.partitions) - set(partitions))
+                    if _UNPARTITIONED_ID not in changed:
+                        months = {
+                            month
+                            for pid in changed
+                            for month in _months_of_partition(pid, partitioning.type)
+                        }
+            df = self._fetch(None if months is None else sorted(months))
+            n_months = self._write_months(df, months)
+            self._write_manifest(_Manifest(schema_key, modified, partitions))
+            stats = MirrorSyncStats(
+                full=months is None, months_fetched=n_months, rows_fetched=df.height
+            )
+            current_span().set(
+                full=stats.full, months=stats.months_fetched, rows=stats.rows_fetched
+            )
+            logger.info(
+                f"Synced {'all' if stats.full else stats.months_fetched} month(s) "
+                f"({stats.rows_fetched} rows) of {self.table_id} to {self.root}"
+            )
+            return stats
+
+    def _partition_times(self) -> dict[str, str]:
+        query = (
+            "SELECT partition_id, last_modified_time "
+            f"FROM `{self.table.project}.{self.table.dataset}.INFORMATION_SCHEMA.PARTITIONS` "
+            "WHERE table_name = @table_name"
+        )
+        job = self.handler.client.query(
+            query,
+            job_config=_create_query_job_config_from_python(
+                {"table_name": self.table.table}
+            ),
+        )
+        rows = cast(pl.DataFrame, pl.from_arrow(job.to_arrow()))
+        return {
+            pid: str(last_modified)
+            for pid, last_modified in zip(
+                rows["partition_id"].to_list(), rows["last_modified_time"].to_list()
+            )
+        }
+
+    def _fetch(self, months: list[str] | None) -> pl.DataFrame:
+        """
+        Rows of `months`, or of the whole table when None.
+        """
+        fields = [f.name for f in self.table.fields]
+        query = f"SELECT {', '.join(fields)} FROM {self.table.get_bq_table_id()}"
+        params: dict[str, QueryParamValue] = {}
+        if months is not None:
+            if len(months) == 0:
+                return pl.DataFrame(schema=table_schema(self.table).polars_schema)
+            conditions: list[str] = []
+            for i, (start, end) in enumerate(
+                _month_ranges([m for m in months if m != NULL_PARTITION_ID])
+            ):
+                # constant bounds on the column keep the partition pruning
+                conditions.append(
+                    f"({self._column} >= @start_{i} AND {self._column} < @end_{i})"
+                )
+                for name, bound in ((f"start_{i}", start), (f"end_{i}", end)):
+                    params[name] = (
+                        datetime.datetime.combine(bound, datetime.time(), datetime.UTC)
+                        if self._is_timestamp
+                        else bound
+                    )
+            if NULL_PARTITION_ID in months:
+                conditions.append(f"{self._column} IS NULL")
+            query += f" WHERE {' OR '.join(conditions)}"
+        return self.handler.fetch_df(query, self.table, fields, params)
+
+    def _write_months(self, df: pl.DataFrame, months: set[str] | None) -> int:
+        """
+        Replace the files of `months` (every month when None) with the rows
+        of `df`; months left without rows are removed. Returns the months written.
+        """
+        column = pl.col(self._column)
+        dtype = df.schema[self._column]
+        if isinstance(dtype, pl.Datetime) and dtype.time_zone is not None:
+            column = column.dt.convert_time_zone("UTC")
+        parts: dict[str, pl.DataFrame] = {
+            cast(str, month): part
+            for (month,), part in df.with_columns(
+                column.dt.strftime("%Y-%m")
+                .fill_null(NULL_PARTITION_ID)
+                .alias(MIRROR_PARTITION_KEY)
+            )
+            .partition_by(MIRROR_PARTITION_KEY, as_dict=True, include_key=False)
+            .items()
+        }
+        for month, part in parts.items():
+            directory = self.root / f"{MIRROR_PARTITION_KEY}={month}"
+            directory.mkdir(parents=True, exist_ok=True)
+            # readers never see a partly written file
+            tmp_path = directory / f".{MIRROR_FILE_NAME}.tmp"
+            part.write_parquet(tmp_path)
+            os.replace(tmp_path, directory / MIRROR_FILE_NAME)
+        stale = (set(self.months) if months is None else months) - set(parts)
+        for month in stale:
+            shutil.rmtree(
+                self.root / f"{MIRROR_PARTITION_KEY}={month}", ignore_errors=True
+            )
+        return len(parts) + len(stale)
+
+    def _read_manifest(self) -> _Manifest | None:
+        path = self.root / _MANIFEST_NAME
+        if not path.exists():
+            return None
+        try:
+            return _Manifest(**json.loads(path.read_text()))
+        except (ValueError, TypeError):
+            logger.warning(f"Ignoring the corrupt mirror manifest {path}")
+            return None
+
+    def _write_manifest(self, manifest: _Manifest) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f".{_MANIFEST_NAME}.tmp"
+        tmp_path.write_text(json.dumps(asdict(manifest), indent=2, sort_keys=True))
+        os.replace(tmp_path, self.root / _MANIFEST_NAME)
@@ -0,0 +1,139 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Final
+
+import polars as pl
+from loguru import logger
+
+DEFAULT_QUERY_CACHE_MAX_BYTES: Final[int] = 1024 * 1024 * 1024
+DEFAULT_QUERY_CACHE_TTL_SECONDS: Final[float] = 24 * 60 * 60
+
+# table written by a DML statement, e.g. "DELETE FROM `p.d.t` WHERE ...".
+# Only backticked or dotted names count as tables, so that keywords following
+# the verbs, as in "INSERT ROW" or "UPDATE SET" of a MERGE, are not taken for one.
+_DML_TARGET_PATTERN: Final[re.Pattern[str]] = re.compile(
+    r"\b(?:DELETE\s+(?:FROM\s+)?|UPDATE\s+|INSERT\s+(?:INTO\s+)?|MERGE\s+(?:INTO\s+)?)"
+    r"(?:`([^`]+)`|([\w-]+(?:\.[\w-]+)+))",
+    re.IGNORECASE,
+)
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split())
+
+
+def dml_target_tables(query: str) -> set[str]:
+    """
+    `project.dataset.table` ids written by the statements in `query`.
+    """
+    return {m.group(1) or m.group(2) for m in _DML_TARGET_PATTERN.finditer(query)}
+
+
+@dataclass
+class QueryCacheStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_saved: int = 0
+
+
+@dataclass
+class QueryResultCache:
+    """
+    On-disk cache of query results stored as Parquet files.
+
+    Entries live in `cache_dir/<table id>/<key>.parquet`. The file mtime is
+    the creation time (for the TTL) and the atime is the last access (for LRU).
+    The key includes the table's last-modified time, so writes made by
+    other processes also make old entries unreachable.
+    """
+
+    cache_dir: Path
+    max_bytes: int = DEFAULT_QUERY_CACHE_MAX_BYTES
+    ttl_seconds: float = DEFAULT_QUERY_CACHE_TTL_SECONDS
+    stats: QueryCacheStats = field(default_factory=QueryCacheStats)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    @staticmethod
+    def make_key(
+        query: str,
+        params: list[dict],
+        fields_to_fetch: list[str],
+        table_modified: datetime.datetime | None,
+    ) -> str:
+        payload = json.dumps(
+            {
+                "query": normalize_query(query),
+                "params": params,
+                "fields": fields_to_fetch,
+                "table_modified": table_modified.isoformat()
+                if table_modified
+                else None,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, table_id: str, key: str) -> Path:
+        return self.cache_dir / table_id / f"{key}.parquet"
+
+    def get(self, table_id: str, key: str) -> pl.DataFrame | None:
+        path = self._path(table_id, key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            with self._lock:
+                self.stats.misses += 1
+            return None
+        now = time.time()
+        if now - stat.st_mtime > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            with self._lock:
+                self.stats.misses += 1
+            return None
+        # polars memory-maps local files when reading parquet
+        df = pl.read_parquet(path)
+        # record the access for LRU while keeping the creation time
+        os.utime(path, (now, stat.st_mtime))
+        with self._lock:
+            self.stats.hits += 1
+            self.stats.bytes_saved += int(df.estimated_size())
+        return df
+
+    def put(self, table_id: str, key: str, df: pl.DataFrame) -> None:
+        path = self._path(table_id, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        df.write_parquet(tmp_path)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def invalidate(self, table_id: str) -> None:
+        for path in (self.cache_dir / table_id).glob("*.parquet"):
+            path.unlink(missing_ok=True)
+        logger.info(f"Invalidated query cache for {table_id}")
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries: list[tuple[Path, os.stat_result]] = []
+            for path in self.cache_dir.glob("*/*.parquet"):
+                try:
+                    entries.append((path, path.stat()))
+                except FileNotFoundError:
+                    continue
+            total = sum(stat.st_size for _, stat in entries)
+            # least recently accessed first
+            for path, stat in sorted(entries, key=lambda e: e[1].st_atime):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= stat.st_size
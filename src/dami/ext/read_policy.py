@@ -0,0 +1,211 @@
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Final, TypeVar
+
+import requests
+from google.api_core import exceptions as api_exceptions
+from loguru import logger
+
+from dami.tracing import in_current_context
+
+READ_ATTEMPT_TIMEOUT_SECONDS: Final[float] = 30.0
+READ_MAX_ATTEMPTS: Final[int] = 4
+READ_INITIAL_BACKOFF_SECONDS: Final[float] = 0.2
+READ_MAX_BACKOFF_SECONDS: Final[float] = 10.0
+# latencies of recent reads of each kind, from which its hedge delay is taken
+READ_LATENCY_WINDOW: Final[int] = 256
+# threads running hedged reads; a read holds up to two of them
+HEDGE_MAX_WORKERS: Final[int] = 32
+
+# transient failures; a slow response fails with a requests timeout
+RETRYABLE_READ_ERRORS: Final[tuple[type[BaseException], ...]] = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+_TIMEOUT_ERRORS: Final[tuple[type[BaseException], ...]] = (
+    requests.exceptions.Timeout,
+    api_exceptions.GatewayTimeout,
+    TimeoutError,
+)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class ReadPolicy:
+    """
+    Deadlines, retries and hedging of idempotent reads.
+
+    `attempt_timeout` is passed to each request as its timeout. Failed
+    attempts are retried after an exponential backoff with full jitter.
+    With `hedge_quantile` set, a read of a hedged kind still running after
+    that quantile of the recent latencies of its kind is sent again and the
+    first response is kept.
+    """
+
+    attempt_timeout: float | None = READ_ATTEMPT_TIMEOUT_SECONDS
+    max_attempts: int = READ_MAX_ATTEMPTS
+    initial_backoff: float = READ_INITIAL_BACKOFF_SECONDS
+    max_backoff: float = READ_MAX_BACKOFF_SECONDS
+    backoff_multiplier: float = 2.0
+    # e.g. 0.95; None disables hedging
+    hedge_quantile: float | None = None
+    # reads observed before the first hedge
+    hedge_min_samples: int = 20
+    hedge_min_delay: float = 0.01
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Sleep before retrying after the `attempt`-th (1-based) failure.
+        """
+        ceiling = min(
+            self.max_backoff,
+            self.initial_backoff * self.backoff_multiplier ** (attempt - 1),
+        )
+        return random.uniform(0, ceiling)
+
+
+@dataclass
+class ReadStats:
+    # logical reads
+    reads: int = 0
+    # requests sent, retries and hedges included
+    attempts: int = 0
+    retries: int = 0
+    timeouts: int = 0
+    hedges: int = 0
+    # hedges that responded before the original request
+    hedge_wins: int = 0
+
+    @property
+    def hedge_win_rate(self) -> float:
+        return self.hedge_wins / self.hedges if self.hedges else 0.0
+
+
+@dataclass
+class ResilientReader:
+    """
+    Runs reads under a `ReadPolicy`, recording `ReadStats`.
+    Thread-safe, so that the handlers of every thread can share the latency
+    windows and the hedging pool.
+    """
+
+    policy: ReadPolicy = field(default_factory=ReadPolicy)
+    stats: ReadStats = field(default_factory=ReadStats)
+    # hedge kind -> latencies of its recent reads
+    _latencies: dict[str, deque[float]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _executor: ThreadPoolExecutor | None = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def call(
+        self, read: Callable[[float | None], T], hedge_kind: str | None = None
+    ) -> T:
+        """
+        `read(timeout)` sends one request with the given timeout.
+        Only reads with a `hedge_kind` are hedged, after the latencies of that
+        kind; give one kind to idempotent reads of about the same size.
+        """
+        with self._lock:
+            self.stats.reads += 1
+        attempt = 1
+        while True:
+            try:
+                return self._hedged(read, hedge_kind)
+            except RETRYABLE_READ_ERRORS as e:
+                is_last = attempt >= self.policy.max_attempts
+                with self._lock:
+                    if isinstance(e, _TIMEOUT_ERRORS):
+                        self.stats.timeouts += 1
+                    if not is_last:
+                        self.stats.retries += 1
+                if is_last:
+                    raise
+                delay = self.policy.backoff(attempt)
+                logger.warning(
+                    f"Retrying a read in {delay:.2f}s after attempt {attempt}: {e!r}"
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def hedge_delay(self, kind: str) -> float | None:
+        """
+        Time after which a read of `kind` is hedged; None until enough reads
+        of it were seen.
+        """
+        quantile = self.policy.hedge_quantile
+        with self._lock:
+            # quantiles need two samples
+            min_samples = max(2, self.policy.hedge_min_samples)
+            window = self._latencies.get(kind, ())
+            if quantile is None or len(window) < min_samples:
+                return None
+            latencies = list(window)
+        cut = statistics.quantiles(latencies, n=100, method="inclusive")
+        delay = cut[min(98, max(0, round(quantile * 100) - 1))]
+        return max(self.policy.hedge_min_delay, delay)
+
+    def _timed(self, read: Callable[[float | None], T], kind: str | None) -> T:
+        with self._lock:
+            self.stats.attempts += 1
+        started = time.perf_counter()
+        result = read(self.policy.attempt_timeout)
+        if kind is not None:
+            latency = time.perf_counter() - started
+            with self._lock:
+                window = self._latencies.get(kind)
+                if window is None:
+                    window = self._latencies[kind] = deque(maxlen=READ_LATENCY_WINDOW)
+                window.append(latency)
+        return result
+
+    def _submit(self, read: Callable[[float | None], T], kind: str) -> Future[T]:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS)
+            executor = self._executor
+
+        def timed() -> T:
+            return self._timed(read, kind)
+
+        return executor.submit(in_current_context(timed))
+
+    def _hedged(self, read: Callable[[float | None], T], kind: str | None) -> T:
+        delay = self.hedge_delay(kind) if kind is not None else None
+        if kind is None or delay is None:
+            return self._timed(read, kind)
+        primary = self._submit(read, kind)
+        if wait([primary], timeout=delay).done:
+            return primary.result()
+        with self._lock:
+            self.stats.hedges += 1
+        hedge = self._submit(read, kind)
+        pending: set[Future[T]] = {primary, hedge}
+        error: BaseException | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if (error := future.exception()) is None:
+                    if future is hedge:
+                        with self._lock:
+                            self.stats.hedge_wins += 1
+                    # the slower request is left to finish; its response is dropped
+                    return future.result()
+        assert error is not None
+        raise error
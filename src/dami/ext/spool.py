@@ -0,0 +1,147 @@
+import os
+import tempfile
+import threading
+from contextlib import ExitStack
+from typing import IO, Self
+
+
+class SpooledPipe:
+    """
+    A buffer written by one thread while another reads it, so that an upload
+    can start before the encoding ends. Up to `max_memory_bytes` are held in
+    memory and the rest goes to a temp file; everything written is kept,
+    so the reader can seek back to retry a chunk.
+
+    `read(n)` blocks until `n` bytes are written or the writer has finished.
+    """
+
+    mode = "rb"
+
+    def __init__(self, max_memory_bytes: int) -> None:
+        self.max_memory_bytes = max_memory_bytes
+        with ExitStack() as stack:
+            self._file: IO[bytes] = stack.enter_context(
+                tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+            )
+            # the temp file is closed with `_resources`, in `close`
+            self._resources = stack.pop_all()
+        self._cond = threading.Condition()
+        self._written = 0
+        self._pos = 0
+        self._finished = False
+        self._closed = False
+        self._error: BaseException | None = None
+
+    @property
+    def n_bytes(self) -> int:
+        return self._written
+
+    @property
+    def spilled_to_disk(self) -> bool:
+        # SpooledTemporaryFile rolls over once it grows beyond max_size
+        return self._written > self.max_memory_bytes
+
+    @property
+    def peak_memory_bytes(self) -> int:
+        """
+        Most bytes the buffer held in memory before spilling to disk.
+        """
+        return min(self._written, self.max_memory_bytes)
+
+    # writer side
+
+    def write(self, data: bytes) -> int:
+        with self._cond:
+            if self._closed:
+                raise ValueError("The reader closed the pipe")
+            if self._finished:
+                raise ValueError("The pipe is finished")
+            self._file.seek(0, os.SEEK_END)
+            n = self._file.write(data)
+            self._written += n
+            self._cond.notify_all()
+        return n
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self) -> None:
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException) -> None:
+        """
+        Stop the reader with `error`, e.g. when the encoding failed.
+        """
+        with self._cond:
+            self._error = error
+            self._finished = True
+            self._cond.notify_all()
+
+    # reader side
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        with self._cond:
+            self._cond.wait_for(
+                lambda: (
+                    self._finished
+                    or self._closed
+                    or (size >= 0 and self._written - self._pos >= size)
+                )
+            )
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise ValueError("I/O operation on closed pipe")
+            self._file.seek(self._pos)
+            available = self._written - self._pos
+            data = self._file.read(available if size < 0 else min(size, available))
+            self._pos += len(data)
+            return data
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        with self._cond:
+            if whence == os.SEEK_SET:
+                pos = offset
+            elif whence == os.SEEK_CUR:
+                pos = self._pos + offset
+            else:
+                # the end is known only when the writer has finished
+                self._cond.wait_for(lambda: self._finished or self._closed)
+                pos = self._written + offset
+            if pos < 0:
+                raise ValueError(f"Negative seek position {pos}")
+            self._pos = pos
+            return pos
+
+    def close(self) -> None:
+        """
+        Release the buffer; a writer still running fails on its next write.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._resources.close()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
@@ -0,0 +1,36 @@
+import codecs
+from collections.abc import Iterable, Iterator
+from typing import Final
+
+# encodings whose bytes 0x00-0x7F always stand for the same ASCII characters,
+# so pure-ASCII chunks are already valid UTF-8 (unlike e.g. ISO-2022-JP)
+ASCII_COMPATIBLE_ENCODINGS: Final[frozenset[str]] = frozenset(
+    {"shift_jis", "cp932", "shift_jis_2004", "euc_jp", "iso8859-1", "cp1252"}
+)
+
+
+def is_utf8(encoding: str | None) -> bool:
+    return codecs.lookup(encoding or "utf-8").name == "utf-8"
+
+
+def transcode_to_utf8(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    Re-encode a byte stream from `encoding` to UTF-8 one chunk at a time.
+    A multibyte character split between two chunks is carried over
+    by the incremental decoder.
+    """
+    name = codecs.lookup(encoding).name
+    if name == "utf-8":
+        yield from chunks
+        return
+    passthrough_ascii = name in ASCII_COMPATIBLE_ENCODINGS
+    decoder = codecs.getincrementaldecoder(name)()
+    for chunk in chunks:
+        # skip the round trip through str when nothing but ASCII is pending
+        if passthrough_ascii and chunk.isascii() and not decoder.getstate()[0]:
+            yield chunk
+        else:
+            yield decoder.decode(chunk).encode("utf-8")
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail.encode("utf-8")
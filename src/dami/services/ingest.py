@@ -0,0 +1,154 @@
+import datetime
+import threading
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Final, Literal
+
+import polars as pl
+from google.api_core.exceptions import GoogleAPIError
+from google.cloud.storage import Blob
+from loguru import logger
+from pydantic import BaseModel
+
+from dami.ext.gcs import BlobNotFoundError, UnsupportedFileTypeError
+from dami.services.moneyforward import MoneyForwardService
+from dami.types.moneyforward import IngestMode, UpsertStats
+
+INGEST_MAX_WORKERS: Final[int] = 2
+INGEST_MAX_PENDING: Final[int] = 32
+# finished jobs kept for the status endpoints
+INGEST_MAX_HISTORY: Final[int] = 1000
+
+JobStatus = Literal["queued", "running", "succeeded", "failed"]
+
+# failures of a bad export or of GCS/BigQuery, logged without a traceback.
+# `ValueError` covers `SchemaViolationError` and pydantic's `ValidationError`.
+EXPECTED_INGEST_ERRORS: Final = (
+    GoogleAPIError,
+    BlobNotFoundError,
+    UnsupportedFileTypeError,
+    pl.exceptions.PolarsError,
+    ValueError,
+    OSError,
+)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class IngestJob(BaseModel):
+    id: str
+    blob_uri: str
+    mode: IngestMode
+    status: JobStatus = "queued"
+    created_at: datetime.datetime
+    started_at: datetime.datetime | None = None
+    finished_at: datetime.datetime | None = None
+    error: str | None = None
+    stats: UpsertStats | None = None
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+@dataclass
+class IngestJobQueue:
+    """
+    Runs `MoneyForwardService.insert_csv_blob` on a bounded pool of workers.
+    `service_factory` is called on the worker thread, so with a
+    `ThreadLocalSingleton` provider each worker keeps its own warm service.
+    """
+
+    service_factory: Callable[[], MoneyForwardService]
+    max_workers: int = INGEST_MAX_WORKERS
+    max_pending: int = INGEST_MAX_PENDING
+    max_history: int = INGEST_MAX_HISTORY
+    _jobs: OrderedDict[str, IngestJob] = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _n_pending: int = field(default=0, init=False, repr=False)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+    _executor: ThreadPoolExecutor = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="ingest"
+        )
+
+    def is_full(self) -> bool:
+        with self._lock:
+            return self._n_pending >= self.max_pending
+
+    def submit(self, blob: Blob, mode: IngestMode = "replace") -> IngestJob:
+        assert blob.bucket is not None and blob.name is not None
+        job = IngestJob(
+            id=uuid.uuid4().hex,
+            blob_uri=f"gs://{blob.bucket.name}/{blob.name}",
+            mode=mode,
+            created_at=_now(),
+        )
+        with self._lock:
+            if self._n_pending >= self.max_pending:
+                raise QueueFullError(
+                    f"Ingest queue is full ({self.max_pending} pending jobs)"
+                )
+            self._n_pending += 1
+            self._jobs[job.id] = job
+            self._trim_history()
+        future = self._executor.submit(self._run, job, blob)
+        future.add_done_callback(partial(self._finish, job))
+        logger.info(f"Queued ingest job {job.id} for {job.blob_uri}")
+        return job
+
+    def get(self, job_id: str) -> IngestJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job is not None else None
+
+    def list(self) -> list[IngestJob]:
+        with self._lock:
+            return [job.model_copy() for job in self._jobs.values()]
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def _trim_history(self) -> None:
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status in ("succeeded", "failed")
+        ]
+        for job_id in finished[: max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: IngestJob, blob: Blob) -> UpsertStats | None:
+        with self._lock:
+            job.status = "running"
+            job.started_at = _now()
+        return self.service_factory().insert_csv_blob(blob, mode=job.mode)
+
+    def _finish(self, job: IngestJob, future: Future[UpsertStats | None]) -> None:
+        error = future.exception()
+        if isinstance(error, EXPECTED_INGEST_ERRORS):
+            logger.error(f"Ingest job {job.id} failed: {error!r}")
+        elif error is not None:
+            logger.opt(exception=error).error(
+                f"Ingest job {job.id} failed unexpectedly"
+            )
+        with self._lock:
+            if error is None:
+                job.status = "succeeded"
+                job.stats = future.result()
+            else:
+                job.status = "failed"
+                job.error = repr(error)
+            job.finished_at = _now()
+            self._n_pending -= 1
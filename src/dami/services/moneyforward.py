@@ -1,14 +1,26 @@
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
 import datetime
+import hashlib
 import json
 from pathlib import Path
-from typing import cast
+import tempfile
+from typing import TypeVar, cast
+import uuid
 
+from google.cloud.storage import Blob
 import polars as pl
 from dami.ext.bq import BQPolarsHandler
-from dami.ext.gcs import GCSHandler, GCSLocation
-from dami.settings import GCP_PROJECT, PROJECT_ROOT
-from dami.types.bq import BQField, BQTable
+from dami.ext.bq_jobs import BQJobScheduler
+from dami.ext.bq_schema import SchemaRegistry, get_schema_registry, table_schema
+from dami.ext.gcs import GCSHandler, GCSLocation, file_crc32c
+from dami.ext.transcode import transcode_to_utf8
+from dami.settings import GCP_PROJECT
+from dami.tracing import current_span, span, traced
+from dami.types.bq import BQTable
+from dami.types.moneyforward import IngestMode, UpsertStats
 from loguru import logger
 
 
@@ -25,62 +37,468 @@ COL_MAPPING: dict[str, str] = {
     "ID": "transaction_id",
 }
 
+KEY_COLUMN = "transaction_id"
+# columns compared by the row hash in the upsert mode
+HASHED_COLUMNS: list[str] = [c for c in COL_MAPPING.values() if c != KEY_COLUMN]
+# the upsert mode stages rows in a table of its own, which BQ drops after
+# this long should the run not get to delete it
+STAGING_TABLE_EXPIRATION = datetime.timedelta(hours=1)
+# separates columns and marks NULLs in the row hash; neither appears in the CSV
+_HASH_SEPARATOR = "\x1f"
+_HASH_NULL = "\x00"
+
+# labels on the table recording the CSV generation last loaded into it;
+# a recreated table has none, so the next load is never skipped
+LOADED_OBJECT_LABEL = "dami-loaded-object"
+LOADED_GENERATION_LABEL = "dami-loaded-generation"
+
+# typed copy of `<name>.csv` written at upload, as `<name>.csv.parquet`
+MF_CSV_ENCODING = "shift-jis"
+
+LANDING_SUFFIX = ".parquet"
+LANDING_COMPRESSION = "zstd"
+LANDING_TRANSCODE_CHUNK_SIZE = 1024 * 1024
+# custom metadata on a landing copy: the CRC32C of the CSV it was converted
+# from, the conversion it went through and the date range of its rows
+LANDING_SOURCE_METADATA_KEY = "dami-source-crc32c"
+LANDING_SCHEMA_METADATA_KEY = "dami-landing-schema"
+LANDING_START_DATE_METADATA_KEY = "dami-start-date"
+LANDING_END_DATE_METADATA_KEY = "dami-end-date"
+
+BACKFILL_MAX_WORKERS = 4
+# one load job per partition; wider date ranges are deleted with DML,
+# which scans only the partitions of the range
+MAX_REPLACED_PARTITIONS = 62
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def _imap_bounded(
+    executor: ThreadPoolExecutor,
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    window: int,
+) -> Iterator[R]:
+    """
+    `executor.map` that keeps at most `window` tasks in flight,
+    so that finished results do not pile up in memory.
+    """
+    pending: deque[Future[R]] = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _row_hash_sql(columns: list[str], alias: str) -> str:
+    """
+    MD5 over the string form of `columns` of the table aliased `alias`.
+    """
+    parts = ", ".join(
+        f"IFNULL(CAST({alias}.{c} AS STRING), '{_HASH_NULL}')" for c in columns
+    )
+    return f"TO_HEX(MD5(ARRAY_TO_STRING([{parts}], '{_HASH_SEPARATOR}')))"
+
 
 @dataclass
 class MoneyForwardService:
     bq_handler: BQPolarsHandler
     gcs_handler: GCSHandler
     gcs_dir: GCSLocation
-    # I don't inject bq_table by DIContainer because
-    # this service depends on the specific table
-    bq_table: BQTable = field(init=False)
+    schema_registry: SchemaRegistry = field(default_factory=get_schema_registry)
 
-    def __post_init__(self):
-        columns = json.loads(
-            (PROJECT_ROOT / "bigquery/schema/moneyforward.json").read_text()
-        )
-        self.bq_table = BQTable(
-            project=GCP_PROJECT,
-            dataset="finance",
-            table="moneyforward",
-            fields=[BQField(**col) for col in columns],
+    # I don't inject bq_table by DIContainer because
+    # this service depends on the specific table.
+    # Looked up on every use, so that a changed schema file is picked up.
+    @property
+    def bq_table(self) -> BQTable:
+        return self.schema_registry.table(
+            "moneyforward", project=GCP_PROJECT, dataset="finance"
         )
 
-    def upload_csv_to_gcs(self, local_path: Path) -> None:
-        filename = local_path.name
-        loc = GCSLocation(
+    def csv_location(self, filename: str) -> GCSLocation:
+        return GCSLocation(
             bucket=self.gcs_dir.bucket,
             path=f"{self.gcs_dir.path}/{filename}",
         )
-        self.gcs_handler.upload_bytes(
-            data=local_path.read_bytes(),
-            loc=loc,
+
+    def landing_location(self, csv_blob: Blob) -> GCSLocation:
+        # next to the CSV, which may be outside of `gcs_dir`
+        assert csv_blob.bucket is not None and csv_blob.name is not None
+        return GCSLocation(
+            bucket=csv_blob.bucket.name, path=f"{csv_blob.name}{LANDING_SUFFIX}"
+        )
+
+    @property
+    def landing_schema_key(self) -> str:
+        """
+        Digest of the conversion; landing copies written with another one are stale.
+        """
+        fingerprint = table_schema(self.bq_table).fingerprint
+        conversion = json.dumps([COL_MAPPING, fingerprint], sort_keys=True)
+        return hashlib.md5(conversion.encode("utf-8")).hexdigest()
+
+    def _convert(self, df: pl.DataFrame) -> pl.DataFrame:
+        """
+        Rename the CSV columns and cast them to the table schema.
+        """
+        with span("mf.convert", rows=df.height):
+            return BQPolarsHandler.coerce_df(
+                df.rename(COL_MAPPING).with_columns(pl.col("transaction_date").str.to_date()),
+                self.bq_table,
+            )
+
+    @traced("mf.upload_csv_to_gcs")
+    def upload_csv_to_gcs(self, local_path: Path) -> Blob:
+        """
+        Upload the CSV unless GCS already has an object with the same CRC32C,
+        and write its landing copy unless a current one exists.
+        """
+        loc = self.csv_location(local_path.name)
+        blob = self.gcs_handler.find_blob(loc)
+        if blob is not None and blob.crc32c == file_crc32c(local_path):
+            logger.info(f"Skipped uploading {local_path}; unchanged at {loc.get_uri()}")
+            current_span().set(skipped=True)
+        else:
+            self.gcs_handler.upload_file(local_path=local_path, loc=loc)
+            logger.info(f"Uploaded {local_path} to GCS: {loc.get_uri()}")
+            blob = self.gcs_handler.get_blob(loc)
+        if self.find_landing_copy(blob) is None:
+            self.write_landing_copy(local_path, blob)
+        return blob
+
+    @traced("mf.write_landing_copy")
+    def write_landing_copy(self, local_path: Path, csv_blob: Blob) -> GCSLocation:
+        """
+        Convert the local CSV uploaded as `csv_blob` to zstd-compressed parquet
+        typed by the table schema, and upload it next to the CSV.
+        """
+        loc = self.landing_location(csv_blob)
+        assert csv_blob.crc32c is not None
+        metadata = {
+            LANDING_SOURCE_METADATA_KEY: csv_blob.crc32c,
+            LANDING_SCHEMA_METADATA_KEY: self.landing_schema_key,
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # transcoded chunk by chunk, so that polars reads UTF-8 from disk
+            # instead of decoding the whole file in memory
+            csv_path = Path(tmp_dir) / "utf8.csv"
+            with local_path.open("rb") as src, csv_path.open("wb") as dst:
+                chunks = iter(lambda: src.read(LANDING_TRANSCODE_CHUNK_SIZE), b"")
+                dst.writelines(transcode_to_utf8(chunks, MF_CSV_ENCODING))
+            df = self._convert(pl.read_csv(csv_path))
+            if df.height > 0:
+                metadata[LANDING_START_DATE_METADATA_KEY] = str(df["transaction_date"].min())
+                metadata[LANDING_END_DATE_METADATA_KEY] = str(df["transaction_date"].max())
+            path = Path(tmp_dir) / "landing.parquet"
+            df.write_parquet(path, compression=LANDING_COMPRESSION)
+            current_span().set(rows=df.height, bytes=path.stat().st_size)
+            self.gcs_handler.upload_file(local_path=path, loc=loc, metadata=metadata)
+        logger.info(f"Wrote the landing copy of {csv_blob.name} to {loc.get_uri()}")
+        return loc
+
+    def _is_current_landing_copy(self, landing: Blob, csv_blob: Blob) -> bool:
+        metadata = landing.metadata or {}
+        return (
+            csv_blob.crc32c is not None
+            and metadata.get(LANDING_SOURCE_METADATA_KEY) == csv_blob.crc32c
+            and metadata.get(LANDING_SCHEMA_METADATA_KEY) == self.landing_schema_key
+        )
+
+    def find_landing_copy(self, csv_blob: Blob) -> Blob | None:
+        """
+        The landing copy of `csv_blob`, if it was converted from its current content.
+        """
+        landing = self.gcs_handler.find_blob(self.landing_location(csv_blob))
+        if landing is None or not self._is_current_landing_copy(landing, csv_blob):
+            return None
+        return landing
+
+    @staticmethod
+    def _loaded_labels(blob: Blob) -> dict[str, str]:
+        # label values allow neither slashes nor dots; hash the object name
+        assert blob.name is not None
+        return {
+            LOADED_OBJECT_LABEL: hashlib.md5(blob.name.encode("utf-8")).hexdigest(),
+            LOADED_GENERATION_LABEL: str(blob.generation),
+        }
+
+    def _is_loaded(self, blob: Blob) -> bool:
+        """
+        Whether `blob` is the last CSV loaded into the table, at its current generation.
+        """
+        labels = self.bq_handler.get_labels(self.bq_table)
+        return all(labels.get(k) == v for k, v in self._loaded_labels(blob).items())
+
+    def _mark_loaded(self, blob: Blob) -> None:
+        self.bq_handler.update_labels(self.bq_table, self._loaded_labels(blob))
+
+    def _download_records(
+        self,
+        blob: Blob,
+        landing: Blob | None,
+        max_memory_bytes: int | None = None,
+    ) -> pl.DataFrame:
+        """
+        Rows of the CSV `blob`, read from its current landing copy if any.
+        """
+        if landing is not None:
+            current_span().set(landing=True)
+            return self.gcs_handler.download_df(
+                landing, str_encoding=None, max_memory_bytes=max_memory_bytes
+            )
+        df = self.gcs_handler.download_df(
+            blob, str_encoding=MF_CSV_ENCODING, max_memory_bytes=max_memory_bytes
         )
-        logger.info(f"Uploaded {local_path} to GCS: {loc.get_uri()}")
+        return self._convert(df)
+
+    @traced("mf.ingest_csv")
+    def ingest_csv(
+        self, local_path: Path, mode: IngestMode = "replace", force: bool = False
+    ) -> UpsertStats | None:
+        """
+        Upload a local CSV and load it into BQ.
+        Re-running with an unchanged file costs three metadata GETs, of the
+        CSV, of its landing copy and of the table, unless `force` is set.
+        """
+        blob = self.upload_csv_to_gcs(local_path)
+        return self.insert_csv_blob(blob, mode=mode, force=force)
 
-    def insert_latest_csv(self) -> None:
+    def insert_latest_csv(self, mode: IngestMode = "replace") -> UpsertStats | None:
         last_csv_path = self.gcs_handler.get_latest_blob(self.gcs_dir, suffix=".csv")
         if last_csv_path is None:
             raise FileNotFoundError(
                 f"No files found in GCS path: {self.gcs_dir.get_uri()}"
             )
-        df = self.gcs_handler.download_df(last_csv_path, str_encoding="shift-jis")
-        # update
-        df = df.rename(COL_MAPPING).with_columns(
-            pl.col("transaction_date").str.to_date()
+        return self.insert_csv_blob(last_csv_path, mode=mode)
+
+    @traced("mf.insert_csv_blob")
+    def insert_csv_blob(
+        self, blob: Blob, mode: IngestMode = "replace", force: bool = False
+    ) -> UpsertStats | None:
+        current_span().set(blob=blob.name, mode=mode)
+        if not force and self._is_loaded(blob):
+            logger.info(
+                f"Skipped loading {blob.name} (generation {blob.generation}); "
+                f"already loaded into {self.bq_table.get_bq_table_id()}"
+            )
+            current_span().set(skipped=True)
+            return None
+        landing = self.find_landing_copy(blob)
+        if mode == "replace" and landing is not None and self._replace_from_landing(landing):
+            self._mark_loaded(blob)
+            logger.info(f"Inserted {landing.name} into BigQuery from GCS")
+            return None
+        df = self._download_records(blob, landing)
+        if mode == "upsert":
+            stats = self.upsert_df(df)
+            self._mark_loaded(blob)
+            return stats
+        self.replace_date_range(df)
+        self._mark_loaded(blob)
+        logger.info("Inserted latest CSV data into BigQuery")
+        return None
+
+    def replace_date_range(self, df: pl.DataFrame) -> None:
+        """
+        Replace the rows of the table in the date range of `df`.
+        When the table is partitioned by date, the partitions of the range
+        are overwritten by load jobs; otherwise the range is deleted with DML
+        while the new rows are encoded, and loaded once the DELETE has succeeded.
+        """
+        start = cast(datetime.date, df["transaction_date"].min())
+        end = cast(datetime.date, df["transaction_date"].max())
+        table = self._live_table()
+        partition_ids = self._replaced_partitions(table, start, end)
+        if partition_ids is not None:
+            self.bq_handler.replace_partitions(df, table, partition_ids=partition_ids)
+            return
+        with BQJobScheduler(self.bq_handler) as jobs:
+            deleted = self._submit_delete_range(jobs, start, end)
+            # encoded while the DELETE runs; uploaded once it has succeeded
+            jobs.submit_load_df(df, self.bq_table, after=deleted)
+
+    def _replace_from_landing(self, landing: Blob) -> bool:
+        """
+        `replace_date_range` with the rows of a landing copy, which BQ loads
+        from GCS without them passing through the client. A load job takes the
+        whole file, so this applies only when the range is replaced with DML;
+        returns False when the partitions are to be replaced instead.
+        """
+        metadata = landing.metadata or {}
+        if LANDING_START_DATE_METADATA_KEY not in metadata:
+            return False
+        start = datetime.date.fromisoformat(metadata[LANDING_START_DATE_METADATA_KEY])
+        end = datetime.date.fromisoformat(metadata[LANDING_END_DATE_METADATA_KEY])
+        if self._replaced_partitions(self._live_table(), start, end) is not None:
+            return False
+        assert landing.bucket is not None and landing.name is not None
+        uri = GCSLocation(bucket=landing.bucket.name, path=landing.name).get_uri()
+        with BQJobScheduler(self.bq_handler) as jobs:
+            deleted = self._submit_delete_range(jobs, start, end)
+            jobs.submit_load_uri(uri, self.bq_table, after=deleted)
+        return True
+
+    def _live_table(self) -> BQTable:
+        """
+        `bq_table` with the partitioning of the table in BQ, which is kept
+        until the table is migrated (`scripts/migrate_partitioning.py`).
+        """
+        partitioning = self.bq_handler.get_time_partitioning(self.bq_table)
+        if partitioning == self.bq_table.time_partitioning:
+            return self.bq_table
+        return self.bq_table.model_copy(update={"time_partitioning": partitioning})
+
+    def _replaced_partitions(
+        self, table: BQTable, start: datetime.date, end: datetime.date
+    ) -> list[str] | None:
+        """
+        Partitions overwritten to replace the range; None when the range is
+        deleted with DML instead.
+        """
+        partitioning = table.time_partitioning
+        if partitioning is None or partitioning.field != "transaction_date":
+            return None
+        partition_ids = partitioning.partition_ids_between(start, end)
+        if len(partition_ids) > MAX_REPLACED_PARTITIONS:
+            return None
+        return partition_ids
+
+    def _submit_delete_range(
+        self, jobs: BQJobScheduler, start: datetime.date, end: datetime.date
+    ) -> Future[None]:
+        return jobs.submit_update_query(
+            f"DELETE FROM {self.bq_table.get_bq_table_id()} "
+            "WHERE transaction_date BETWEEN @start_date AND @end_date",
+            params={"start_date": start, "end_date": end},
         )
-        # delete old records
-        table_name = self.bq_table.get_bq_table_id()
-        self.bq_handler.run_update_query(
-            f"DELETE FROM {table_name} WHERE transaction_date BETWEEN @start_date AND @end_date",
-            params={
-                "start_date": cast(datetime.date, df["transaction_date"].min()),
-                "end_date": cast(datetime.date, df["transaction_date"].max()),
-            },
+
+    @traced("mf.backfill")
+    def backfill(
+        self,
+        prefix: GCSLocation | None = None,
+        max_workers: int = BACKFILL_MAX_WORKERS,
+        max_memory_bytes: int | None = None,
+    ) -> int:
+        """
+        Rebuild the table from every CSV under `prefix` (default: `gcs_dir`)
+        with a single WRITE_TRUNCATE load job.
+        CSVs are downloaded and parsed on `max_workers` threads, with at most
+        `max_workers` parsed files held besides the result. `max_memory_bytes`
+        is passed to `download_df`. Where date ranges overlap, the rows of the
+        most recently updated file win.
+        """
+        prefix = prefix or self.gcs_dir
+        blobs = sorted(
+            self.gcs_handler.list_blobs(prefix, suffix=".csv"),
+            key=lambda b: b.updated,
+            reverse=True,
         )
-        # delete the files
-        self.bq_handler.insert_df(df, self.bq_table)
-        logger.info("Inserted latest CSV data into BigQuery")
+        if len(blobs) == 0:
+            raise FileNotFoundError(f"No files found in GCS path: {prefix.get_uri()}")
+        # one listing instead of a metadata GET per CSV
+        landing_copies = {
+            b.name: b for b in self.gcs_handler.list_blobs(prefix, suffix=LANDING_SUFFIX)
+        }
+
+        def download(blob: Blob) -> pl.DataFrame:
+            landing = landing_copies.get(f"{blob.name}{LANDING_SUFFIX}")
+            if landing is not None and not self._is_current_landing_copy(landing, blob):
+                landing = None
+            return self._download_records(blob, landing, max_memory_bytes)
 
+        # date ranges already taken by newer files
+        covered: list[tuple[datetime.date, datetime.date]] = []
+        frames: list[pl.DataFrame] = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            parsed = _imap_bounded(
+                executor,
+                download,
+                blobs,
+                window=max_workers,
+            )
+            for blob, df in zip(blobs, parsed):
+                if df.height == 0:
+                    continue
+                start = cast(datetime.date, df["transaction_date"].min())
+                end = cast(datetime.date, df["transaction_date"].max())
+                for covered_start, covered_end in covered:
+                    df = df.filter(
+                        ~pl.col("transaction_date").is_between(covered_start, covered_end)
+                    )
+                covered.append((start, end))
+                logger.info(f"Backfill: {df.height} rows kept from {blob.name}")
+                frames.append(df)
+        df = pl.concat(frames)
+        current_span().set(n_blobs=len(blobs), rows=df.height)
+        self.bq_handler.insert_df(df, self.bq_table, write_disposition="WRITE_TRUNCATE")
+        logger.info(f"Backfilled {df.height} rows from {len(blobs)} files")
+        return df.height
+
+    @traced("mf.upsert_df")
+    def upsert_df(self, df: pl.DataFrame) -> UpsertStats:
+        """
+        Apply `df` to the table with a single MERGE.
+        `df` is loaded to a staging table and BQ compares its rows with the
+        table by a content hash keyed on `transaction_id`, so that only new or
+        changed rows are written. Rows in the date range of `df` that are
+        missing from it are deleted.
+        Each run stages into a new table, so concurrent upserts do not
+        overwrite each other's rows.
+        """
+        table_name = self.bq_table.get_bq_table_id()
+        staging_table = self.bq_table.model_copy(
+            update={
+                "table": f"{self.bq_table.table}_staging_{uuid.uuid4().hex}",
+                "time_partitioning": None,
+                "clustering_fields": None,
+            }
+        )
+        self.bq_handler.create_table(
+            staging_table,
+            exists_ok=False,
+            expires=datetime.datetime.now(datetime.UTC) + STAGING_TABLE_EXPIRATION,
+        )
+        try:
+            self.bq_handler.insert_df(df, staging_table)
+            update_set = ", ".join(f"{c} = S.{c}" for c in HASHED_COLUMNS)
+            merge_query = (
+                f"MERGE {table_name} T USING {staging_table.get_bq_table_id()} S "
+                f"ON T.{KEY_COLUMN} = S.{KEY_COLUMN} "
+                f"WHEN MATCHED AND {_row_hash_sql(HASHED_COLUMNS, 'T')} "
+                f"!= {_row_hash_sql(HASHED_COLUMNS, 'S')} THEN UPDATE SET {update_set} "
+                "WHEN NOT MATCHED THEN INSERT ROW "
+                "WHEN NOT MATCHED BY SOURCE "
+                "AND T.transaction_date BETWEEN @start_date AND @end_date THEN DELETE"
+            )
+            job = self.bq_handler.run_update_query(
+                merge_query,
+                params={
+                    "start_date": cast(datetime.date, df["transaction_date"].min()),
+                    "end_date": cast(datetime.date, df["transaction_date"].max()),
+                },
+            )
+        finally:
+            self.bq_handler.delete_table(staging_table)
+        dml_stats = job.dml_stats
+        inserted = dml_stats.inserted_row_count if dml_stats is not None else 0
+        updated = dml_stats.updated_row_count if dml_stats is not None else 0
+        stats = UpsertStats(
+            inserted=inserted,
+            updated=updated,
+            unchanged=df.height - inserted - updated,
+            deleted=dml_stats.deleted_row_count if dml_stats is not None else 0,
+        )
+        current_span().set(
+            inserted=stats.inserted,
+            updated=stats.updated,
+            unchanged=stats.unchanged,
+            deleted=stats.deleted,
+        )
+        logger.info(f"Upserted latest CSV data into {table_name}: {stats}")
+        return stats
 
 
@@ -5,4 +5,8 @@ from typing import Final
 PROJECT_ROOT: Final[Path] = Path(__file__).parent.parent.parent
 GCP_PROJECT: Final[str] = "strange-oxide-138404"
 GS_BUCKET: Final[str] = "whiro-dami-storage"
-SERVICE_ACCOUNT_PATH: Final[Path] = PROJECT_ROOT / "terraform/.secrets/runner-service-account-key.json"
\ No newline at end of file
+SERVICE_ACCOUNT_PATH: Final[Path] = PROJECT_ROOT / "terraform/.secrets/runner-service-account-key.json"
+BQ_SCHEMA_DIR: Final[Path] = PROJECT_ROOT / "bigquery/schema"
+BQ_TABLE_OPTIONS_DIR: Final[Path] = PROJECT_ROOT / "bigquery/options"
+# local parquet copies of BQ tables made by `dami.ext.mirror.TableMirror`
+BQ_MIRROR_DIR: Final[Path] = PROJECT_ROOT / ".cache/bq_mirror"
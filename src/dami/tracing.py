@@ -0,0 +1,193 @@
+"""
+Timed spans around the hot paths of the handlers and services.
+
+Tracing is off until an exporter is configured:
+
+    configure_tracing(JsonLinesExporter(Path("trace.jsonl")))
+
+While it is off, `span` returns a shared no-op and `traced` calls straight through.
+"""
+
+import contextvars
+import functools
+import itertools
+import json
+import threading
+import time
+from collections.abc import Callable, Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import ParamSpec, Protocol, TypeVar
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+AttributeValue = str | int | float | bool | None
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: int
+    parent_id: int | None
+    thread: str
+    # wall-clock start, for ordering spans of different processes
+    start_time: float
+    duration_seconds: float = 0.0
+    attributes: dict[str, AttributeValue] = field(default_factory=dict)
+    error: str | None = None
+
+    def set(self, **attributes: AttributeValue) -> None:
+        self.attributes.update(attributes)
+
+
+class _NoopSpan:
+    """
+    Stands in for `Span` while tracing is off.
+    """
+
+    def set(self, **attributes: AttributeValue) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class SpanExporter(Protocol):
+    def export(self, span: Span) -> None: ...
+
+
+@dataclass
+class InMemoryExporter:
+    spans: list[Span] = field(default_factory=list)
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def find(self, name: str) -> list[Span]:
+        with self._lock:
+            return [span for span in self.spans if span.name == name]
+
+
+@dataclass
+class JsonLinesExporter:
+    """
+    Appends one JSON object per finished span to `path`.
+    """
+
+    path: Path
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(asdict(span), ensure_ascii=False, default=str)
+        with self._lock, self.path.open("a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+_exporter: SpanExporter | None = None
+_span_ids = itertools.count(1)
+_current_span: ContextVar[Span | None] = ContextVar("dami_current_span", default=None)
+
+
+def configure_tracing(exporter: SpanExporter | None) -> None:
+    """
+    Start exporting spans to `exporter`; None turns tracing off.
+    """
+    global _exporter
+    _exporter = exporter
+
+
+def tracing_enabled() -> bool:
+    return _exporter is not None
+
+
+def current_span() -> Span | _NoopSpan:
+    """
+    The innermost open span of this thread, to attach attributes to.
+    """
+    if _exporter is None:
+        return _NOOP_SPAN
+    return _current_span.get() or _NOOP_SPAN
+
+
+@contextmanager
+def _record(name: str, attributes: dict[str, AttributeValue]) -> Generator[Span]:
+    parent = _current_span.get()
+    span = Span(
+        name=name,
+        span_id=next(_span_ids),
+        parent_id=parent.span_id if parent is not None else None,
+        thread=threading.current_thread().name,
+        start_time=time.time(),
+        attributes=attributes,
+    )
+    token = _current_span.set(span)
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span.error = type(e).__name__
+        raise
+    finally:
+        span.duration_seconds = time.perf_counter() - started
+        _current_span.reset(token)
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(span)
+
+
+class _NoopContext:
+    def __enter__(self) -> _NoopSpan:
+        return _NOOP_SPAN
+
+    def __exit__(self, *exc_info: object) -> None:
+        pass
+
+
+_NOOP_CONTEXT = _NoopContext()
+
+
+def span(name: str, **attributes: AttributeValue):
+    """
+    `with span("gcs.download", bytes=n) as s: ...` times the block.
+    """
+    if _exporter is None:
+        return _NOOP_CONTEXT
+    return _record(name, attributes)
+
+
+def in_current_context[**P, R](
+    fn: Callable[P, R], /, *args: P.args, **kwargs: P.kwargs
+) -> Callable[[], R]:
+    """
+    `fn(*args, **kwargs)` bound to a copy of the current context, to be run on
+    another thread with the spans it opens nested under the current one.
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, fn, *args, **kwargs)
+
+
+def traced(name: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """
+    Wrap a method in a span; attach attributes with `current_span().set(...)`.
+    """
+
+    def decorator(fn: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(fn)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            if _exporter is None:
+                return fn(*args, **kwargs)
+            with _record(name, {}):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
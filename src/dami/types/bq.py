@@ -1,7 +1,8 @@
+from collections.abc import Mapping
 import datetime
 import re
-from typing import Literal, Self
-from pydantic import BaseModel, field_validator, model_validator
+from typing import Any, Literal, Self
+from pydantic import BaseModel, PrivateAttr, field_validator, model_validator
 
 import polars as pl
 
@@ -25,10 +26,26 @@ PolarsTypeForBQ = (
 )
 
 PythonTypeForBQ = str | int | float | bool | datetime.datetime | datetime.date
+# query parameter values; lists become ARRAY and mappings STRUCT parameters
+QueryParamValue = (
+    PythonTypeForBQ | list["QueryParamValue"] | Mapping[str, "QueryParamValue"]
+)
 
 
 BQQuery = str
 
+TimePartitioningType = Literal["HOUR", "DAY", "MONTH", "YEAR"]
+
+# strftime format of the partition decorator (`table$20260101`) of each type
+PARTITION_ID_FORMATS: dict[TimePartitioningType, str] = {
+    "HOUR": "%Y%m%d%H",
+    "DAY": "%Y%m%d",
+    "MONTH": "%Y%m",
+    "YEAR": "%Y",
+}
+# the partition of rows whose partitioning column is NULL
+NULL_PARTITION_ID = "__NULL__"
+
 
 class BQField(BaseModel):
     name: str
@@ -52,11 +69,61 @@ class BQField(BaseModel):
         return self
 
 
+class BQTimePartitioning(BaseModel):
+    # None partitions by ingestion time
+    field: str | None = None
+    type: TimePartitioningType = "DAY"
+    expiration_ms: int | None = None
+    require_partition_filter: bool = False
+
+    def partition_id(self, value: datetime.date | None) -> str:
+        if value is None:
+            return NULL_PARTITION_ID
+        return value.strftime(PARTITION_ID_FORMATS[self.type])
+
+    def partition_id_expr(self, column: pl.Expr | None = None) -> pl.Expr:
+        """
+        Partition decorator of each row; `column` defaults to the partitioning column.
+        """
+        if column is None:
+            if self.field is None:
+                raise ValueError("An ingestion-time partitioned table has no partitioning column")
+            column = pl.col(self.field)
+        return (
+            column.dt.strftime(PARTITION_ID_FORMATS[self.type])
+            .fill_null(NULL_PARTITION_ID)
+        )
+
+    def partition_ids_between(self, start: datetime.date, end: datetime.date) -> list[str]:
+        """
+        Decorators of the partitions holding the days from `start` to `end`.
+        """
+        if self.type == "HOUR":
+            raise ValueError("Hourly partitions cannot be derived from dates")
+        ids: dict[str, None] = {}
+        for i in range((end - start).days + 1):
+            ids[self.partition_id(start + datetime.timedelta(days=i))] = None
+        return list(ids)
+
+
+class BQTableOptions(BaseModel):
+    """
+    Table options stored next to the schemas, in `bigquery/options/<name>.json`.
+    """
+
+    time_partitioning: BQTimePartitioning | None = None
+    clustering_fields: list[str] | None = None
+
+
 class BQTable(BaseModel):
     project: str
     dataset: str
     table: str
     fields: list[BQField]
+    time_partitioning: BQTimePartitioning | None = None
+    clustering_fields: list[str] | None = None
+    # derived schemas memoized by `dami.ext.bq_schema.table_schema`
+    _schema: Any = PrivateAttr(default=None)
 
     @field_validator("table")
     def validate_table_name(cls, v: str) -> str:
@@ -67,6 +134,37 @@ class BQTable(BaseModel):
             )
         return v
 
+    @model_validator(mode="after")
+    def check_table_options(self) -> Self:
+        fields = {field.name: field for field in self.fields}
+        partitioning = self.time_partitioning
+        if partitioning is not None and partitioning.field is not None:
+            field = fields.get(partitioning.field)
+            if field is None or field.mode == "REPEATED":
+                raise ValueError(f"Partitioning column {partitioning.field} is not in the table")
+            allowed = ("TIMESTAMP",) if partitioning.type == "HOUR" else ("DATE", "TIMESTAMP")
+            if field.type not in allowed:
+                raise ValueError(
+                    f"Cannot partition by {partitioning.type} on {field.type} column {field.name}"
+                )
+        if self.clustering_fields is not None:
+            # BQ allows up to four top-level, non-repeated clustering columns
+            if len(self.clustering_fields) > 4:
+                raise ValueError("At most 4 clustering fields are allowed")
+            for name in self.clustering_fields:
+                field = fields.get(name)
+                if field is None or field.mode == "REPEATED" or field.type == "RECORD":
+                    raise ValueError(f"Cannot cluster by {name}")
+        return self
+
+    def model_copy(
+        self, *, update: Mapping[str, Any] | None = None, deep: bool = False
+    ) -> Self:
+        # a copy may differ in name or fields; it derives its own schemas
+        copy = super().model_copy(update=update, deep=deep)
+        copy._schema = None
+        return copy
+
     def get_bq_table_id(self) -> str:
         return f"`{self.project}.{self.dataset}.{self.table}`"
 
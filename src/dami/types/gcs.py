@@ -0,0 +1,20 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class GCSLocation:
+    bucket: str
+    path: str
+
+    def get_uri(self) -> str:
+        return f"gs://{self.bucket}/{self.path}"
+
+    @classmethod
+    def from_uri(cls, uri: str) -> "GCSLocation":
+        if not uri.startswith("gs://"):
+            raise ValueError(f"Invalid GCS URI: {uri}")
+        bucket_name, blob_name = uri[5:].split("/", 1)
+        return cls(bucket=bucket_name, path=blob_name)
+
+
+GCSPath = str | GCSLocation
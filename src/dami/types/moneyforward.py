@@ -0,0 +1,14 @@
+from dataclasses import dataclass
+from typing import Literal
+
+# "replace": delete the CSV's date range and reload every row
+# "upsert": MERGE only new or changed rows
+IngestMode = Literal["replace", "upsert"]
+
+
+@dataclass(frozen=True)
+class UpsertStats:
+    inserted: int
+    updated: int
+    unchanged: int
+    deleted: int
@@ -0,0 +1,834 @@
+import base64
+import datetime
+import fnmatch
+import re
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import BinaryIO, Self, cast
+
+import google_crc32c
+import polars as pl
+import pyarrow as pa
+import requests
+from dependency_injector import providers
+from google.api_core.exceptions import (
+    BadRequest,
+    Conflict,
+    NotFound,
+    PreconditionFailed,
+)
+from google.cloud import bigquery as bq
+from google.cloud.bigquery.client import _DEFAULT_CHUNKSIZE
+from google.cloud.bigquery_storage_v1 import types as bqs_types
+
+from dami.container import DIContainer
+from dami.ext.bq_schema import table_schema
+from dami.types.bq import BQField, BQTable, BQTimePartitioning
+
+
+@dataclass
+class _FakeWriteStream:
+    table: str
+    type_: bqs_types.WriteStream.Type
+    batches: list[pa.RecordBatch] = field(default_factory=list)
+    finalized: bool = False
+
+
+class FakeBigQueryWriteClient:
+    """
+    In-memory stand-in for `BigQueryWriteClient` that accepts Arrow rows.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._streams: dict[str, _FakeWriteStream] = {}
+        self.tables: dict[str, list[pa.RecordBatch]] = {}
+
+    def create_write_stream(
+        self, parent: str, write_stream: bqs_types.WriteStream
+    ) -> bqs_types.WriteStream:
+        with self._lock:
+            name = f"{parent}/streams/{len(self._streams)}"
+            self._streams[name] = _FakeWriteStream(
+                table=parent, type_=write_stream.type_
+            )
+        return bqs_types.WriteStream(name=name, type_=write_stream.type_)
+
+    def append_rows(
+        self,
+        requests: Iterable[bqs_types.AppendRowsRequest],
+        metadata: tuple[tuple[str, str], ...] = (),
+    ) -> Iterator[bqs_types.AppendRowsResponse]:
+        schema: pa.Schema | None = None
+        for request in requests:
+            stream = self._streams[request.write_stream]
+            assert not stream.finalized
+            assert request.offset == sum(b.num_rows for b in stream.batches)
+            if request.arrow_rows.writer_schema.serialized_schema:
+                schema = pa.ipc.read_schema(
+                    pa.py_buffer(request.arrow_rows.writer_schema.serialized_schema)
+                )
+            assert schema is not None, "the first request must carry the schema"
+            batch = pa.ipc.read_record_batch(
+                pa.py_buffer(request.arrow_rows.rows.serialized_record_batch), schema
+            )
+            stream.batches.append(batch)
+            if stream.type_ == bqs_types.WriteStream.Type.COMMITTED:
+                self._commit(stream, [batch])
+            yield bqs_types.AppendRowsResponse()
+
+    def finalize_write_stream(self, name: str) -> None:
+        self._streams[name].finalized = True
+
+    def batch_commit_write_streams(
+        self, request: bqs_types.BatchCommitWriteStreamsRequest
+    ) -> bqs_types.BatchCommitWriteStreamsResponse:
+        for name in request.write_streams:
+            stream = self._streams[name]
+            assert stream.finalized
+            self._commit(stream, stream.batches)
+        return bqs_types.BatchCommitWriteStreamsResponse()
+
+    def _commit(self, stream: _FakeWriteStream, batches: list[pa.RecordBatch]) -> None:
+        with self._lock:
+            self.tables.setdefault(stream.table, []).extend(batches)
+
+    def read_table(self, parent: str) -> pl.DataFrame:
+        return cast(
+            pl.DataFrame, pl.from_arrow(pa.Table.from_batches(self.tables[parent]))
+        )
+
+
+@dataclass
+class _FakeObject:
+    data: bytes
+    generation: int
+    updated: datetime.datetime
+    metadata: dict[str, str] | None = None
+
+
+class FakeBlob:
+    """
+    Stand-in for `storage.Blob`; properties are loaded from the bucket
+    like a real blob after `reload`.
+    """
+
+    def __init__(self, bucket: "FakeBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.generation: int | None = None
+        self.size: int | None = None
+        self.updated: datetime.datetime | None = None
+        self.crc32c: str | None = None
+        self.metadata: dict[str, str] | None = None
+
+    @property
+    def _client(self) -> "FakeStorageClient":
+        return self.bucket.client
+
+    def _load(self, obj: _FakeObject) -> Self:
+        self.generation = obj.generation
+        self.size = len(obj.data)
+        self.updated = obj.updated
+        self.crc32c = base64.b64encode(
+            google_crc32c.value(obj.data).to_bytes(4, "big")
+        ).decode("ascii")
+        self.metadata = dict(obj.metadata) if obj.metadata is not None else None
+        return self
+
+    def _object(self) -> _FakeObject:
+        self._client.n_requests += 1
+        obj = self._client.objects.get((self.bucket.name, self.name))
+        if obj is None:
+            raise NotFound(f"{self.bucket.name}/{self.name}")
+        return obj
+
+    def _read(self, timeout: float | None) -> _FakeObject:
+        """
+        `_object` behind the latency and errors injected into the client.
+        """
+        self._client.inject_read_fault(timeout)
+        return self._object()
+
+    def reload(self, timeout: float | None = None, **kwargs) -> None:
+        self._load(self._read(timeout))
+
+    def exists(self) -> bool:
+        return (self.bucket.name, self.name) in self._client.objects
+
+    def download_as_bytes(
+        self,
+        start: int | None = None,
+        end: int | None = None,
+        if_generation_match: int | None = None,
+        timeout: float | None = None,
+        **kwargs,
+    ) -> bytes:
+        obj = self._read(timeout)
+        if if_generation_match is not None and obj.generation != if_generation_match:
+            raise PreconditionFailed(f"{self.bucket.name}/{self.name}")
+        data = obj.data[start or 0 : (end + 1 if end is not None else None)]
+        if self._client.read_bytes_per_second is not None:
+            time.sleep(len(data) / self._client.read_bytes_per_second)
+        self._client.bytes_downloaded += len(data)
+        return data
+
+    def upload_from_string(self, data: bytes | str, **kwargs) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._load(
+            self._client.put_object(self.bucket.name, self.name, data, self.metadata)
+        )
+
+    def upload_from_file(self, f: BinaryIO, size: int | None = None, **kwargs) -> None:
+        self.upload_from_string(f.read(size) if size is not None else f.read())
+
+    def upload_from_filename(self, filename: str | Path, **kwargs) -> None:
+        self.upload_from_string(Path(filename).read_bytes())
+
+    def compose(self, sources: list["FakeBlob"], **kwargs) -> None:
+        data = b"".join(source._object().data for source in sources)
+        self.upload_from_string(data)
+
+    def patch(self) -> None:
+        obj = self._object()
+        obj.metadata = dict(self.metadata) if self.metadata is not None else None
+
+    def delete(self) -> None:
+        self._object()
+        with self._client._lock:
+            del self._client.objects[(self.bucket.name, self.name)]
+
+
+@dataclass
+class FakeBucket:
+    client: "FakeStorageClient"
+    name: str
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str, **kwargs) -> FakeBlob | None:
+        blob = FakeBlob(self, name)
+        try:
+            blob.reload(**kwargs)
+        except NotFound:
+            return None
+        return blob
+
+
+class FakeStorageClient:
+    """
+    In-memory stand-in for `storage.Client`.
+    Counts requests and the payload bytes moved in each direction.
+
+    Reads sleep for `read_latency()` seconds, failing with a timeout when
+    that exceeds the request's timeout, and raise the errors queued in
+    `read_errors` first. With `read_bytes_per_second`, downloads also take
+    time in proportion to their payload.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.objects: dict[tuple[str, str], _FakeObject] = {}
+        self._generation = 0
+        self.n_requests = 0
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.read_latency: Callable[[], float] | None = None
+        self.read_bytes_per_second: float | None = None
+        self.read_errors: deque[BaseException] = deque()
+
+    def inject_read_fault(self, timeout: float | None) -> None:
+        with self._lock:
+            error = self.read_errors.popleft() if self.read_errors else None
+        if error is not None:
+            self.n_requests += 1
+            raise error
+        latency = self.read_latency() if self.read_latency is not None else 0.0
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            self.n_requests += 1
+            raise requests.exceptions.ReadTimeout(f"no response within {timeout}s")
+        time.sleep(latency)
+
+    def put_object(
+        self,
+        bucket: str,
+        name: str,
+        data: bytes,
+        metadata: dict[str, str] | None = None,
+    ) -> _FakeObject:
+        with self._lock:
+            self._generation += 1
+            self.n_requests += 1
+            self.bytes_uploaded += len(data)
+            obj = _FakeObject(
+                data=data,
+                generation=self._generation,
+                updated=datetime.datetime.now(datetime.UTC),
+                metadata=dict(metadata) if metadata is not None else None,
+            )
+            self.objects[(bucket, name)] = obj
+        return obj
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self, name)
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        self.n_requests += 1
+        return FakeBucket(self, name)
+
+    def list_blobs(
+        self,
+        bucket: FakeBucket | str,
+        prefix: str | None = None,
+        start_offset: str | None = None,
+        match_glob: str | None = None,
+        **kwargs,
+    ) -> Iterator[FakeBlob]:
+        bucket = bucket if isinstance(bucket, FakeBucket) else self.bucket(bucket)
+        self.n_requests += 1
+        with self._lock:
+            objects = sorted(
+                (name, obj)
+                for (bucket_name, name), obj in self.objects.items()
+                if bucket_name == bucket.name
+            )
+        for name, obj in objects:
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            if start_offset is not None and name < start_offset:
+                continue
+            if match_glob is not None and not fnmatch.fnmatchcase(name, match_glob):
+                continue
+            yield FakeBlob(bucket, name)._load(obj)
+
+
+_TABLE_ID_PATTERN = re.compile(r"`?([\w-]+\.[\w-]+\.[\w-]+)`?")
+_PARTITIONS_VIEW_PATTERN = re.compile(
+    r"`?([\w-]+\.[\w-]+)\.INFORMATION_SCHEMA\.PARTITIONS`?", re.IGNORECASE
+)
+_STATEMENT_SEPARATOR = re.compile(r";\s*(?:\n|$)")
+_DELETE_PATTERN = re.compile(
+    r"^\s*DELETE\s+FROM\s+(\S+)\s+WHERE\s+(.*)$", re.IGNORECASE | re.DOTALL
+)
+
+
+def _sql_literal(value: object) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return f"CAST('{value.isoformat()}' AS TIMESTAMP)"
+    if isinstance(value, datetime.date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, str):
+        escaped = value.replace("'", "''")
+        return f"'{escaped}'"
+    raise NotImplementedError(f"Unsupported query parameter value: {value!r}")
+
+
+@dataclass
+class FakeQueryJob:
+    job_id: str
+    table: pa.Table | None
+
+    def done(self, retry=None) -> bool:
+        return True
+
+    def result(self, timeout=None, retry=None) -> Self:
+        return self
+
+    def to_arrow(self, bqstorage_client=None, **kwargs) -> pa.Table:
+        assert self.table is not None, "DML jobs have no result"
+        return self.table
+
+    def to_arrow_iterable(
+        self, bqstorage_client=None, **kwargs
+    ) -> Iterator[pa.RecordBatch]:
+        yield from self.to_arrow().to_batches()
+
+
+@dataclass
+class FakeLoadJob:
+    job_id: str
+    destination: str
+
+    def done(self, retry=None) -> bool:
+        return True
+
+    def result(self, timeout=None, retry=None) -> Self:
+        return self
+
+
+class FakeResumableUpload:
+    """
+    Stand-in for the `ResumableUpload` of a load job. Like the real one, each
+    chunk is read in full before it is sent, and a short chunk ends the
+    upload and starts the job.
+    """
+
+    def __init__(
+        self,
+        client: "FakeBigQueryClient",
+        stream: BinaryIO,
+        job_resource: dict,
+        chunk_size: int,
+    ) -> None:
+        self._client = client
+        self._stream = stream
+        self._job_resource = job_resource
+        self._chunk_size = chunk_size
+        self._chunks: list[bytes] = []
+        self.finished = False
+
+    def transmit_next_chunk(self, transport, timeout=None) -> SimpleNamespace:
+        chunk = self._stream.read(self._chunk_size)
+        self._client.upload_chunk_sizes.append(len(chunk))
+        if self._client.upload_bytes_per_second is not None:
+            time.sleep(len(chunk) / self._client.upload_bytes_per_second)
+        self._chunks.append(chunk)
+        if len(chunk) == self._chunk_size:
+            return SimpleNamespace(status_code=308)
+        self.finished = True
+        data = b"".join(self._chunks)
+        configuration = self._job_resource["configuration"]
+        table = configuration["load"]["destinationTable"]
+        destination = f"{table['projectId']}.{table['datasetId']}.{table['tableId']}"
+        job = self._client._load_uploaded(
+            data,
+            destination,
+            cast(bq.LoadJobConfig, bq.LoadJobConfig.from_api_repr(configuration)),
+        )
+        resource = {"jobReference": {"jobId": job.job_id}}
+        return SimpleNamespace(status_code=200, json=lambda: resource)
+
+
+class FakeBigQueryClient:
+    """
+    In-memory stand-in for `bigquery.Client`; tables are Polars DataFrames.
+
+    Queries run on the Polars SQL engine after inlining the query parameters,
+    so only the BigQuery SQL that Polars also understands is supported.
+    `DELETE FROM t WHERE cond` is run as a SELECT of the remaining rows, and
+    multi-statement scripts are split at semicolons ending a line.
+    `<dataset>.INFORMATION_SCHEMA.PARTITIONS` is computed from the tables.
+    Loaded Parquet files are parsed when the table is next read, so that
+    a load costs the caller only the upload; loads into a partition
+    decorator (`table$20260101`) are parsed at once.
+    Loads from `gs://` URIs read the objects of `storage`.
+    """
+
+    def __init__(self, storage: FakeStorageClient | None = None) -> None:
+        self.storage = storage
+        # reentrant so that a partition load can read the table it replaces
+        self._lock = threading.RLock()
+        self._tables: dict[str, pl.DataFrame] = {}
+        self._partitioning: dict[str, BQTimePartitioning] = {}
+        # partition id -> (rows digest, last modified), for INFORMATION_SCHEMA.PARTITIONS
+        self._partition_versions: dict[
+            str, dict[str, tuple[int, datetime.datetime]]
+        ] = {}
+        self._pending_loads: dict[str, list[bytes]] = {}
+        self.modified: dict[str, datetime.datetime] = {}
+        self.labels: dict[str, dict[str, str]] = {}
+        self.queries: list[str] = []
+        self.bytes_loaded = 0
+        # sizes of the load job upload chunks read so far
+        self.upload_chunk_sizes: list[int] = []
+        self._load_jobs: dict[str, FakeLoadJob] = {}
+        self.location: str | None = None
+        self.bytes_fetched = 0
+        self._n_jobs = 0
+        # simulated bandwidth of load job uploads; None reads the file at once
+        self.upload_bytes_per_second: float | None = None
+
+    def _job_id(self) -> str:
+        with self._lock:
+            self._n_jobs += 1
+            return f"fake-job-{self._n_jobs}"
+
+    def _set_table(self, table_id: str, df: pl.DataFrame) -> None:
+        with self._lock:
+            self._tables[table_id] = df
+            self._pending_loads.pop(table_id, None)
+            self.modified[table_id] = datetime.datetime.now(datetime.UTC)
+
+    def read_table(self, table_id: str) -> pl.DataFrame:
+        table_id = table_id.strip("`")
+        with self._lock:
+            if table_id not in self._tables:
+                raise NotFound(table_id)
+            pending = self._pending_loads.pop(table_id, [])
+            if pending:
+                self._tables[table_id] = pl.concat(
+                    [
+                        self._tables[table_id],
+                        *(pl.read_parquet(data) for data in pending),
+                    ],
+                    how="vertical_relaxed",
+                )
+            return self._tables[table_id]
+
+    def create_table(self, table: BQTable | bq.Table, exists_ok: bool = False) -> None:
+        if isinstance(table, bq.Table):
+            partitioning = table.time_partitioning
+            table = BQTable(
+                project=table.project,
+                dataset=table.dataset_id,
+                table=table.table_id,
+                fields=[BQField.model_validate(f.to_api_repr()) for f in table.schema],
+                time_partitioning=(
+                    BQTimePartitioning(
+                        field=partitioning.field, type=partitioning.type_
+                    )
+                    if partitioning is not None
+                    else None
+                ),
+            )
+        table_id = f"{table.project}.{table.dataset}.{table.table}"
+        if table_id in self._tables:
+            if exists_ok:
+                return
+            raise Conflict(table_id)
+        if table.time_partitioning is not None:
+            self._partitioning[table_id] = table.time_partitioning
+        self.labels[table_id] = {}
+        schema = table_schema(table).arrow_schema
+        self._set_table(
+            table_id, cast(pl.DataFrame, pl.from_arrow(schema.empty_table()))
+        )
+
+    def get_table(self, table_id: str) -> SimpleNamespace:
+        table_id = table_id.strip("`")
+        if table_id not in self._tables:
+            raise NotFound(table_id)
+        partitioning = self._partitioning.get(table_id)
+        return SimpleNamespace(
+            modified=self.modified[table_id],
+            labels=dict(self.labels[table_id]),
+            time_partitioning=(
+                bq.TimePartitioning(type_=partitioning.type, field=partitioning.field)
+                if partitioning is not None
+                else None
+            ),
+            require_partition_filter=None,
+        )
+
+    def update_table(self, table: bq.Table, fields: list[str]) -> bq.Table:
+        table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        if table_id not in self._tables:
+            raise NotFound(table_id)
+        if "labels" in fields:
+            # patch semantics: labels set to None are removed
+            for key, value in table.labels.items():
+                if value is None:
+                    self.labels[table_id].pop(key, None)
+                else:
+                    self.labels[table_id][key] = value
+        return table
+
+    def delete_table(self, table_id: str, not_found_ok: bool = False) -> None:
+        table_id = table_id.strip("`")
+        with self._lock:
+            if table_id not in self._tables:
+                if not_found_ok:
+                    return
+                raise NotFound(table_id)
+            del self._tables[table_id]
+            self._partitioning.pop(table_id, None)
+            self._partition_versions.pop(table_id, None)
+            self._pending_loads.pop(table_id, None)
+            self.labels.pop(table_id, None)
+
+    def load_table_from_file(
+        self,
+        file_obj: BinaryIO,
+        destination: str,
+        project: str | None = None,
+        job_config: bq.LoadJobConfig | None = None,
+        **kwargs,
+    ) -> FakeLoadJob:
+        assert job_config is not None
+        configuration = job_config.to_api_repr()
+        configuration["load"]["destinationTable"] = bq.TableReference.from_string(
+            destination
+        ).to_api_repr()
+        upload, transport = self._initiate_resumable_upload(
+            file_obj, {"configuration": configuration}, None, None, project=project
+        )
+        while not upload.finished:
+            response = upload.transmit_next_chunk(transport)
+        return self.job_from_resource(response.json())
+
+    def _initiate_resumable_upload(
+        self,
+        stream: BinaryIO,
+        metadata: dict,
+        num_retries: int | None,
+        timeout: float | None,
+        project: str | None = None,
+    ) -> tuple[FakeResumableUpload, None]:
+        # uploaded in chunks of the real client's size unless the caller changes it
+        return FakeResumableUpload(self, stream, metadata, _DEFAULT_CHUNKSIZE), None
+
+    def job_from_resource(self, resource: dict) -> FakeLoadJob:
+        return self._load_jobs.pop(resource["jobReference"]["jobId"])
+
+    def _load_uploaded(
+        self, data: bytes, destination: str, job_config: bq.LoadJobConfig
+    ) -> FakeLoadJob:
+        self.bytes_loaded += len(data)
+        job = self._load(data, destination, job_config)
+        self._load_jobs[job.job_id] = job
+        return job
+
+    def load_table_from_uri(
+        self,
+        source_uris: str,
+        destination: str,
+        project: str | None = None,
+        job_config: bq.LoadJobConfig | None = None,
+        **kwargs,
+    ) -> FakeLoadJob:
+        # copied within GCP; no bytes cross the client's network
+        assert self.storage is not None and source_uris.startswith("gs://")
+        bucket, _, name = source_uris[len("gs://") :].partition("/")
+        obj = self.storage.objects.get((bucket, name))
+        if obj is None:
+            raise NotFound(source_uris)
+        return self._load(obj.data, destination, job_config)
+
+    def _load(
+        self, data: bytes, destination: str, job_config: bq.LoadJobConfig | None
+    ) -> FakeLoadJob:
+        assert (
+            job_config is not None
+            and job_config.source_format == bq.SourceFormat.PARQUET
+        )
+        destination, _, partition_id = destination.partition("$")
+        if destination not in self._tables:
+            raise NotFound(destination)
+        if partition_id:
+            self._load_partition(destination, partition_id, data, job_config)
+            return FakeLoadJob(job_id=self._job_id(), destination=destination)
+        with self._lock:
+            if job_config.write_disposition == "WRITE_TRUNCATE":
+                self._tables[destination] = self._tables[destination].clear()
+                self._pending_loads[destination] = [data]
+            else:
+                self._pending_loads.setdefault(destination, []).append(data)
+            self.modified[destination] = datetime.datetime.now(datetime.UTC)
+        return FakeLoadJob(job_id=self._job_id(), destination=destination)
+
+    def _load_partition(
+        self,
+        table_id: str,
+        partition_id: str,
+        data: bytes,
+        job_config: bq.LoadJobConfig,
+    ) -> None:
+        partitioning = self._partitioning.get(table_id)
+        if partitioning is None or partitioning.field is None:
+            raise BadRequest(f"{table_id} is not partitioned by a column")
+        is_in_partition = partitioning.partition_id_expr() == partition_id
+        loaded = pl.read_parquet(data)
+        if not loaded.select(is_in_partition.all()).item() and loaded.height > 0:
+            raise BadRequest(f"Rows outside of partition {partition_id} of {table_id}")
+        with self._lock:
+            current = self.read_table(table_id)
+            if job_config.write_disposition == "WRITE_TRUNCATE":
+                current = current.filter(~is_in_partition)
+            self._set_table(
+                table_id, pl.concat([current, loaded], how="vertical_relaxed")
+            )
+
+    def _partitions_view(self, dataset_id: str) -> pl.DataFrame:
+        """
+        `INFORMATION_SCHEMA.PARTITIONS` of the column-partitioned tables of
+        `dataset_id`. A partition is modified when its rows' hash changes
+        between two reads of the view.
+        """
+        now = datetime.datetime.now(datetime.UTC)
+        rows: list[dict] = []
+        with self._lock:
+            for table_id, partitioning in self._partitioning.items():
+                if (
+                    not table_id.startswith(f"{dataset_id}.")
+                    or partitioning.field is None
+                ):
+                    continue
+                df = self.read_table(table_id)
+                known = self._partition_versions.get(table_id, {})
+                versions: dict[str, tuple[int, datetime.datetime]] = {}
+                for (partition_id,), part in (
+                    df.with_columns(
+                        partitioning.partition_id_expr().alias("__partition_id")
+                    )
+                    .partition_by("__partition_id", as_dict=True, include_key=False)
+                    .items()
+                ):
+                    # order-insensitive digest of the partition's rows
+                    digest = sum(part.hash_rows().to_list()) % 2**64
+                    previous = known.get(cast(str, partition_id))
+                    modified = (
+                        previous[1] if previous and previous[0] == digest else now
+                    )
+                    versions[cast(str, partition_id)] = (digest, modified)
+                    rows.append(
+                        {
+                            "table_name": table_id.rsplit(".", 1)[1],
+                            "partition_id": partition_id,
+                            "total_rows": part.height,
+                            "last_modified_time": modified,
+                        }
+                    )
+                self._partition_versions[table_id] = versions
+        return pl.DataFrame(
+            rows,
+            schema={
+                "table_name": pl.String,
+                "partition_id": pl.String,
+                "total_rows": pl.Int64,
+                "last_modified_time": pl.Datetime("us", "UTC"),
+            },
+        )
+
+    def _inline_params(self, query: str, job_config: bq.QueryJobConfig | None) -> str:
+        params = job_config.query_parameters if job_config is not None else []
+        for param in params:
+            if (
+                isinstance(param, bq.ArrayQueryParameter)
+                and param.array_type == "STRUCT"
+            ):
+                query = self._inline_struct_array(query, param)
+            elif isinstance(param, bq.ArrayQueryParameter):
+                values = ", ".join(_sql_literal(v) for v in param.values)
+                query = re.sub(rf"UNNEST\(\s*@{param.name}\s*\)", f"({values})", query)
+            elif isinstance(param, bq.ScalarQueryParameter):
+                query = re.sub(rf"@{param.name}\b", _sql_literal(param.value), query)
+            else:
+                raise NotImplementedError(f"Unsupported query parameter: {param!r}")
+        return query
+
+    @staticmethod
+    def _inline_struct_array(query: str, param: bq.ArrayQueryParameter) -> str:
+        """
+        Expand `STRUCT(a, b) IN UNNEST(@param)` into ORed field comparisons.
+        """
+
+        def expand(m: re.Match[str]) -> str:
+            columns = [c.strip() for c in m.group(1).split(",")]
+            conditions = [
+                " AND ".join(
+                    f"{column} = {_sql_literal(value)}"
+                    for column, value in zip(columns, element.struct_values.values())
+                )
+                for element in param.values
+            ]
+            return "(" + " OR ".join(f"({c})" for c in conditions) + ")"
+
+        return re.sub(
+            rf"STRUCT\(([^)]*)\)\s+IN\s+UNNEST\(\s*@{param.name}\s*\)", expand, query
+        )
+
+    def query(
+        self, query: str, job_config: bq.QueryJobConfig | None = None, **kwargs
+    ) -> FakeQueryJob:
+        self.queries.append(query)
+        sql = self._inline_params(query, job_config)
+        # a multi-statement script returns the result of its last statement
+        statements = [s for s in _STATEMENT_SEPARATOR.split(sql) if s.strip()]
+        job_id = self._job_id()
+        table: pa.Table | None = None
+        for statement in statements:
+            table = self._execute(statement)
+        return FakeQueryJob(job_id=job_id, table=table)
+
+    def _execute(self, sql: str) -> pa.Table | None:
+        aliases: dict[str, str] = {}
+
+        def alias(m: re.Match[str]) -> str:
+            return aliases.setdefault(m.group(1), f"t{len(aliases)}")
+
+        if (delete := _DELETE_PATTERN.match(sql)) is not None:
+            table_id = delete.group(1).strip("`")
+            condition = _TABLE_ID_PATTERN.sub(alias, delete.group(2))
+            ctx = pl.SQLContext(t=self.read_table(table_id))
+            remaining = ctx.execute(
+                f"SELECT * FROM t WHERE NOT COALESCE(({condition}), FALSE)", eager=True
+            )
+            self._set_table(table_id, remaining)
+            return None
+        if re.match(r"^\s*(MERGE|UPDATE|INSERT|CREATE|DROP)\b", sql, re.IGNORECASE):
+            raise NotImplementedError(f"Unsupported statement: {sql}")
+        views: dict[str, pl.DataFrame] = {}
+        if (info := _PARTITIONS_VIEW_PATTERN.search(sql)) is not None:
+            views["partitions"] = self._partitions_view(info.group(1))
+            sql = _PARTITIONS_VIEW_PATTERN.sub("partitions", sql)
+        sql = _TABLE_ID_PATTERN.sub(alias, sql)
+        ctx = pl.SQLContext(
+            {
+                **views,
+                **{
+                    name: self.read_table(table_id)
+                    for table_id, name in aliases.items()
+                },
+            }
+        )
+        table = ctx.execute(sql, eager=True).to_arrow()
+        self.bytes_fetched += table.nbytes
+        return table
+
+
+@dataclass
+class FakeClients:
+    storage: FakeStorageClient
+    bq: FakeBigQueryClient
+    bq_write: FakeBigQueryWriteClient
+
+    @property
+    def bytes_copied(self) -> int:
+        """
+        Payload bytes that would cross the network with the real clients.
+        """
+        return (
+            self.storage.bytes_uploaded
+            + self.storage.bytes_downloaded
+            + self.bq.bytes_loaded
+            + self.bq.bytes_fetched
+        )
+
+    def reset_counters(self) -> None:
+        self.storage.n_requests = 0
+        self.storage.bytes_uploaded = 0
+        self.storage.bytes_downloaded = 0
+        self.bq.bytes_loaded = 0
+        self.bq.bytes_fetched = 0
+
+
+def override_with_fakes(container: DIContainer) -> FakeClients:
+    """
+    Point every client provider of `container` at an in-memory fake.
+    """
+    storage = FakeStorageClient()
+    clients = FakeClients(
+        storage=storage,
+        bq=FakeBigQueryClient(storage),
+        bq_write=FakeBigQueryWriteClient(),
+    )
+    container.storage_client.override(providers.Object(clients.storage))
+    container.bq_client.override(providers.Object(clients.bq))
+    container.bq_write_client.override(providers.Object(clients.bq_write))
+    # the fake query jobs return Arrow tables without a read session
+    container.bq_read_client.override(providers.Object(None))
+    return clients
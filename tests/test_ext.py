@@ -1,19 +1,67 @@
+import asyncio
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
+import json
+import os
+from pathlib import Path
 import time
+from typing import cast
+
+from google.api_core.exceptions import NotFound, ServiceUnavailable
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import bigquery as bq, storage
+from google.cloud.bigquery_storage_v1 import BigQueryWriteClient
+from google.api_core.future.polling import PollingFuture
 
 from dami.container import DIContainer
-from dami.ext.bq import BQPolarsHandler
+from dami.ext.aio import AsyncBQPolarsHandler, AsyncGCSHandler
+from dami.ext.bq import (
+    BQPolarsHandler,
+    ParquetLoadOptions,
+    WriteStreamType,
+    _create_query_job_config_from_python,
+    _split_df,
+)
+from dami.ext.bq_jobs import BQJobScheduler
 from dami.ext.gcs import (
+    BucketCache,
     GCSHandler,
     GCSLocation,
     BlobNotFoundError,
     UnsupportedFileTypeError,
 )
+from dami.ext.bq_schema import SchemaRegistry, generate_bq_table, table_schema
+from dami.ext.bq_validation import SchemaViolationError, compile_table_schema
+from dami.ext.http import RequestCounter, pooled_session
+from dami.ext.mirror import TableMirror
+from dami.ext.spool import SpooledPipe
+from dami.ext.transcode import transcode_to_utf8
+from dami.ext.query_cache import QueryResultCache, dml_target_tables
+from dami.ext.read_policy import ReadPolicy, ResilientReader
 import pytest
 
 import polars as pl
 
 from dami.settings import GS_BUCKET
-from dami.types.bq import BQTable, BQField
+from dami.tracing import (
+    InMemoryExporter,
+    JsonLinesExporter,
+    configure_tracing,
+    current_span,
+    span,
+    traced,
+)
+from dami.types.bq import BQTable, BQField, BQTimePartitioning
+from tests import fakes
+from tests.fakes import (
+    FakeBigQueryClient,
+    FakeBigQueryWriteClient,
+    FakeStorageClient,
+    override_with_fakes,
+)
+import requests
+from requests.adapters import HTTPAdapter
 
 
 class TestGCSHandler:
@@ -40,6 +88,45 @@ class TestGCSHandler:
         # cleanup
         handler.delete_blob(loc)
 
+    def test_download_streaming(self, handler: GCSHandler):
+        df = pl.DataFrame(
+            {
+                "col1": list(range(1000)),
+                "col2": ["日本語"] * 1000,
+            }
+        )
+        loc = GCSLocation(
+            bucket=GS_BUCKET,
+            path="test/test_download_streaming.csv",
+        )
+        handler.upload_bytes(df.write_csv().encode("shift-jis"), loc)
+        blob = handler.get_blob(loc)
+        # small ceiling forces many ranged reads and chunk-spanning multibyte chars
+        fetched_df = handler.download_df(blob, "shift-jis", max_memory_bytes=1024)
+        assert df.equals(fetched_df)
+        with handler.download_lazy(blob, "shift-jis", max_memory_bytes=1024) as lf:
+            assert lf.select(pl.len()).collect().item() == 1000
+        batches = list(handler.download_batches(blob, "shift-jis", max_memory_bytes=4096))
+        assert len(batches) > 1
+        assert df.equals(pl.concat(batches))
+        handler.delete_blob(loc)
+
+    def test_upload_file_parallel(self, handler: GCSHandler, tmp_path: Path):
+        local_path = tmp_path / "random.bin"
+        data = os.urandom(300_001)
+        local_path.write_bytes(data)
+        loc = GCSLocation(
+            bucket=GS_BUCKET,
+            path="test/test_upload_file_parallel.bin",
+        )
+        stats = handler.upload_file(
+            local_path, loc, parallel_threshold=100_000, part_size=100_000
+        )
+        assert stats.n_parts == 4
+        assert stats.n_bytes == len(data)
+        assert handler.get_blob(loc).download_as_bytes() == data
+        handler.delete_blob(loc)
+
     def test_get_blob_not_found(self, handler: GCSHandler):
         loc = GCSLocation(
             bucket=GS_BUCKET,
@@ -79,6 +166,28 @@ class TestGCSHandler:
         handler.delete_blob(loc1)
         handler.delete_blob(loc2)
 
+    def test_get_latest_blob_cached(self, handler: GCSHandler):
+        prefix = GCSLocation(bucket=GS_BUCKET, path="test/test_get_latest_blob_cached/")
+        loc1 = GCSLocation(bucket=GS_BUCKET, path=f"{prefix.path}2026-01.csv")
+        loc2 = GCSLocation(bucket=GS_BUCKET, path=f"{prefix.path}2026-02.csv")
+        handler.upload_bytes(b"data1", loc1)
+        latest_blob = handler.get_latest_blob(prefix, suffix=".csv", order_by="name")
+        assert latest_blob is not None
+        assert latest_blob.name == loc1.path
+        assert handler.prefix_cache_stats.misses == 1
+        # a new blob is found by the incremental listing
+        handler.upload_bytes(b"data2", loc2)
+        latest_blob = handler.get_latest_blob(prefix, suffix=".csv", order_by="name")
+        assert latest_blob is not None
+        assert latest_blob.name == loc2.path
+        assert handler.prefix_cache_stats.hits == 1
+        # a deleted blob is dropped from the index
+        handler.delete_blob(loc2)
+        latest_blob = handler.get_latest_blob(prefix, suffix=".csv", order_by="name")
+        assert latest_blob is not None
+        assert latest_blob.name == loc1.path
+        handler.delete_blob(loc1)
+
     def test_download_unsupported_file_type(self, handler: GCSHandler):
         loc = GCSLocation(
             bucket=GS_BUCKET,
@@ -102,6 +211,327 @@ class TestGCSHandler:
             handler.get_blob(loc)
 
 
+class TestGCSHandlerOffline:
+    def test_download_streaming(self):
+        client = FakeStorageClient()
+        df = pl.DataFrame({"col1": list(range(1000)), "col2": ["日本語"] * 1000})
+        client.put_object(GS_BUCKET, "streaming.csv", df.write_csv().encode("shift-jis"))
+        handler = GCSHandler(client=cast(storage.Client, client))
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="streaming.csv"))
+        expected = handler.download_df(blob, "shift-jis")
+        assert df.equals(expected)
+        client.n_requests = 0
+        # small ceiling forces many ranged reads and chunk-spanning multibyte chars
+        assert expected.equals(handler.download_df(blob, "shift-jis", max_memory_bytes=1024))
+        assert client.n_requests > 1
+        with handler.download_lazy(blob, "shift-jis", max_memory_bytes=1024) as lf:
+            assert expected.equals(lf.collect())
+        batches = list(handler.download_batches(blob, "shift-jis", max_memory_bytes=4096))
+        assert len(batches) > 1
+        assert expected.equals(pl.concat(batches))
+
+    def test_upload_file_resumes(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+        client = FakeStorageClient()
+        handler = GCSHandler(client=cast(storage.Client, client))
+        local_path = tmp_path / "random.bin"
+        data = os.urandom(300_001)
+        local_path.write_bytes(data)
+        loc = GCSLocation(bucket=GS_BUCKET, path="resumed.bin")
+        uploaded: list[str] = []
+        failures = [ConnectionError("connection reset")]
+        upload_from_file = fakes.FakeBlob.upload_from_file
+
+        def flaky_upload(blob: fakes.FakeBlob, f, size=None, **kwargs) -> None:
+            if blob.name.endswith("/00002") and failures:
+                raise failures.pop()
+            uploaded.append(blob.name)
+            upload_from_file(blob, f, size=size, **kwargs)
+
+        monkeypatch.setattr(fakes.FakeBlob, "upload_from_file", flaky_upload)
+        with pytest.raises(ConnectionError):
+            handler.upload_file(
+                local_path, loc, parallel_threshold=100_000, part_size=100_000
+            )
+        assert handler.find_blob(loc) is None
+        uploaded.clear()
+        stats = handler.upload_file(
+            local_path, loc, parallel_threshold=100_000, part_size=100_000
+        )
+        # only the failed part is sent again
+        assert uploaded == ["resumed.bin.parts/00002"]
+        assert (stats.n_parts, stats.n_resumed_parts) == (4, 3)
+        assert handler.get_blob(loc).download_as_bytes() == data
+        assert not any(name.startswith("resumed.bin.parts/") for _, name in client.objects)
+
+    def test_get_latest_blob_smaller_name(self):
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "exports/b.csv", b"b")
+        handler = GCSHandler(client=cast(storage.Client, client))
+        prefix = GCSLocation(bucket=GS_BUCKET, path="exports/")
+        latest = handler.get_latest_blob(prefix, ".csv")
+        assert latest is not None and latest.name == "exports/b.csv"
+        time.sleep(0.01)
+        # newer, but sorts before the name the index has seen
+        client.put_object(GS_BUCKET, "exports/a.csv", b"a")
+        latest = handler.get_latest_blob(prefix, ".csv")
+        assert latest is not None and latest.name == "exports/a.csv"
+
+    def test_get_latest_blob_concurrent(self):
+        client = FakeStorageClient()
+        for month in range(1, 13):
+            client.put_object(GS_BUCKET, f"concurrent/2026-{month:02}.csv", b"a")
+        handler = GCSHandler(client=cast(storage.Client, client))
+        prefix = GCSLocation(bucket=GS_BUCKET, path="concurrent/")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            latest = list(
+                executor.map(
+                    lambda _: handler.get_latest_blob(prefix, ".csv", order_by="name"),
+                    range(64),
+                )
+            )
+        assert {blob.name for blob in latest if blob is not None} == {
+            "concurrent/2026-12.csv"
+        }
+        stats = handler.prefix_cache_stats
+        assert stats.hits + stats.misses == 64
+
+
+class TestBucketCache:
+    def test_bucket_metadata_fetched_once(self):
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "a.csv", b"a")
+        handler = GCSHandler(client=cast(storage.Client, client))
+        loc = GCSLocation(bucket=GS_BUCKET, path="a.csv")
+        handler.get_blob(loc)
+        client.n_requests = 0
+        handler.get_blob(loc)
+        handler.upload_bytes(b"b", GCSLocation(bucket=GS_BUCKET, path="b.csv"))
+        handler.delete_blob(loc)
+        # one request per operation, none for the bucket
+        assert client.n_requests == 3
+        assert handler.bucket_cache.stats.hits == 3
+        assert handler.bucket_cache.stats.misses == 1
+
+    def test_shared_and_expiring(self):
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "a.csv", b"a")
+        cache = BucketCache(ttl=0.05)
+        loc = GCSLocation(bucket=GS_BUCKET, path="a.csv")
+        # handlers of different threads share the cached handle
+        GCSHandler(client=cast(storage.Client, client), bucket_cache=cache).get_blob(loc)
+        GCSHandler(client=cast(storage.Client, client), bucket_cache=cache).get_blob(loc)
+        assert cache.stats.misses == 1
+        time.sleep(0.1)
+        GCSHandler(client=cast(storage.Client, client), bucket_cache=cache).get_blob(loc)
+        assert cache.stats.misses == 2
+
+    def test_pooled_session(self):
+        counter = RequestCounter()
+        session = pooled_session(AnonymousCredentials(), pool_size=4, counter=counter)
+        adapter = session.get_adapter("https://storage.googleapis.com")
+        assert isinstance(adapter, HTTPAdapter)
+        assert adapter._pool_maxsize == 4
+        response = requests.Response()
+        response.request = requests.Request("GET", "https://example.com").prepare()
+        for hook in session.hooks["response"]:
+            hook(response)
+        assert counter.by_method == {"GET": 1}
+        assert counter.n_requests == 1
+
+
+class TestReadPolicy:
+    @pytest.fixture
+    def client(self) -> FakeStorageClient:
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "a.csv", b"a,b\n1,2\n")
+        return client
+
+    def test_retries_transient_errors_and_timeouts(self, client: FakeStorageClient):
+        policy = ReadPolicy(attempt_timeout=0.05, initial_backoff=0.001)
+        handler = GCSHandler(client=cast(storage.Client, client), reader=ResilientReader(policy=policy))
+        client.read_errors.append(ServiceUnavailable("unavailable"))
+        latencies = iter([0.2, 0.0])
+        client.read_latency = lambda: next(latencies, 0.0)
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="a.csv"))
+        assert blob.size == 8
+        stats = handler.reader.stats
+        assert (stats.reads, stats.attempts, stats.retries, stats.timeouts) == (1, 3, 2, 1)
+
+    def test_gives_up_after_max_attempts(self, client: FakeStorageClient):
+        policy = ReadPolicy(max_attempts=2, initial_backoff=0.001)
+        handler = GCSHandler(client=cast(storage.Client, client), reader=ResilientReader(policy=policy))
+        client.read_errors.extend([ServiceUnavailable("a"), ServiceUnavailable("b")])
+        with pytest.raises(ServiceUnavailable):
+            handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="a.csv"))
+        assert handler.reader.stats.attempts == 2
+
+    def test_not_found_is_not_retried(self, client: FakeStorageClient):
+        handler = GCSHandler(client=cast(storage.Client, client))
+        assert handler.find_blob(GCSLocation(bucket=GS_BUCKET, path="missing.csv")) is None
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="a.csv"))
+        client.objects.clear()
+        with pytest.raises(NotFound):
+            handler.download_df(blob, str_encoding=None)
+        assert handler.reader.stats.retries == 0
+
+    def test_hedged_read_keeps_first_response(self, client: FakeStorageClient):
+        policy = ReadPolicy(hedge_quantile=0.9, hedge_min_samples=5, hedge_min_delay=0.01)
+        reader = ResilientReader(policy=policy)
+        handler = GCSHandler(client=cast(storage.Client, client), reader=reader)
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="a.csv"))
+        expected = handler.download_df(blob, "shift-jis")
+        # two ranged reads of 4 bytes each
+        for _ in range(3):
+            handler.download_df(blob, "shift-jis", max_memory_bytes=4)
+        assert reader.hedge_delay("range:4") == pytest.approx(0.01)
+        # the first request stalls; the hedge sent after the delay answers
+        latencies = iter([1.0])
+        client.read_latency = lambda: next(latencies, 0.0)
+        started = time.perf_counter()
+        df = handler.download_df(blob, "shift-jis", max_memory_bytes=4)
+        assert time.perf_counter() - started < 0.5
+        assert df.equals(expected)
+        assert (reader.stats.hedges, reader.stats.hedge_wins) == (1, 1)
+        assert reader.stats.hedge_win_rate == 1.0
+
+    def test_hedges_only_slow_reads_of_their_size(self):
+        client = FakeStorageClient()
+        # 128 KiB: four 32 KiB reads or 256 reads of 512 bytes
+        client.put_object(GS_BUCKET, "b.csv", b"i\n" + b"1\n" * (64 * 1024 - 1))
+        policy = ReadPolicy(hedge_quantile=0.95, hedge_min_samples=5, hedge_min_delay=0.005)
+        reader = ResilientReader(policy=policy)
+        handler = GCSHandler(client=cast(storage.Client, client), reader=reader)
+        loc = GCSLocation(bucket=GS_BUCKET, path="b.csv")
+        blob = handler.get_blob(loc)
+        # a read takes time in proportion to its size
+        client.read_bytes_per_second = 4 * 1024 * 1024
+        large_reads = 0
+        for _ in range(10):
+            handler.download_df(blob, "shift-jis", max_memory_bytes=512)
+            # each slower than any of the small reads
+            df = handler.download_df(blob, "shift-jis", max_memory_bytes=32 * 1024)
+            large_reads += 4
+        assert df.height == 64 * 1024 - 1
+        # whole downloads and metadata reads are never hedged
+        hedges = reader.stats.hedges
+        handler.download_df(blob, None)
+        handler.get_blob(loc)
+        assert reader.stats.hedges == hedges
+        # with one window for both sizes, about every large read would be hedged
+        assert hedges < large_reads / 2
+
+    def test_backoff_is_capped(self):
+        policy = ReadPolicy(initial_backoff=1.0, max_backoff=3.0)
+        assert all(0 <= policy.backoff(attempt) <= 3.0 for attempt in range(1, 10))
+
+    def test_container_shares_reader(self):
+        container = DIContainer()
+        override_with_fakes(container)
+        handler = container.gcs_handler()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other = cast(GCSHandler, executor.submit(container.gcs_handler).result())
+        assert handler is not other
+        assert handler.reader is other.reader
+
+
+class TestTranscode:
+    TEXT = "ID,内容,金額（円）\na1,コンビニ ﾗﾝﾁ,-800\nb2,給与,300000\n"
+
+    @pytest.mark.parametrize("encoding", ["shift-jis", "cp932", "euc-jp"])
+    def test_split_multibyte(self, encoding: str):
+        data = self.TEXT.encode(encoding)
+        # every split point, including ones inside a two-byte character
+        for i in range(len(data) + 1):
+            out = b"".join(transcode_to_utf8([data[:i], data[i:]], encoding))
+            assert out == self.TEXT.encode("utf-8")
+
+    def test_ascii_passthrough(self):
+        chunks = [b"a,b\n", "あ".encode("shift-jis")[:1], "あ".encode("shift-jis")[1:], b"c\n"]
+        assert b"".join(transcode_to_utf8(chunks, "shift-jis")) == "a,b\nあc\n".encode()
+
+    def test_truncated_input(self):
+        with pytest.raises(UnicodeDecodeError):
+            list(transcode_to_utf8(["あ".encode("shift-jis")[:1]], "shift-jis"))
+
+    def test_download_df_chunked(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr("dami.ext.gcs.DOWNLOAD_CHUNK_SIZE", 7)
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "mf.csv", (self.TEXT * 3).encode("shift-jis"))
+        handler = GCSHandler(client=cast(storage.Client, client))
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="mf.csv"))
+        client.n_requests = 0
+        df = handler.download_df(blob, "shift-jis")
+        assert client.n_requests > 1
+        expected = pl.read_csv((self.TEXT * 3).encode("utf-8"))
+        assert df.equals(expected)
+
+
+class TestTracing:
+    @pytest.fixture
+    def exporter(self) -> Iterator[InMemoryExporter]:
+        exporter = InMemoryExporter()
+        configure_tracing(exporter)
+        yield exporter
+        configure_tracing(None)
+
+    def test_nested_spans(self, exporter: InMemoryExporter):
+        @traced("outer")
+        def outer() -> None:
+            current_span().set(rows=3)
+            with span("inner", bytes=10):
+                pass
+
+        outer()
+        (outer_span,) = exporter.find("outer")
+        (inner_span,) = exporter.find("inner")
+        assert outer_span.parent_id is None
+        assert inner_span.parent_id == outer_span.span_id
+        assert outer_span.attributes == {"rows": 3}
+        assert inner_span.attributes == {"bytes": 10}
+        assert outer_span.duration_seconds >= inner_span.duration_seconds
+
+    def test_error(self, exporter: InMemoryExporter):
+        with pytest.raises(ValueError):
+            with span("failing"):
+                raise ValueError("boom")
+        assert exporter.find("failing")[0].error == "ValueError"
+
+    def test_disabled(self):
+        @traced("noop")
+        def fn() -> int:
+            current_span().set(rows=1)
+            return 1
+
+        assert fn() == 1
+        with span("noop") as s:
+            s.set(bytes=1)
+
+    def test_download_df_spans(self, exporter: InMemoryExporter):
+        data = TestTranscode.TEXT.encode("shift-jis")
+        client = FakeStorageClient()
+        client.put_object(GS_BUCKET, "mf.csv", data)
+        handler = GCSHandler(client=cast(storage.Client, client))
+        blob = handler.get_blob(GCSLocation(bucket=GS_BUCKET, path="mf.csv"))
+        df = handler.download_df(blob, "shift-jis")
+        (download,) = exporter.find("gcs.download_df")
+        assert download.attributes["rows"] == df.height
+        assert download.attributes["bytes"] == len(data)
+        assert {s.parent_id for s in exporter.find("gcs.parse")} == {download.span_id}
+
+    def test_json_lines(self, tmp_path: Path):
+        path = tmp_path / "trace.jsonl"
+        configure_tracing(JsonLinesExporter(path))
+        try:
+            with span("a", rows=1):
+                with span("b"):
+                    pass
+        finally:
+            configure_tracing(None)
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["name"] for line in lines] == ["b", "a"]
+        assert lines[1]["attributes"] == {"rows": 1}
+
+
 class TestBQPolarsHandler:
     @pytest.fixture()
     def bq_handler(self, container: DIContainer) -> BQPolarsHandler:
@@ -205,3 +635,910 @@ class TestBQPolarsHandler:
         assert fetched_df["name"][0] == "updated"
         assert fetched_df["id"][0] == 1
         assert fetched_df["value"][0] == 1.1
+
+    def test_fetch_batches(self, bq_handler: BQPolarsHandler, sample_table: BQTable):
+        table_id = sample_table.get_bq_table_id()
+        bq_handler.run_update_query(f"DELETE FROM {table_id} WHERE TRUE", params={})
+        df = pl.DataFrame(
+            {
+                "id": list(range(1000)),
+                "name": [f"name_{i}" for i in range(1000)],
+                "value": [i / 10 for i in range(1000)],
+            }
+        )
+        bq_handler.insert_df(df, sample_table)
+
+        query = f"SELECT id, name, value FROM {table_id} WHERE id >= @min_id"
+        batches = list(
+            bq_handler.fetch_batches(
+                query=query,
+                table=sample_table,
+                fields_to_fetch=["id", "name", "value"],
+                params={"min_id": 500},
+            )
+        )
+        assert pl.concat(batches).height == 500
+        assert all(batch.schema["id"] == pl.Int64 for batch in batches)
+
+        lf = bq_handler.fetch_lazy(
+            query=query,
+            table=sample_table,
+            fields_to_fetch=["id", "name", "value"],
+            params={"min_id": 500},
+        )
+        fetched_df = lf.filter(pl.col("id") < 600).select("id").collect()
+        assert fetched_df.sort("id")["id"].to_list() == list(range(500, 600))
+
+
+class TestBQStorageWrite:
+    @pytest.fixture
+    def write_client(self) -> FakeBigQueryWriteClient:
+        return FakeBigQueryWriteClient()
+
+    @pytest.fixture
+    def bq_handler(self, write_client: FakeBigQueryWriteClient) -> BQPolarsHandler:
+        # the storage write path does not touch the BigQuery client
+        return BQPolarsHandler(
+            client=cast(bq.Client, None),
+            write_client=cast(BigQueryWriteClient, write_client),
+        )
+
+    def test_split_df(self):
+        df = pl.DataFrame({"id": list(range(1000)), "name": ["x" * 10] * 1000})
+        batches = _split_df(df, max_bytes=1000)
+        assert len(batches) > 1
+        assert all(batch.estimated_size() <= 1000 for batch in batches)
+        assert pl.concat(batches).equals(df)
+
+    @pytest.fixture
+    def sample_table(self) -> BQTable:
+        return BQTable(
+            project="strange-oxide-138404",
+            dataset="testing",
+            table="for_data_test",
+            fields=[
+                BQField(name="id", type="INTEGER", mode="REQUIRED"),
+                BQField(name="name", type="STRING", mode="NULLABLE"),
+                BQField(name="value", type="FLOAT", mode="NULLABLE"),
+            ],
+        )
+
+    @pytest.mark.parametrize("stream_type", ["PENDING", "COMMITTED"])
+    def test_write_df(
+        self,
+        bq_handler: BQPolarsHandler,
+        write_client: FakeBigQueryWriteClient,
+        sample_table: BQTable,
+        stream_type: WriteStreamType,
+    ):
+        df = pl.DataFrame(
+            {
+                "id": list(range(10_000)),
+                "name": [f"name_{i}" for i in range(10_000)],
+                "value": [i / 10 for i in range(10_000)],
+            }
+        )
+        # small requests force several batches written by parallel streams
+        bq_handler.write_df(
+            df, sample_table, stream_type=stream_type, max_request_bytes=16 * 1024
+        )
+        parent = "projects/strange-oxide-138404/datasets/testing/tables/for_data_test"
+        assert len(write_client.tables[parent]) > 1
+        # BQ tables are unordered and parallel streams may commit in any order
+        assert df.equals(write_client.read_table(parent).sort("id"))
+
+    def test_write_df_required_null(
+        self, bq_handler: BQPolarsHandler, sample_table: BQTable
+    ):
+        df = pl.DataFrame(
+            {
+                "id": [1, None],
+                "name": ["a", "b"],
+                "value": [1.1, 2.2],
+            },
+            schema={"id": pl.Int64, "name": pl.String, "value": pl.Float64},
+        )
+        with pytest.raises(ValueError):
+            bq_handler.insert_df(df, sample_table, mode="storage_write")
+
+
+class TestBQValidation:
+    @pytest.fixture
+    def nested_table(self) -> BQTable:
+        return BQTable(
+            project="strange-oxide-138404",
+            dataset="testing",
+            table="for_validation_test",
+            fields=[
+                BQField(name="id", type="INTEGER", mode="REQUIRED"),
+                BQField(name="tags", type="STRING", mode="REPEATED"),
+                BQField(
+                    name="items",
+                    type="RECORD",
+                    mode="REPEATED",
+                    fields=[
+                        BQField(name="sku", type="STRING", mode="REQUIRED"),
+                        BQField(name="price", type="FLOAT", mode="NULLABLE"),
+                    ],
+                ),
+            ],
+        )
+
+    def make_df(self, ids: list, tags: list, items: list) -> pl.DataFrame:
+        return pl.DataFrame(
+            {"id": ids, "tags": tags, "items": items},
+            schema={
+                "id": pl.Int64,
+                "tags": pl.List(pl.String),
+                "items": pl.List(pl.Struct({"sku": pl.String, "price": pl.Float64})),
+            },
+        )
+
+    def test_compiled_once(self, nested_table: BQTable):
+        assert compile_table_schema(nested_table) is compile_table_schema(
+            nested_table.model_copy(deep=True)
+        )
+
+    def test_valid(self, nested_table: BQTable):
+        df = self.make_df(
+            [1, 2],
+            [["a"], None],
+            [[{"sku": "x", "price": 1.0}], []],
+        )
+        BQPolarsHandler.validate_df(df, nested_table)
+
+    def test_mode_violations(self, nested_table: BQTable):
+        df = self.make_df(
+            [1, None],
+            [["a", None], []],
+            [[{"sku": None, "price": 1.0}, None], None],
+        )
+        with pytest.raises(SchemaViolationError) as e:
+            BQPolarsHandler.validate_df(df, nested_table)
+        assert e.value.violations == {
+            "id: null in REQUIRED field": 1,
+            "tags: null element in REPEATED field": 1,
+            "items: null element in REPEATED field": 1,
+            "items.sku: null in REQUIRED field": 1,
+        }
+
+    def test_repeated_dtype(self, nested_table: BQTable):
+        df = self.make_df([1], [["a"]], [[]]).with_columns(pl.lit("a").alias("tags"))
+        with pytest.raises(TypeError):
+            BQPolarsHandler.validate_df(df, nested_table)
+
+    def test_coerce(self, nested_table: BQTable):
+        df = pl.DataFrame(
+            {
+                "id": pl.Series([1, 2], dtype=pl.Int32),
+                "tags": pl.Series([["a"], []], dtype=pl.List(pl.Categorical)),
+                "items": [[{"sku": "x", "price": 1}], None],
+                "extra": [True, False],
+            }
+        )
+        coerced = BQPolarsHandler.coerce_df(df, nested_table)
+        assert coerced.schema == pl.Schema(
+            {
+                "id": pl.Int64,
+                "tags": pl.List(pl.String),
+                "items": pl.List(pl.Struct({"sku": pl.String, "price": pl.Float64})),
+            }
+        )
+        assert coerced["items"].to_list() == [[{"sku": "x", "price": 1.0}], None]
+        BQPolarsHandler.validate_df(coerced, nested_table)
+
+    def test_coerce_incompatible(self, nested_table: BQTable):
+        df = self.make_df([1], [["a"]], [[]]).with_columns(pl.lit("1").alias("id"))
+        with pytest.raises(TypeError):
+            BQPolarsHandler.coerce_df(df, nested_table)
+
+
+class TestSchemaRegistry:
+    def write_schema(self, path: Path, fields: list[dict], mtime_ns: int) -> None:
+        path.write_text(json.dumps(fields))
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    def test_load_and_reload(self, tmp_path: Path):
+        path = tmp_path / "sample.json"
+        self.write_schema(
+            path, [{"name": "id", "type": "INTEGER", "mode": "REQUIRED"}], 1_000_000_000
+        )
+        # an unsupported schema is never parsed unless requested
+        (tmp_path / "broken.json").write_text("[{}]")
+        registry = SchemaRegistry(schema_dir=tmp_path)
+        assert registry.names() == ["broken", "sample"]
+
+        table = registry.table("sample", project="p", dataset="d")
+        assert table.table == "sample"
+        assert registry.table("sample", project="p", dataset="d") is table
+        schema = table_schema(table)
+        assert table_schema(table) is schema
+        assert schema.polars_schema == {"id": pl.Int64}
+        assert [f.name for f in schema.bq_fields] == ["id"]
+        assert schema.fetch_schema(["id"]) == {"id": pl.Int64}
+
+        self.write_schema(
+            path,
+            [
+                {"name": "id", "type": "INTEGER", "mode": "REQUIRED"},
+                {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+            ],
+            2_000_000_000,
+        )
+        reloaded = registry.table("sample", project="p", dataset="d")
+        assert reloaded is not table
+        assert list(table_schema(reloaded).polars_schema) == ["id", "name"]
+
+    def test_table_options(self, tmp_path: Path):
+        self.write_schema(
+            tmp_path / "sample.json",
+            [{"name": "day", "type": "DATE", "mode": "NULLABLE"}],
+            1_000_000_000,
+        )
+        options_dir = tmp_path / "options"
+        options_dir.mkdir()
+        (options_dir / "sample.json").write_text(
+            json.dumps({"time_partitioning": {"field": "day", "type": "MONTH"}})
+        )
+        registry = SchemaRegistry(schema_dir=tmp_path, options_dir=options_dir)
+        table = registry.table("sample", project="p", dataset="d")
+        assert table.time_partitioning == BQTimePartitioning(field="day", type="MONTH")
+        assert registry.names() == ["sample"]
+
+    def test_renamed_copy(self, tmp_path: Path):
+        self.write_schema(
+            tmp_path / "sample.json",
+            [{"name": "id", "type": "INTEGER", "mode": "REQUIRED"}],
+            1_000_000_000,
+        )
+        table = SchemaRegistry(schema_dir=tmp_path).table("sample", "p", "d")
+        staging = table.model_copy(update={"table": "sample_staging"})
+        assert table_schema(staging).table_id == "p.d.sample_staging"
+        assert table_schema(table).table_id == "p.d.sample"
+
+    def test_copy_with_other_fields(self, tmp_path: Path):
+        self.write_schema(
+            tmp_path / "sample.json",
+            [{"name": "id", "type": "INTEGER", "mode": "REQUIRED"}],
+            1_000_000_000,
+        )
+        table = SchemaRegistry(schema_dir=tmp_path).table("sample", "p", "d")
+        schema = table_schema(table)
+        name = BQField(name="name", type="STRING", mode="NULLABLE")
+        extended = table.model_copy(update={"fields": [*table.fields, name]})
+        assert list(table_schema(extended).polars_schema) == ["id", "name"]
+        assert table_schema(extended).fingerprint != schema.fingerprint
+        assert table_schema(table) is schema
+
+
+class TestBQPartitioning:
+    @pytest.fixture
+    def table(self) -> BQTable:
+        return BQTable(
+            project="p",
+            dataset="d",
+            table="events",
+            fields=[
+                BQField(name="day", type="DATE", mode="REQUIRED"),
+                BQField(name="kind", type="STRING", mode="NULLABLE"),
+                BQField(name="n", type="INTEGER", mode="NULLABLE"),
+            ],
+            time_partitioning=BQTimePartitioning(field="day"),
+            clustering_fields=["kind"],
+        )
+
+    def make_df(self, days: list[int], n: int) -> pl.DataFrame:
+        return pl.DataFrame(
+            {
+                "day": [datetime.date(2026, 1, d) for d in days],
+                "kind": ["a"] * len(days),
+                "n": [n] * len(days),
+            }
+        )
+
+    def test_table_options(self, table: BQTable):
+        bq_table = generate_bq_table(table)
+        assert bq_table.time_partitioning.field == "day"
+        assert bq_table.time_partitioning.type_ == "DAY"
+        assert bq_table.clustering_fields == ["kind"]
+        with pytest.raises(ValueError):
+            BQTable.model_validate({**table.model_dump(), "time_partitioning": {"field": "kind"}})
+        with pytest.raises(ValueError):
+            BQTable.model_validate({**table.model_dump(), "clustering_fields": ["missing"]})
+
+    def test_partition_ids(self):
+        days = BQTimePartitioning(field="day")
+        assert days.partition_ids_between(
+            datetime.date(2026, 1, 30), datetime.date(2026, 2, 1)
+        ) == ["20260130", "20260131", "20260201"]
+        months = BQTimePartitioning(field="day", type="MONTH")
+        assert months.partition_ids_between(
+            datetime.date(2026, 1, 30), datetime.date(2026, 2, 1)
+        ) == ["202601", "202602"]
+
+    def test_replace_partitions(self, table: BQTable):
+        client = FakeBigQueryClient()
+        handler = BQPolarsHandler(client=cast(bq.Client, client))
+        handler.create_table(table)
+        handler.insert_df(self.make_df([1, 2, 2, 3], n=0), table)
+        replaced = handler.replace_partitions(
+            self.make_df([2, 4], n=1), table, partition_ids=["20260103"]
+        )
+        assert replaced == ["20260102", "20260103", "20260104"]
+        loaded = client.read_table("p.d.events").sort("day")
+        assert loaded["day"].dt.day().to_list() == [1, 2, 4]
+        assert loaded["n"].to_list() == [0, 1, 1]
+        # no DML is issued
+        assert client.queries == []
+
+    def test_replace_partitions_unpartitioned(self, table: BQTable):
+        table.time_partitioning = None
+        handler = BQPolarsHandler(client=cast(bq.Client, FakeBigQueryClient()))
+        with pytest.raises(ValueError):
+            handler.replace_partitions(self.make_df([1], n=0), table)
+
+
+class TestSpooledLoad:
+    def test_pipe(self):
+        with SpooledPipe(max_memory_bytes=4) as pipe, ThreadPoolExecutor(1) as executor:
+            reading = executor.submit(pipe.read, 6)
+            pipe.write(b"abc")
+            time.sleep(0.05)
+            # blocks until 6 bytes are written
+            assert not reading.done()
+            pipe.write(b"defgh")
+            assert reading.result(timeout=1) == b"abcdef"
+            assert pipe.spilled_to_disk
+            # seeking back replays the spooled bytes
+            pipe.seek(2)
+            pipe.finish()
+            assert pipe.read() == b"cdefgh"
+            assert pipe.seek(0, os.SEEK_END) == 8
+
+    def test_pipe_errors(self):
+        pipe = SpooledPipe(max_memory_bytes=1024)
+        pipe.fail(RuntimeError("encoding failed"))
+        with pytest.raises(RuntimeError):
+            pipe.read()
+        pipe = SpooledPipe(max_memory_bytes=1024)
+        pipe.close()
+        # the writer stops when the reader gives up
+        with pytest.raises(ValueError):
+            pipe.write(b"a")
+
+    @pytest.mark.parametrize("compression", ["zstd", "snappy", "uncompressed"])
+    def test_insert_df(self, compression):
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        client = FakeBigQueryClient()
+        client.create_table(table)
+        handler = BQPolarsHandler(
+            client=cast(bq.Client, client),
+            load_options=ParquetLoadOptions(
+                compression=compression, row_group_size=1000, max_memory_bytes=1024
+            ),
+        )
+        df = pl.DataFrame({"id": range(10_000)})
+        stats = handler.insert_df(df, table)
+        assert stats is not None
+        assert stats.n_rows == 10_000
+        assert stats.n_bytes == client.bytes_loaded
+        assert stats.spilled_to_disk
+        assert stats.peak_buffer_bytes == 1024
+        assert client.read_table("p.d.t").equals(df)
+
+    def test_upload_chunks_fit_in_memory(self):
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        client = FakeBigQueryClient()
+        client.create_table(table)
+        max_memory_bytes = 768 * 1024
+        handler = BQPolarsHandler(
+            client=cast(bq.Client, client),
+            load_options=ParquetLoadOptions(
+                compression="uncompressed", max_memory_bytes=max_memory_bytes
+            ),
+        )
+        df = pl.DataFrame({"id": range(500_000)})
+        stats = handler.insert_df(df, table)
+        assert stats is not None
+        # each chunk is sent once encoded, instead of after 100 MiB
+        *chunks, last = client.upload_chunk_sizes
+        assert len(chunks) > 1
+        assert set(chunks) == {max_memory_bytes}
+        assert last < max_memory_bytes
+        assert sum(client.upload_chunk_sizes) == stats.n_bytes
+        assert client.read_table("p.d.t").equals(df)
+
+    def test_upload_chunks_with_client(self):
+        class ResumableSession:
+            """
+            Answers the requests of a resumable load job upload.
+            """
+
+            is_mtls = False
+
+            def __init__(self) -> None:
+                self.job_resource: dict = {}
+                self.chunks: list[bytes] = []
+
+            def request(
+                self, method: str, url: str, data: bytes, headers: dict[str, str], **kwargs
+            ) -> requests.Response:
+                response = requests.Response()
+                response.status_code = 200
+                if method == "POST":
+                    self.job_resource = json.loads(data)
+                    response.headers["location"] = "https://upload.example/session"
+                    return response
+                self.chunks.append(data)
+                if headers["content-range"].endswith("/*"):
+                    response.status_code = 308
+                    uploaded = sum(len(chunk) for chunk in self.chunks)
+                    response.headers["range"] = f"bytes=0-{uploaded - 1}"
+                else:
+                    response._content = json.dumps(self.job_resource).encode()
+                return response
+
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        session = ResumableSession()
+        client = bq.Client(
+            project="p",
+            credentials=AnonymousCredentials(),
+            _http=cast(requests.Session, session),
+        )
+        handler = BQPolarsHandler(
+            client=client,
+            load_options=ParquetLoadOptions(
+                compression="uncompressed", max_memory_bytes=256 * 1024
+            ),
+        )
+        df = pl.DataFrame({"id": range(100_000)})
+        job = handler.submit_load_df(df, table, write_disposition="WRITE_TRUNCATE")
+        assert isinstance(job, bq.LoadJob)
+        assert job.destination.table_id == "t"
+        assert job.write_disposition == "WRITE_TRUNCATE"
+        assert len(session.chunks) > 1
+        assert {len(chunk) for chunk in session.chunks[:-1]} == {256 * 1024}
+        assert pl.read_parquet(b"".join(session.chunks)).equals(df)
+
+    def test_failed_upload(self):
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="missing",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        handler = BQPolarsHandler(client=cast(bq.Client, FakeBigQueryClient()))
+        with pytest.raises(NotFound):
+            handler.insert_df(pl.DataFrame({"id": range(10)}), table)
+
+
+class TestFetchByKeys:
+    @pytest.fixture
+    def table(self) -> BQTable:
+        return BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[
+                BQField(name="id", type="INTEGER", mode="REQUIRED"),
+                BQField(name="day", type="DATE", mode="REQUIRED"),
+                BQField(name="value", type="STRING", mode="NULLABLE"),
+            ],
+        )
+
+    @pytest.fixture
+    def handler(self, table: BQTable) -> BQPolarsHandler:
+        client = FakeBigQueryClient()
+        client.create_table(table)
+        client._set_table(
+            "p.d.t",
+            pl.DataFrame(
+                {
+                    "id": range(100),
+                    "day": [datetime.date(2026, 1, 1 + i % 2) for i in range(100)],
+                    "value": [f"v{i}" for i in range(100)],
+                }
+            ),
+        )
+        return BQPolarsHandler(client=cast(bq.Client, client))
+
+    def test_struct_parameters(self):
+        job_config = _create_query_job_config_from_python(
+            {
+                "keys": [{"id": 1, "day": datetime.date(2026, 1, 1)}],
+                "range": {"start": 1, "ids": [1, 2]},
+            }
+        )
+        keys, range_ = [p.to_api_repr() for p in job_config.query_parameters]
+        assert keys["parameterType"]["arrayType"]["structTypes"] == [
+            {"name": "id", "type": {"type": "INTEGER"}},
+            {"name": "day", "type": {"type": "DATE"}},
+        ]
+        assert range_["parameterValue"]["structValues"]["ids"] == {
+            "arrayValues": [{"value": "1"}, {"value": "2"}]
+        }
+
+    def test_batches(self, handler: BQPolarsHandler, table: BQTable):
+        client = cast(FakeBigQueryClient, handler.client)
+        keys = pl.Series("id", [5, 1, 99, 5, 1000, None])
+        df = handler.fetch_by_keys(table, keys, ["id", "value"], max_param_bytes=32)
+        # one query per distinct key with the tiny limit; order is not kept
+        assert len(client.queries) == 4
+        assert sorted(df["id"].to_list()) == [1, 5, 99]
+        assert df.schema == {"id": pl.Int64, "value": pl.String}
+
+    def test_composite_keys(self, handler: BQPolarsHandler, table: BQTable):
+        keys = pl.DataFrame(
+            {"id": [2, 3], "day": [datetime.date(2026, 1, 1), datetime.date(2026, 1, 1)]}
+        )
+        df = handler.fetch_by_keys(table, keys, ["id", "day", "value"])
+        # id 3 is on 2026-01-02
+        assert df["value"].to_list() == ["v2"]
+        empty = handler.fetch_by_keys(table, keys.clear(), ["id"])
+        assert empty.height == 0 and empty.schema == {"id": pl.Int64}
+
+
+class TestTableMirror:
+    @pytest.fixture
+    def table(self) -> BQTable:
+        return BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[
+                BQField(name="id", type="INTEGER", mode="REQUIRED"),
+                BQField(name="day", type="DATE", mode="NULLABLE"),
+            ],
+            time_partitioning=BQTimePartitioning(field="day"),
+        )
+
+    @pytest.fixture
+    def mirror(self, table: BQTable, tmp_path: Path) -> TableMirror:
+        client = FakeBigQueryClient()
+        client.create_table(table)
+        client._set_table(
+            "p.d.t",
+            pl.DataFrame(
+                {
+                    "id": [1, 2, 3, 4],
+                    "day": [
+                        datetime.date(2026, 1, 5),
+                        datetime.date(2026, 1, 20),
+                        datetime.date(2026, 2, 1),
+                        None,
+                    ],
+                }
+            ),
+        )
+        handler = BQPolarsHandler(client=cast(bq.Client, client))
+        return TableMirror(handler=handler, table=table, mirror_dir=tmp_path)
+
+    def test_sync(self, mirror: TableMirror):
+        client = cast(FakeBigQueryClient, mirror.handler.client)
+        stats = mirror.sync()
+        assert stats.full and stats.rows_fetched == 4
+        assert mirror.months == ["2026-01", "2026-02", "__NULL__"]
+        df = mirror.scan().filter(pl.col("month") == "2026-01").select("id").collect()
+        assert sorted(df["id"].to_list()) == [1, 2]
+
+        # unchanged: one metadata request and no query
+        n_queries = len(client.queries)
+        assert mirror.sync().up_to_date
+        assert len(client.queries) == n_queries
+
+    def test_incremental_sync(self, mirror: TableMirror):
+        client = cast(FakeBigQueryClient, mirror.handler.client)
+        mirror.sync()
+        january = mirror.root / "month=2026-01" / "data.parquet"
+        january_mtime = january.stat().st_mtime_ns
+        # rewrite February and drop every row of it
+        client._set_table(
+            "p.d.t", client.read_table("p.d.t").filter(pl.col("id") != 3)
+        )
+        stats = mirror.sync()
+        assert not stats.full and stats.months_fetched == 1
+        assert mirror.months == ["2026-01", "__NULL__"]
+        assert january.stat().st_mtime_ns == january_mtime
+        # add rows to February again
+        client._set_table(
+            "p.d.t",
+            pl.concat(
+                [
+                    client.read_table("p.d.t"),
+                    pl.DataFrame({"id": [5], "day": [datetime.date(2026, 2, 3)]}),
+                ]
+            ),
+        )
+        stats = mirror.sync()
+        assert stats.months_fetched == 1 and stats.rows_fetched == 1
+        # only February was queried
+        assert "@start_0" in client.queries[-1]
+        assert "@start_1" not in client.queries[-1] and "IS NULL" not in client.queries[-1]
+        assert mirror.scan().select(pl.len()).collect().item() == 4
+
+    def test_schema_change_resyncs(self, mirror: TableMirror, table: BQTable):
+        client = cast(FakeBigQueryClient, mirror.handler.client)
+        mirror.sync()
+        described = table.model_copy(
+            update={
+                "fields": [
+                    table.fields[0].model_copy(update={"description": "key"}),
+                    table.fields[1],
+                ]
+            }
+        )
+        other = TableMirror(handler=mirror.handler, table=described, mirror_dir=mirror.mirror_dir)
+        # the manifest of the old schema is not compared with, although the table is unchanged
+        stats = other.sync()
+        assert stats.full and stats.rows_fetched == 4
+        assert "WHERE" not in client.queries[-1]
+        assert other.sync().up_to_date
+
+    def test_empty_and_unpartitioned(self, table: BQTable, tmp_path: Path):
+        unpartitioned = table.model_copy(update={"time_partitioning": None})
+        client = FakeBigQueryClient()
+        client.create_table(unpartitioned)
+        handler = BQPolarsHandler(client=cast(bq.Client, client))
+        with pytest.raises(ValueError):
+            TableMirror(handler=handler, table=unpartitioned, mirror_dir=tmp_path)
+        mirror = TableMirror(
+            handler=handler, table=unpartitioned, mirror_dir=tmp_path, column="day"
+        )
+        assert mirror.scan().collect().columns == ["id", "day", "month"]
+        client._set_table(
+            "p.d.t", pl.DataFrame({"id": [1], "day": [datetime.date(2026, 3, 1)]})
+        )
+        # without partitions, any change fetches the whole table
+        assert mirror.sync().full
+        assert mirror.scan().collect()["month"].to_list() == ["2026-03"]
+
+
+class TestBQJobScheduler:
+    @pytest.fixture
+    def handler(self) -> BQPolarsHandler:
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        client = FakeBigQueryClient()
+        client.create_table(table)
+        client._set_table("p.d.t", pl.DataFrame({"id": range(10)}))
+        return BQPolarsHandler(client=cast(bq.Client, client))
+
+    def test_statements_share_one_job(self, handler: BQPolarsHandler):
+        client = cast(FakeBigQueryClient, handler.client)
+        completed: list[Future] = []
+        with BQJobScheduler(handler) as jobs:
+            for limit in (2, 8):
+                future = jobs.submit_update_query(
+                    "DELETE FROM `p.d.t` WHERE id < @limit", {"limit": limit}
+                )
+                future.add_done_callback(completed.append)
+        # the same parameter name in both statements
+        (script,) = client.queries
+        assert "@s0_limit" in script and "@s1_limit" in script
+        assert len(completed) == 2
+        assert client.read_table("p.d.t")["id"].to_list() == [8, 9]
+
+    def test_load_after(self, handler: BQPolarsHandler):
+        client = cast(FakeBigQueryClient, handler.client)
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        exporter = InMemoryExporter()
+        configure_tracing(exporter)
+        try:
+            with BQJobScheduler(handler) as jobs:
+                gate: Future[None] = Future()
+                loading = jobs.submit_load_df(pl.DataFrame({"id": [10]}), table, after=gate)
+                time.sleep(0.2)
+                # encoded, but not uploaded before `after` succeeds
+                assert len(exporter.find("bq.parquet_encode")) == 1
+                assert not loading.done() and client.bytes_loaded == 0
+                gate.set_result(None)
+                assert loading.result(timeout=5) is not None
+        finally:
+            configure_tracing(None)
+        assert client.read_table("p.d.t").height == 11
+
+    def test_failed_statement(self, handler: BQPolarsHandler):
+        client = cast(FakeBigQueryClient, handler.client)
+        table = BQTable(
+            project="p",
+            dataset="d",
+            table="t",
+            fields=[BQField(name="id", type="INTEGER", mode="REQUIRED")],
+        )
+        with pytest.raises(NotImplementedError):
+            with BQJobScheduler(handler) as jobs:
+                updated = jobs.submit_update_query("UPDATE `p.d.t` SET id = 0 WHERE TRUE", {})
+                loading = jobs.submit_load_df(pl.DataFrame({"id": [10]}), table, after=updated)
+        with pytest.raises(NotImplementedError):
+            loading.result()
+        assert client.bytes_loaded == 0
+
+
+class TestQueryResultCache:
+    @pytest.fixture
+    def cache(self, tmp_path: Path) -> QueryResultCache:
+        return QueryResultCache(cache_dir=tmp_path)
+
+    def test_key_normalizes_query(self):
+        modified = datetime.datetime(2026, 1, 1)
+        key1 = QueryResultCache.make_key("SELECT *\n  FROM t", [], ["id"], modified)
+        key2 = QueryResultCache.make_key("SELECT * FROM t", [], ["id"], modified)
+        key3 = QueryResultCache.make_key(
+            "SELECT * FROM t", [], ["id"], modified + datetime.timedelta(seconds=1)
+        )
+        assert key1 == key2
+        assert key1 != key3
+
+    def test_get_put_invalidate(self, cache: QueryResultCache):
+        df = pl.DataFrame({"id": [1, 2, 3]})
+        assert cache.get("p.d.t", "key") is None
+        cache.put("p.d.t", "key", df)
+        cached = cache.get("p.d.t", "key")
+        assert cached is not None
+        assert df.equals(cached)
+        assert cache.stats.hits == 1
+        assert cache.stats.misses == 1
+        assert cache.stats.bytes_saved > 0
+        cache.invalidate("p.d.t")
+        assert cache.get("p.d.t", "key") is None
+
+    def test_ttl(self, cache: QueryResultCache):
+        cache.ttl_seconds = 0
+        cache.put("p.d.t", "key", pl.DataFrame({"id": [1]}))
+        time.sleep(0.01)
+        assert cache.get("p.d.t", "key") is None
+
+    def test_lru_eviction(self, cache: QueryResultCache):
+        df = pl.DataFrame({"id": list(range(1000))})
+        cache.put("p.d.t", "old", df)
+        cache.put("p.d.t", "new", df)
+        entry_size = (cache.cache_dir / "p.d.t" / "old.parquet").stat().st_size
+        # make "old" the most recently used entry
+        time.sleep(0.01)
+        assert cache.get("p.d.t", "old") is not None
+        cache.max_bytes = entry_size * 2
+        cache.put("p.d.t", "newest", df)
+        assert cache.get("p.d.t", "old") is not None
+        assert cache.get("p.d.t", "new") is None
+
+    def test_dml_target_tables(self):
+        query = "DELETE FROM `p.d.t` WHERE TRUE; INSERT INTO p.d.u (id) VALUES (1)"
+        assert dml_target_tables(query) == {"p.d.t", "p.d.u"}
+        merge = (
+            "MERGE `p.d.t` T USING `p.d.s` S ON T.id = S.id "
+            "WHEN MATCHED THEN UPDATE SET name = S.name "
+            "WHEN NOT MATCHED THEN INSERT ROW "
+            "WHEN NOT MATCHED BY SOURCE THEN DELETE"
+        )
+        assert dml_target_tables(merge) == {"p.d.t"}
+
+
+class TestAsyncHandlers:
+    @pytest.fixture
+    def executor(self) -> Iterator[ThreadPoolExecutor]:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            yield executor
+
+    def test_wait_job_polls_without_blocking(self, executor: ThreadPoolExecutor):
+        class SlowJob(PollingFuture):
+            def __init__(self, n_polls: int) -> None:
+                super().__init__()
+                self.remaining = n_polls
+
+            def done(self, retry=None) -> bool:
+                self.remaining -= 1
+                return self.remaining <= 0
+
+            def result(self, timeout=None, retry=None, polling=None):
+                assert self.remaining <= 0
+                return self
+
+            def cancel(self) -> bool:
+                return False
+
+            def cancelled(self) -> bool:
+                return False
+
+        handler = AsyncBQPolarsHandler(
+            executor=executor,
+            handler=BQPolarsHandler(client=cast(bq.Client, None)),
+            poll_initial_interval=0.01,
+        )
+
+        async def run() -> list[SlowJob]:
+            # more jobs than threads: waiting must not hold a thread per job
+            jobs = [SlowJob(n_polls=3) for _ in range(20)]
+            return await asyncio.gather(*(handler.wait_job(job) for job in jobs))
+
+        jobs = asyncio.run(run())
+        assert all(job.remaining <= 0 for job in jobs)
+
+    def test_concurrent_transfers(self, executor: ThreadPoolExecutor):
+        uploaded: list[str] = []
+
+        class SlowGCSHandler:
+            def upload_bytes(self, data: bytes, loc: GCSLocation) -> None:
+                time.sleep(0.05)
+                uploaded.append(loc.path)
+
+        handler = AsyncGCSHandler(
+            executor=executor,
+            handler=cast(GCSHandler, SlowGCSHandler()),
+        )
+
+        async def run() -> None:
+            await asyncio.gather(
+                *(
+                    handler.upload_bytes(b"data", GCSLocation(bucket=GS_BUCKET, path=f"{i}"))
+                    for i in range(8)
+                )
+            )
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        # 8 uploads on 4 threads take two rounds, not eight
+        assert time.perf_counter() - started < 0.3
+        assert sorted(uploaded) == [str(i) for i in range(8)]
+
+    def test_upload_stream(self, executor: ThreadPoolExecutor):
+        class FakeWriter:
+            def __init__(self) -> None:
+                self.chunks: list[bytes] = []
+                self.closed = False
+
+            def write(self, data: bytes) -> int:
+                assert not self.closed
+                self.chunks.append(data)
+                return len(data)
+
+            def close(self) -> None:
+                self.closed = True
+
+        writer = FakeWriter()
+
+        class StreamingGCSHandler:
+            def open_writer(self, loc: GCSLocation) -> FakeWriter:
+                return writer
+
+            def get_blob(self, loc: GCSLocation) -> str:
+                assert writer.closed
+                return loc.path
+
+        handler = AsyncGCSHandler(
+            executor=executor,
+            handler=cast(GCSHandler, StreamingGCSHandler()),
+        )
+
+        async def body():
+            for chunk in (b"a,b\n", b"", b"1,2\n"):
+                yield chunk
+
+        blob = asyncio.run(
+            handler.upload_stream(body(), GCSLocation(bucket=GS_BUCKET, path="x.csv"))
+        )
+        assert blob == "x.csv"
+        assert writer.chunks == [b"a,b\n", b"1,2\n"]
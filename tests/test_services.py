@@ -1,10 +1,111 @@
+import datetime
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+from typing import cast
+
+from google.api_core.exceptions import BadRequest
+from google.cloud.bigquery import DmlStats
+from google.cloud.storage import Blob, Bucket
+
 import polars as pl
 import pytest
 
-from dami.container import DIContainer
-from dami.ext.gcs import GCSLocation
-from dami.services.moneyforward import MoneyForwardService
+import dami
+from dami.container import AppSettings, DIContainer
+from dami.ext.aio import AIO_MAX_WORKERS
+from dami.ext.bq import BQPolarsHandler
+from dami.ext.bq_schema import SchemaRegistry
+from dami.ext.gcs import UPLOAD_MAX_WORKERS, GCSHandler, GCSLocation, file_crc32c
+from dami.ext.http import HTTP_POOL_SIZE
+from dami.ext.query_cache import dml_target_tables
+from dami.services.ingest import IngestJobQueue, QueueFullError
+from dami.services.moneyforward import (
+    COL_MAPPING,
+    LANDING_SUFFIX,
+    MoneyForwardService,
+    UpsertStats,
+)
+from dami.settings import BQ_SCHEMA_DIR, BQ_TABLE_OPTIONS_DIR
+from dami.tracing import InMemoryExporter, configure_tracing
+from dami.types.bq import BQTable, BQTimePartitioning
 from dependency_injector import providers
+from loguru import logger
+from tests.fakes import FakeClients, override_with_fakes
+
+
+class StubBQHandler:
+    """
+    Records the calls made by `MoneyForwardService`; DML jobs report `dml_stats`.
+    """
+
+    def __init__(self, dml_stats: DmlStats | None = None) -> None:
+        self.dml_stats = dml_stats
+        self.inserted: list[tuple[pl.DataFrame, BQTable]] = []
+        self.queries: list[tuple[str, dict]] = []
+        self.labels: dict[str, str] = {}
+        self.created: list[BQTable] = []
+        self.deleted: list[BQTable] = []
+
+    def create_table(self, table, exists_ok=True, expires=None) -> None:
+        self.created.append(table)
+
+    def delete_table(self, table) -> None:
+        self.deleted.append(table)
+
+    def get_labels(self, table) -> dict[str, str]:
+        return dict(self.labels)
+
+    def update_labels(self, table, labels) -> None:
+        self.labels.update(labels)
+
+    def get_time_partitioning(self, table: BQTable) -> BQTimePartitioning | None:
+        return table.time_partitioning
+
+    def insert_df(self, df, table, write_disposition="WRITE_APPEND") -> None:
+        self.inserted.append((df, table))
+
+    def replace_partitions(self, df, table, partition_ids=None) -> list[str]:
+        self.inserted.append((df, table))
+        return partition_ids or []
+
+    def run_update_query(self, query, params) -> SimpleNamespace:
+        self.queries.append((query, params))
+        return SimpleNamespace(dml_stats=self.dml_stats)
+
+
+def make_mf_csv(rows: list[tuple[str, str, int]]) -> bytes:
+    return (
+        make_mf_df(rows)
+        .rename({v: k for k, v in COL_MAPPING.items()})
+        .with_columns(pl.col("日付").dt.strftime("%Y/%m/%d"))
+        .write_csv()
+        .encode("shift-jis")
+    )
+
+
+def make_mf_df(rows: list[tuple[str, str, int]]) -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "is_calculation_target": [1] * len(rows),
+            "transaction_date": [datetime.date(2026, 1, 1)] * len(rows),
+            "content": [content for _, content, _ in rows],
+            "amount": [amount for _, _, amount in rows],
+            "financial_institution": ["bank"] * len(rows),
+            "major_category": ["food"] * len(rows),
+            "minor_category": [None] * len(rows),
+            "memo": [None] * len(rows),
+            "is_transfer": [0] * len(rows),
+            "transaction_id": [tid for tid, _, _ in rows],
+        },
+        schema_overrides={"minor_category": pl.String, "memo": pl.String},
+    )
 
 
 class TestMoneyForwardService:
@@ -24,6 +125,61 @@ class TestMoneyForwardService:
     def test_insert(self, service: MoneyForwardService):
         service.insert_latest_csv()
 
+    def test_upsert_df(self):
+        current = make_mf_df([("a", "lunch", 100), ("b", "dinner", 200), ("c", "cafe", 300)])
+        bq_handler = StubBQHandler(
+            DmlStats(inserted_row_count=1, updated_row_count=1, deleted_row_count=1)
+        )
+        service = MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, None),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+        stats = service.upsert_df(current)
+        assert stats == UpsertStats(inserted=1, updated=1, unchanged=1, deleted=1)
+        # every row is staged; BQ compares the hashes
+        (staged, staging_table), = bq_handler.inserted
+        assert staging_table.table.startswith("moneyforward_staging_")
+        assert bq_handler.created == bq_handler.deleted == [staging_table]
+        assert staged.equals(current)
+        (merge_query, params), = bq_handler.queries
+        assert merge_query.startswith("MERGE")
+        # only the table is invalidated, not the keywords of the MERGE
+        assert dml_target_tables(merge_query) == {"strange-oxide-138404.finance.moneyforward"}
+        assert "WHEN MATCHED AND TO_HEX(MD5(" in merge_query
+        assert "IFNULL(CAST(S.amount AS STRING)" in merge_query
+        assert params == {
+            "start_date": datetime.date(2026, 1, 1),
+            "end_date": datetime.date(2026, 1, 1),
+        }
+
+    def test_upsert_df_unchanged(self):
+        current = make_mf_df([("a", "lunch", 100)])
+        bq_handler = StubBQHandler(DmlStats())
+        service = MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, None),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+        stats = service.upsert_df(current)
+        assert stats == UpsertStats(inserted=0, updated=0, unchanged=1, deleted=0)
+
+    def test_upsert_df_failure_drops_staging(self):
+        class FailingBQHandler(StubBQHandler):
+            def run_update_query(self, query, params) -> SimpleNamespace:
+                raise BadRequest("MERGE failed")
+
+        bq_handler = FailingBQHandler()
+        service = MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, None),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+        with pytest.raises(BadRequest):
+            service.upsert_df(make_mf_df([("a", "lunch", 100)]))
+        assert len(bq_handler.created) == 1
+        assert bq_handler.deleted == bq_handler.created
+
 
 def test_pass():
     df = pl.read_csv(
@@ -31,3 +187,524 @@ def test_pass():
         encoding="shift-jis",
     )
     assert "内容" in df.columns
+
+
+class StubGCSHandler:
+    """
+    Serves one CSV blob and the landing copies written of it, and records
+    uploads and downloads.
+    """
+
+    def __init__(self, blob: Blob | None) -> None:
+        self.blob = blob
+        self.uploaded: list[Path] = []
+        self.downloaded: list[Blob] = []
+        self.landing: dict[str, tuple[Blob, pl.DataFrame]] = {}
+
+    def find_blob(self, loc: GCSLocation) -> Blob | None:
+        if loc.path.endswith(LANDING_SUFFIX):
+            return self.landing[loc.path][0] if loc.path in self.landing else None
+        return self.blob
+
+    def get_blob(self, loc: GCSLocation) -> Blob:
+        assert self.blob is not None
+        return self.blob
+
+    def upload_file(
+        self, local_path: Path, loc: GCSLocation, metadata: dict[str, str] | None = None
+    ) -> None:
+        if loc.path.endswith(LANDING_SUFFIX):
+            blob = Blob(loc.path, bucket=Bucket(client=None, name=loc.bucket))
+            blob.metadata = metadata
+            self.landing[loc.path] = (blob, pl.read_parquet(local_path))
+            return
+        self.uploaded.append(local_path)
+
+    def download_df(
+        self, blob: Blob, str_encoding: str | None, max_memory_bytes: int | None = None
+    ) -> pl.DataFrame:
+        self.downloaded.append(blob)
+        if blob.name in self.landing:
+            return self.landing[blob.name][1]
+        return make_mf_df([("a", "lunch", 100)]).rename(
+            {v: k for k, v in COL_MAPPING.items()}
+        ).with_columns(pl.col("日付").dt.strftime("%Y/%m/%d"))
+
+
+class TestMoneyForwardShortCircuit:
+    @pytest.fixture
+    def csv_path(self, tmp_path: Path) -> Path:
+        path = tmp_path / "mf.csv"
+        path.write_bytes(make_mf_csv([("a", "lunch", 100)]))
+        return path
+
+    @pytest.fixture
+    def blob(self, csv_path: Path) -> Blob:
+        blob = Blob("mf_records//mf.csv", bucket=Bucket(client=None, name="whiro-dami-storage"), generation=1)
+        blob._properties["crc32c"] = file_crc32c(csv_path)
+        return blob
+
+    def make_service(
+        self, gcs_handler: StubGCSHandler, bq_handler: StubBQHandler
+    ) -> MoneyForwardService:
+        return MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, gcs_handler),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+
+    def test_rerun_is_noop(self, csv_path: Path, blob: Blob):
+        gcs_handler = StubGCSHandler(blob)
+        bq_handler = StubBQHandler()
+        service = self.make_service(gcs_handler, bq_handler)
+        # first run: same bytes already in GCS but never loaded;
+        # only the landing copy is written, and read instead of the CSV
+        service.ingest_csv(csv_path)
+        assert gcs_handler.uploaded == []
+        ((landing, _),) = gcs_handler.landing.values()
+        assert gcs_handler.downloaded == [landing]
+        assert len(bq_handler.inserted) == 1
+        # second run: nothing to do
+        service.ingest_csv(csv_path)
+        assert len(gcs_handler.landing) == 1
+        assert gcs_handler.downloaded == [landing]
+        assert len(bq_handler.inserted) == 1
+        # force reloads
+        service.ingest_csv(csv_path, force=True)
+        assert len(bq_handler.inserted) == 2
+
+    def test_changed_file_is_uploaded(self, csv_path: Path, blob: Blob):
+        gcs_handler = StubGCSHandler(blob)
+        service = self.make_service(gcs_handler, StubBQHandler())
+        csv_path.write_bytes(make_mf_csv([("b", "dinner", 200)]))
+        service.upload_csv_to_gcs(csv_path)
+        assert gcs_handler.uploaded == [csv_path]
+        ((_, landed),) = gcs_handler.landing.values()
+        assert landed["transaction_id"].to_list() == ["b"]
+
+
+class TestMoneyForwardBackfill:
+    def test_backfill_newest_file_wins(self):
+        def make_csv_df(dates: list[datetime.date], content: str) -> pl.DataFrame:
+            rows = [(f"{content}-{d}", content, 100) for d in dates]
+            return make_mf_df(rows).with_columns(pl.Series("transaction_date", dates))
+
+        jan = [datetime.date(2026, 1, d) for d in (1, 15, 31)]
+        jan_feb = [datetime.date(2026, 1, 20), datetime.date(2026, 2, 10)]
+        now = datetime.datetime(2026, 3, 1)
+        frames = {
+            "old.csv": (make_csv_df(jan, "old"), now - datetime.timedelta(days=30)),
+            "new.csv": (make_csv_df(jan_feb, "new"), now),
+        }
+
+        class BackfillGCSHandler:
+            def list_blobs(self, prefix: GCSLocation, suffix: str) -> list[Blob]:
+                blobs = []
+                for name, (_, updated) in frames.items():
+                    blob = Blob(name, bucket=None)
+                    blob._properties["updated"] = updated.isoformat() + "Z"
+                    blobs.append(blob)
+                return blobs
+
+            def download_df(self, blob, str_encoding, max_memory_bytes=None):
+                df = frames[blob.name][0]
+                return df.rename({v: k for k, v in COL_MAPPING.items()}).with_columns(
+                    pl.col("日付").dt.strftime("%Y/%m/%d")
+                )
+
+        bq_handler = StubBQHandler()
+        service = MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, BackfillGCSHandler()),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+        assert service.backfill(max_workers=2) == 4
+        (loaded, _), = bq_handler.inserted
+        # 2026-01-31 falls in the newer file's range (01-20 to 02-10) and is dropped
+        assert sorted(loaded["transaction_id"].to_list()) == [
+            "new-2026-01-20",
+            "new-2026-02-10",
+            "old-2026-01-01",
+            "old-2026-01-15",
+        ]
+
+
+class TestIngestJobQueue:
+    def test_jobs_run_in_background(self):
+        release = threading.Event()
+
+        class BlockingService:
+            def insert_csv_blob(self, blob: Blob, mode: str = "replace", force: bool = False):
+                assert release.wait(timeout=5)
+                if blob.name == "bad.csv":
+                    raise ValueError("broken CSV")
+                return UpsertStats(inserted=1, updated=0, unchanged=0, deleted=0)
+
+        service = BlockingService()
+        queue = IngestJobQueue(
+            service_factory=lambda: cast(MoneyForwardService, service),
+            max_workers=1,
+            max_pending=2,
+        )
+        bucket = Bucket(client=None, name="whiro-dami-storage")
+        ok = queue.submit(Blob("ok.csv", bucket=bucket), mode="upsert")
+        bad = queue.submit(Blob("bad.csv", bucket=bucket))
+        assert queue.is_full()
+        with pytest.raises(QueueFullError):
+            queue.submit(Blob("more.csv", bucket=bucket))
+        release.set()
+        queue.shutdown(wait=True)
+
+        ok_job, bad_job = queue.get(ok.id), queue.get(bad.id)
+        assert ok_job is not None and bad_job is not None
+        assert ok_job.status == "succeeded"
+        assert ok_job.blob_uri == "gs://whiro-dami-storage/ok.csv"
+        assert ok_job.stats == UpsertStats(inserted=1, updated=0, unchanged=0, deleted=0)
+        assert bad_job.status == "failed" and "broken CSV" in (bad_job.error or "")
+        assert [job.id for job in queue.list()] == [ok.id, bad.id]
+        assert not queue.is_full()
+        assert queue.get("missing") is None
+
+    def test_overlapping_upserts_stage_separately(self):
+        frames = {
+            "a.csv": make_mf_df([("a", "lunch", 100)]),
+            "b.csv": make_mf_df([("b", "dinner", 200)]),
+        }
+
+        class CSVGCSHandler:
+            def find_blob(self, loc: GCSLocation) -> Blob | None:
+                return None
+
+            def download_df(self, blob, str_encoding, max_memory_bytes=None):
+                df = frames[blob.name].rename({v: k for k, v in COL_MAPPING.items()})
+                return df.with_columns(pl.col("日付").dt.strftime("%Y/%m/%d"))
+
+        class OverlappingBQHandler(StubBQHandler):
+            """
+            Holds each staging load until both jobs have staged, and records
+            the rows each MERGE reads from its staging table.
+            """
+
+            def __init__(self) -> None:
+                super().__init__(DmlStats())
+                self.staged: dict[str, pl.DataFrame] = {}
+                self.merged: list[list[str]] = []
+                self.both_staged = threading.Barrier(2, timeout=5)
+                self._lock = threading.Lock()
+
+            def insert_df(self, df, table, write_disposition="WRITE_APPEND") -> None:
+                with self._lock:
+                    if write_disposition == "WRITE_TRUNCATE":
+                        self.staged[table.table] = df
+                    else:
+                        self.staged[table.table] = pl.concat(
+                            [self.staged.get(table.table, df.clear()), df]
+                        )
+                self.both_staged.wait()
+
+            def run_update_query(self, query, params) -> SimpleNamespace:
+                match = re.search(r"USING `[^`]+\.([^.`]+)` S", query)
+                assert match is not None
+                with self._lock:
+                    staged = self.staged[match.group(1)]
+                    self.merged.append(staged["transaction_id"].to_list())
+                return super().run_update_query(query, params)
+
+        bq_handler = OverlappingBQHandler()
+        service = MoneyForwardService(
+            bq_handler=cast(BQPolarsHandler, bq_handler),
+            gcs_handler=cast(GCSHandler, CSVGCSHandler()),
+            gcs_dir=GCSLocation(bucket="whiro-dami-storage", path="mf_records/"),
+        )
+        queue = IngestJobQueue(service_factory=lambda: service, max_workers=2)
+        bucket = Bucket(client=None, name="whiro-dami-storage")
+        jobs = [queue.submit(Blob(name, bucket=bucket), mode="upsert") for name in frames]
+        queue.shutdown(wait=True)
+
+        for job in jobs:
+            finished = queue.get(job.id)
+            assert finished is not None and finished.status == "succeeded"
+        # each MERGE reads only the rows of its own CSV
+        assert sorted(bq_handler.merged) == [["a"], ["b"]]
+        assert len({table.table for table in bq_handler.created}) == 2
+        assert sorted(t.table for t in bq_handler.deleted) == sorted(
+            t.table for t in bq_handler.created
+        )
+
+    def test_unexpected_error_is_logged_with_traceback(self):
+        class BrokenService:
+            def insert_csv_blob(self, blob: Blob, mode: str = "replace", force: bool = False):
+                raise RuntimeError("bug")
+
+        messages: list[str] = []
+        sink_id = logger.add(messages.append, level="ERROR")
+        try:
+            queue = IngestJobQueue(
+                service_factory=lambda: cast(MoneyForwardService, BrokenService())
+            )
+            bucket = Bucket(client=None, name="whiro-dami-storage")
+            job = queue.submit(Blob("ok.csv", bucket=bucket))
+            queue.shutdown(wait=True)
+        finally:
+            logger.remove(sink_id)
+        failed = queue.get(job.id)
+        assert failed is not None and failed.status == "failed"
+        assert failed.error == "RuntimeError('bug')"
+        assert not queue.is_full()
+        assert any("Traceback" in message for message in messages)
+
+
+class TestMoneyForwardOffline:
+    @pytest.fixture
+    def fake_container(self) -> tuple[DIContainer, FakeClients]:
+        container = DIContainer()
+        clients = override_with_fakes(container)
+        container.mf_gcs_location.override(
+            providers.Object(GCSLocation(bucket="whiro-dami-storage", path="mf_records"))
+        )
+        return container, clients
+
+    def test_insert_latest_csv(self, fake_container: tuple[DIContainer, FakeClients]):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        table_id = "strange-oxide-138404.finance.moneyforward"
+        clients.storage.put_object(
+            "whiro-dami-storage",
+            "mf_records/2026-01.csv",
+            make_mf_csv([("a", "コンビニ", -500), ("b", "給与", 300000)]),
+        )
+        service.insert_latest_csv()
+        assert sorted(clients.bq.read_table(table_id)["content"].to_list()) == ["コンビニ", "給与"]
+        # the date range is replaced by partition loads, without DML
+        assert clients.bq.queries == []
+
+        # the newer export replaces the rows of its date range
+        clients.storage.put_object(
+            "whiro-dami-storage",
+            "mf_records/2026-02.csv",
+            make_mf_csv([("a", "スーパー", -800)]),
+        )
+        service.insert_latest_csv()
+        loaded = clients.bq.read_table(table_id)
+        assert loaded["transaction_id"].to_list() == ["a"]
+        assert loaded["content"].to_list() == ["スーパー"]
+
+        # already loaded: neither downloaded nor loaded again
+        clients.reset_counters()
+        service.insert_latest_csv()
+        assert clients.bytes_copied == 0
+
+    def test_replace_wide_range(self, fake_container: tuple[DIContainer, FakeClients]):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        df = make_mf_df([("a", "x", 1), ("b", "y", 2)]).with_columns(
+            pl.Series("transaction_date", [datetime.date(2026, 1, 1), datetime.date(2026, 6, 1)])
+        )
+        service.replace_date_range(df)
+        # too many partitions for one load job each
+        (query,) = clients.bq.queries
+        assert query.startswith("DELETE")
+        assert clients.bq.read_table(service.bq_table.get_bq_table_id()).height == 2
+
+    def test_replace_in_unpartitioned_table(
+        self, fake_container: tuple[DIContainer, FakeClients]
+    ):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        # created before the partitioning options, and not migrated yet
+        clients.bq.create_table(service.bq_table.model_copy(update={"time_partitioning": None}))
+        service.replace_date_range(make_mf_df([("a", "x", 1)]))
+        (query,) = clients.bq.queries
+        assert query.startswith("DELETE")
+        assert clients.bq.read_table(service.bq_table.get_bq_table_id()).height == 1
+
+    def test_reload_after_table_recreated(
+        self, fake_container: tuple[DIContainer, FakeClients]
+    ):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        table_id = service.bq_table.get_bq_table_id()
+        clients.storage.put_object(
+            "whiro-dami-storage", "mf_records/2026-01.csv", make_mf_csv([("a", "x", 1)])
+        )
+        service.insert_latest_csv()
+        assert clients.bq.read_table(table_id).height == 1
+        # the new table carries no loaded marks
+        clients.bq.delete_table(table_id)
+        clients.bq.create_table(service.bq_table)
+        service.insert_latest_csv()
+        assert clients.bq.read_table(table_id)["transaction_id"].to_list() == ["a"]
+
+    def test_older_export_is_reloaded(self, fake_container: tuple[DIContainer, FakeClients]):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        table_id = service.bq_table.get_bq_table_id()
+        handler = container.gcs_handler()
+        blobs = []
+        for name, content in (("old", "古い"), ("new", "新しい")):
+            loc = GCSLocation(bucket="whiro-dami-storage", path=f"mf_records/{name}.csv")
+            clients.storage.put_object(loc.bucket, loc.path, make_mf_csv([("a", content, 1)]))
+            blobs.append(handler.get_blob(loc))
+        old, new = blobs
+        service.insert_csv_blob(old)
+        service.insert_csv_blob(new)
+        # the table holds the rows of the newer file, so the older one is not skipped
+        service.insert_csv_blob(old)
+        assert clients.bq.read_table(table_id)["content"].to_list() == ["古い"]
+        clients.reset_counters()
+        service.insert_csv_blob(old)
+        assert clients.bytes_copied == 0
+
+    def test_schema_change_reaches_service(
+        self, fake_container: tuple[DIContainer, FakeClients], tmp_path: Path
+    ):
+        container, _ = fake_container
+        schema_path = tmp_path / "moneyforward.json"
+        shutil.copy(BQ_SCHEMA_DIR / "moneyforward.json", schema_path)
+        os.utime(schema_path, ns=(1_000_000_000, 1_000_000_000))
+        service: MoneyForwardService = container.mf_service()
+        service.schema_registry = SchemaRegistry(
+            schema_dir=tmp_path, options_dir=BQ_TABLE_OPTIONS_DIR
+        )
+        table, key = service.bq_table, service.landing_schema_key
+        assert service.bq_table is table
+
+        columns = json.loads(schema_path.read_text())
+        columns.append({"name": "note", "type": "STRING", "mode": "NULLABLE"})
+        schema_path.write_text(json.dumps(columns))
+        os.utime(schema_path, ns=(2_000_000_000, 2_000_000_000))
+        assert service.bq_table.fields[-1].name == "note"
+        # landing copies of the old schema become stale
+        assert service.landing_schema_key != key
+
+    def test_landing_copy(
+        self, fake_container: tuple[DIContainer, FakeClients], tmp_path: Path
+    ):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        table_id = service.bq_table.get_bq_table_id()
+        csv_path = tmp_path / "2026-01.csv"
+        csv_path.write_bytes(make_mf_csv([("a", "コンビニ", -500), ("b", "給与", 300000)]))
+        service.upload_csv_to_gcs(csv_path)
+        landing = clients.storage.objects[
+            ("whiro-dami-storage", "mf_records/2026-01.csv.parquet")
+        ]
+        landed = pl.read_parquet(landing.data)
+        assert landed.schema["transaction_date"] == pl.Date
+        assert landing.metadata is not None
+        assert landing.metadata["dami-source-crc32c"] == file_crc32c(csv_path)
+
+        # the typed copy is read instead of the CSV
+        clients.reset_counters()
+        service.insert_latest_csv()
+        assert clients.storage.bytes_downloaded == len(landing.data)
+        assert sorted(clients.bq.read_table(table_id)["content"].to_list()) == ["コンビニ", "給与"]
+
+        # a CSV overwritten since makes the copy stale
+        clients.storage.put_object(
+            "whiro-dami-storage", "mf_records/2026-01.csv", make_mf_csv([("a", "スーパー", -800)])
+        )
+        service.insert_latest_csv()
+        assert clients.bq.read_table(table_id)["content"].to_list() == ["スーパー"]
+
+    def test_landing_copy_next_to_csv(
+        self, fake_container: tuple[DIContainer, FakeClients], tmp_path: Path
+    ):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        csv_path = tmp_path / "2026-01.csv"
+        csv_path.write_bytes(make_mf_csv([("a", "コンビニ", -500)]))
+        # a CSV outside of `gcs_dir`, e.g. found by a backfill of another prefix
+        clients.storage.put_object("other-bucket", "archive/2026-01.csv", csv_path.read_bytes())
+        blob = service.gcs_handler.get_blob(
+            GCSLocation(bucket="other-bucket", path="archive/2026-01.csv")
+        )
+        loc = service.write_landing_copy(csv_path, blob)
+        assert (loc.bucket, loc.path) == ("other-bucket", "archive/2026-01.csv.parquet")
+        assert service.find_landing_copy(blob) is not None
+        landed = pl.read_parquet(clients.storage.objects[("other-bucket", loc.path)].data)
+        assert landed["content"].to_list() == ["コンビニ"]
+
+    def test_landing_copy_loaded_from_uri(
+        self, fake_container: tuple[DIContainer, FakeClients], tmp_path: Path
+    ):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        csv_path = tmp_path / "2026-h1.csv"
+        csv_path.write_bytes(
+            make_mf_csv([("a", "x", 1), ("b", "y", 2)]).replace(b"2026/01/01", b"2026/06/01", 1)
+        )
+        service.upload_csv_to_gcs(csv_path)
+        clients.reset_counters()
+        service.insert_latest_csv()
+        # too many partitions to replace; BQ loads the copy from GCS after the DELETE
+        (query,) = clients.bq.queries
+        assert query.startswith("DELETE")
+        assert clients.bytes_copied == 0
+        loaded = clients.bq.read_table(service.bq_table.get_bq_table_id())
+        assert sorted(loaded["transaction_date"].to_list()) == [
+            datetime.date(2026, 1, 1),
+            datetime.date(2026, 6, 1),
+        ]
+
+    def test_insert_latest_csv_spans(self, fake_container: tuple[DIContainer, FakeClients]):
+        container, clients = fake_container
+        service: MoneyForwardService = container.mf_service()
+        clients.bq.create_table(service.bq_table)
+        clients.storage.put_object(
+            "whiro-dami-storage",
+            "mf_records/2026-01.csv",
+            make_mf_csv([("a", "コンビニ", -500), ("b", "給与", 300000)]),
+        )
+        exporter = InMemoryExporter()
+        configure_tracing(exporter)
+        try:
+            service.insert_latest_csv()
+        finally:
+            configure_tracing(None)
+        (root,) = exporter.find("mf.insert_csv_blob")
+        assert root.attributes["blob"] == "mf_records/2026-01.csv"
+        (replace,) = exporter.find("bq.replace_partitions")
+        assert replace.parent_id == root.span_id
+        assert replace.attributes["rows"] == 2
+        assert replace.attributes["partitions"] == 1
+        (encode,) = exporter.find("bq.parquet_encode")
+        assert isinstance(encode.attributes["bytes"], int) and encode.attributes["bytes"] > 0
+        assert exporter.find("bq.load_job_wait")[0].parent_id == replace.span_id
+        assert exporter.find("gcs.download_df")[0].parent_id == root.span_id
+
+
+class TestLazyContainer:
+    def run_isolated(self, code: str) -> list[str]:
+        # a fresh interpreter, since this one already imported everything
+        src = str(Path(dami.__file__).parent.parent)
+        proc = subprocess.run(
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONPATH": src},
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return proc.stdout.split()
+
+    def test_clients_load_on_first_resolve(self):
+        loaded = self.run_isolated(
+            "import sys\n"
+            "from dami.container import DIContainer\n"
+            "lazy = ['polars', 'pyarrow', 'google.cloud.storage', 'google.cloud.bigquery']\n"
+            "print(*[m for m in lazy if m in sys.modules], 'resolved')\n"
+            "DIContainer().bq_load_options()\n"
+            "print(*[m for m in lazy if m in sys.modules])\n"
+        )
+        assert loaded[: loaded.index("resolved")] == []
+        assert {"polars", "google.cloud.bigquery"} <= set(loaded)
+
+    def test_http_pool_size(self):
+        assert AppSettings.model_fields["http_pool_size"].default == HTTP_POOL_SIZE
+        assert HTTP_POOL_SIZE >= AIO_MAX_WORKERS + UPLOAD_MAX_WORKERS